@@ -7,137 +7,527 @@ import argparse
 import json
 import os
 import shutil
+import signal
 import subprocess
-from pathlib import Path
-from functools import partial
+import time
 from multiprocessing import Pool
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 
 import bias_utils
+import cooccur_utils
+import glove_trainer
 import vector_utils
+import workspace_utils
+import work_queue
 import coha_utils
+import corpus_cache
+import doc_influence
+import results_store
+import trace_utils
 from setup import generate_subset
+from bootstrap_utils import parse_bootstrap_output
 import file_utils
 
 
-def safe_delete(file: str):
-    try:
-        os.remove(file)
-    except OSError:
-        pass
+# Co-occurrence data of the in-process trainer, loaded once per worker process
+_worker_data = {}
 
 
-def copy_check(f: str, out_file: str):
-    if not os.path.exists(out_file):
-        os.system(f'cp {f} {out_file}')
+def _terminate_worker(signum, frame):
+    # Pool.terminate sends SIGTERM: kill the running GloVe process group and remove the workspace
+    # of the iteration, then exit at once (unwinding could block the pool's join)
+    process = _worker_data.get('glove_process')
+    if process is not None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+            # Not process.wait, which may be what the signal interrupted (and holds its lock)
+            os.waitpid(process.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+    workspace = _worker_data.get('workspace')
+    if workspace is not None:
+        shutil.rmtree(str(workspace), ignore_errors=True)
+    os._exit(1)
 
 
-def run_iteration(k: int, vector_loc: str, bias_query: Dict[str, str]):
-    # Save in GloVe format and set up files to run GloVe (save vocab and cooccurrence.bin)
-    output_dir = Path(vector_loc, str(k))
-    safe_delete(f'{output_dir}/vectors.txt')
+def init_worker(vector_loc: str, trainer: str, document_store: Optional[str] = None):
+    signal.signal(signal.SIGTERM, _terminate_worker)
+    if document_store is not None:
+        _worker_data['store'] = doc_influence.load_document_store(store_dir=document_store)
+        _worker_data['vocab'] = vector_utils.load_vocab_words(vocab_file=f'{vector_loc}/vocab.txt')
+    elif trainer == 'python':
+        _worker_data['cooccurrences'] = cooccur_utils.load_cooccurrence(
+            cooccurrence_file=f'{vector_loc}/cooccurrence.bin')
+        _worker_data['vocab'] = vector_utils.load_vocab_words(vocab_file=f'{vector_loc}/vocab.txt')
 
-    output_dir.mkdir(parents=True, exist_ok=True)
-    copy_check(f=f'{vector_loc}/cooccurrence.bin', out_file=f'{output_dir}/cooccurrence.bin')
-    copy_check(f=f'{vector_loc}/vocab.txt', out_file=f'{output_dir}/vocab.txt')
 
-    # Run GloVe (only steps 3 shuffle and 4 glove)
-    subprocess.call(
-        [f"run_glove_partial.sh",
-         '',
-         f'../GloVe/',
-         str(output_dir) + '/',
-         '',
-         str(k),
-         ])
+def train_glove_subprocess(k: int, vector_loc: str, workspace: str = 'hardlink',
+                           cooccurrences: Optional[sparse.spmatrix] = None,
+                           words: Optional[Iterable[str]] = None, shuffle: str = 'glove',
+                           work_dir: Optional[str] = None) -> vector_utils.Vectors:
+    # Private workspace sharing vocab and cooccurrence.bin with all iterations (or with a
+    # private cooccurrence.bin when the iteration has its own co-occurrences)
+    shared_files = workspace_utils.SHARED_FILES if cooccurrences is None else ('vocab.txt',)
+    with workspace_utils.bootstrap_workspace(
+            vector_loc=vector_loc, k=k, mode=workspace, shared_files=shared_files, work_dir=work_dir) as output_dir:
+        # Removed by _terminate_worker if the pool is terminated during the iteration
+        _worker_data['workspace'] = output_dir
+        if cooccurrences is not None:
+            with trace_utils.stage('write_cooccurrence'):
+                cooccur_utils.write_cooccurrence(
+                    matrix=cooccurrences, cooccurrence_file=str(output_dir / 'cooccurrence.bin'))
 
-    # Load vectors (we use the center vectors)
-    _, _, center_vectors = vector_utils.load_fulltxt_vectors(vectors_file=f'{vector_loc}/{k}/vectors.txt')
+        if shuffle == 'python':
+            # Shuffle seeded by the iteration number, instead of GloVe's shuffle
+            with trace_utils.stage('shuffle'):
+                cooccur_utils.shuffle_cooccurrence(
+                    cooccurrence_file=str(output_dir / 'cooccurrence.bin'),
+                    buffer_file=str(output_dir / 'cooccurrence.shuf.bin'), seed=k)
 
-    # Compute bias score
-    bias_score_utils = bias_utils.assemble_vectors(
-        vectors=center_vectors, bias_query=bias_query, pre_normalize=False, post_normalize=False, verbose=False)
-    bias_score = bias_utils.compute_bias_score(utils_dict=bias_score_utils, function='cosine')
+        # Run GloVe (only steps 3 shuffle and 4 glove), in its own process group so that the
+        # script and its children are all killed when the iteration is interrupted
+        with trace_utils.stage('glove_shuffle_train'):
+            command = [f"run_glove_partial.sh",
+                       '',
+                       f'../GloVe/',
+                       str(output_dir) + '/',
+                       '',
+                       str(k),
+                       'skip' if shuffle == 'python' else '',
+                       ]
+            process = subprocess.Popen(command, start_new_session=True)
+            _worker_data['glove_process'] = process
+            try:
+                process.wait()
+            except BaseException:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                raise
+            finally:
+                _worker_data.pop('glove_process', None)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(returncode=process.returncode, cmd=command)
 
-    # Remove trained vectors
-    safe_delete(str(output_dir / 'vectors.txt'))
-    safe_delete(str(output_dir / 'cooccurrence.bin'))
-    safe_delete(str(output_dir / 'cooccurrence.shuf.bin'))
-    safe_delete(str(output_dir / 'vocab.txt'))
-    shutil.rmtree(str(output_dir))
+        # Load vectors into one compact matrix (only the rows of words, when given)
+        with trace_utils.stage('load_vectors'):
+            vectors = vector_utils.Vectors.load_txt(vectors_file=str(output_dir / 'vectors.txt'), words=words)
+        _worker_data.pop('workspace', None)
 
-    return bias_score
+    return vectors
+
+
+def train_glove_python(k: int, vector_loc: str, cooccurrences: Optional[sparse.spmatrix] = None,
+                       trainer_kwargs: Optional[Dict] = None) -> vector_utils.Vectors:
+    if 'vocab' not in _worker_data:
+        init_worker(vector_loc=vector_loc, trainer='python')
+    records = _worker_data['cooccurrences'] if cooccurrences is None else \
+        cooccur_utils.matrix_to_records(matrix=cooccurrences)
+
+    # Train in memory (the iteration number seeds the shuffle and initialization)
+    with trace_utils.stage('train_python'):
+        parameter_dict = glove_trainer.train_glove(
+            cooccurrences=records, vocab_size=len(_worker_data['vocab']), seed=k, **(trainer_kwargs or {}))
+    parameter_dict['vocab'] = _worker_data['vocab']
+    return vector_utils.Vectors.from_parameters(parameter_dict=parameter_dict)
+
+
+def score_model(parameter_dict: Union[Dict, vector_utils.Vectors], bias_queries: Dict[str, Dict[str, List[str]]],
+                variants: List[str]) -> Dict[str, Dict[str, float]]:
+    """
+    Computes the cosine bias score of every query for every vector variant of one model.
+    :param parameter_dict: (dict) with W, U and vocab entries, or vector_utils.Vectors
+    :param bias_queries: (dict) of bias queries by name
+    :param variants: (list) of vector variants (see vector_utils.VECTOR_VARIANTS)
+    :return: (dict) of scores by query name and vector variant
+    """
+    if isinstance(parameter_dict, vector_utils.Vectors):
+        # The views derive the variants for the query words only
+        embeddings = [parameter_dict.view(variant=variant) for variant in variants]
+        query_vocab = None
+    else:
+        # Derive the variants for the query words only
+        words = {w for bias_query in bias_queries.values() for word_set in bias_query.values() for w in word_set}
+        word_idx = {w: i for i, w in enumerate(parameter_dict['vocab'])}
+        query_vocab = [w for w in words if w in word_idx]
+        rows = np.array([word_idx[w] for w in query_vocab], dtype=np.int64)
+        embeddings = np.stack([
+            vector_utils.vector_variant(parameter_dict=parameter_dict, variant=variant, rows=rows)
+            for variant in variants])
+    names = list(bias_queries.keys())
+    bias_scores = bias_utils.compute_bias_scores_batched(
+        embeddings=embeddings, vocab=query_vocab, bias_queries=[bias_queries[name] for name in names])
+
+    return {name: {variant: float(bias_scores[i, q]) for i, variant in enumerate(variants)}
+            for q, name in enumerate(names)}
+
+
+def run_iteration(k: int, vector_loc: str, bias_query: Dict[str, List[str]], trainer: str = 'glove',
+                  workspace: str = 'hardlink', bias_queries: Optional[Dict[str, Dict[str, List[str]]]] = None,
+                  variants: Tuple[str, ...] = ('center',), keep_vectors_dir: Optional[str] = None,
+                  document_store: Optional[str] = None, trainer_kwargs: Optional[Dict] = None,
+                  permutations: Optional[int] = None, shuffle: str = 'glove', work_dir: Optional[str] = None) -> Dict:
+    """
+    Trains one GloVe model and scores it.
+    :param k: iteration number
+    :param vector_loc: directory with the cooccurrence.bin and vocab.txt of the corpus
+    :param bias_query: (dict) the main bias query, scored on the center vectors
+    :param trainer: (str) glove or python
+    :param workspace: (str) workspace mode of the glove trainer
+    :param work_dir: directory of the workspaces of the glove trainer, vector_loc if None
+    :param shuffle: (str) glove (GloVe's shuffle) or python (cooccur_utils.shuffle_cooccurrence, seeded by k)
+    for the glove trainer
+    :param bias_queries: (dict) of additional bias queries by name, scored for every variant
+    :param variants: vector variants the additional queries are scored on
+    :param keep_vectors_dir: if given, the model is saved as float16 matrices to {keep_vectors_dir}/{k}
+    :param document_store: if given, the model is trained on a document bootstrap replicate of the
+    corpus (seeded by k), built from the per-document co-occurrences of this doc_influence store
+    :param trainer_kwargs: (dict) of glove_trainer.train_glove parameters (e.g. vector_size, max_iter)
+    for the python trainer
+    :param permutations: if given, the main score is also tested with this many permutations of its
+    targets (seeded by k, see bias_utils.permutation_test)
+    :return: (dict) with the main score and, with bias_queries, the scores by query and variant and,
+    with permutations, the permutation test of the main score
+    """
+    with trace_utils.stage('iteration', k=k, trainer=trainer):
+        cooccurrences = None
+        if document_store is not None:
+            if 'store' not in _worker_data:
+                init_worker(vector_loc=vector_loc, trainer=trainer, document_store=document_store)
+            with trace_utils.stage('resample_cooccurrence'):
+                cooccurrences, _ = doc_influence.resample_cooccurrence(store=_worker_data['store'], seed=k)
+
+        if trainer == 'python':
+            vectors = train_glove_python(
+                k=k, vector_loc=vector_loc, cooccurrences=cooccurrences, trainer_kwargs=trainer_kwargs)
+        else:
+            # Scoring only needs the query words, unless the full model is kept
+            words = None
+            if keep_vectors_dir is None:
+                words = {w for query in [bias_query] + list((bias_queries or {}).values())
+                         for word_set in query.values() for w in word_set}
+            vectors = train_glove_subprocess(
+                k=k, vector_loc=vector_loc, workspace=workspace, cooccurrences=cooccurrences, words=words,
+                shuffle=shuffle, work_dir=work_dir)
+
+        # Compute bias score (on the center vectors)
+        with trace_utils.stage('score'):
+            bias_score_utils = bias_utils.assemble_vectors(
+                vectors=vectors.center, bias_query=bias_query, pre_normalize=False, post_normalize=False)
+            result = {'score': float(bias_utils.compute_bias_score(utils_dict=bias_score_utils, function='cosine'))}
+
+        if permutations is not None:
+            with trace_utils.stage('permutation_test'):
+                result['permutation'] = bias_utils.permutation_test(
+                    embeddings=vectors.center, vocab=None, bias_query=bias_query,
+                    n_permutations=permutations, seed=k)
+
+        if bias_queries is not None:
+            with trace_utils.stage('score_queries'):
+                result['scores'] = score_model(
+                    parameter_dict=vectors, bias_queries=bias_queries, variants=list(variants))
+
+        if keep_vectors_dir is not None:
+            with trace_utils.stage('keep_vectors'):
+                vector_utils.save_binary_vectors(
+                    parameter_dict=vectors.parameters, store_dir=os.path.join(keep_vectors_dir, str(k)), dtype=np.float16)
+
+    return result
+
+
+def score_kept_models(keep_vectors_dir: str, bias_queries: Dict[str, Dict[str, List[str]]],
+                      variants: List[str]) -> Dict[int, Dict[str, Dict[str, float]]]:
+    """
+    Scores bias queries against the models saved with keep_vectors_dir, without retraining.
+    :return: (dict) of scores by iteration, query name and vector variant
+    """
+    scores = {}
+    for name in os.listdir(keep_vectors_dir):
+        if name.isdigit():
+            parameter_dict = vector_utils.load_binary_vectors(store_dir=os.path.join(keep_vectors_dir, name))
+            scores[int(name)] = score_model(parameter_dict=parameter_dict, bias_queries=bias_queries, variants=variants)
+    return scores
+
+
+def append_result(log_outfile: str, k: int, result: Dict):
+    # One line per finished iteration, synced so that a crash loses at most the running iterations
+    with open(log_outfile, 'a') as f:
+        f.write(json.dumps({'k': k, **result}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_results(log_outfile: str) -> List[Dict]:
+    results = []
+    if os.path.exists(log_outfile):
+        with open(log_outfile, 'r') as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Partially written last line
+                    continue
+    return results
+
+
+def write_results_dict(log_outfile: str, dict_outfile: str, corpus_type: str):
+    # Results dict in the format read by ChuChuAnalysis, written atomically
+    simulation_dict = {corpus_type: [r['score'] for r in sorted(load_results(log_outfile), key=lambda r: r['k'])]}
+    with open(f'{dict_outfile}.tmp', 'w') as f:
+        json.dump(simulation_dict, f)
+    os.replace(f'{dict_outfile}.tmp', dict_outfile)
+
+
+def check_stopping_rule(bias_scores: List[float], conf_level: float, ci_width: Optional[float],
+                        ci_change: Optional[float], previous_width: Optional[float]) -> Tuple[bool, float]:
+    """
+    Checks whether the bootstrap confidence interval (as reported by
+    bootstrap_utils.parse_bootstrap_output) is narrow enough, or has stopped changing.
+    :param bias_scores: (list) of bias scores so far
+    :param conf_level: confidence level of the interval
+    :param ci_width: target interval width, not used if None
+    :param ci_change: target absolute change in width since the previous check, not used if None
+    :param previous_width: interval width at the previous check
+    :return: (whether to stop, current interval width)
+    """
+    stats = parse_bootstrap_output(
+        bootstrap_stats=[x for x in bias_scores if x is not None], conf_level=conf_level)
+    width = stats['upper'] - stats['lower']
+    stop = (ci_width is not None and width <= ci_width) or \
+        (ci_change is not None and previous_width is not None and abs(width - previous_width) <= ci_change)
+    return stop, width
+
+
+def run_queue_worker(args, queue: work_queue.WorkQueue, bias_query: Dict[str, List[str]], vector_loc: str,
+                     iteration_kwargs: Dict):
+    """
+    Runs iterations claimed from a shared work queue until none are left, so that any number
+    of invocations (on any number of machines) can share one bootstrap.
+    """
+    in_flight = {}
+    previous_width = None
+    finished_count = 0
+    with Pool(processes=args.num_processes, initializer=init_worker,
+              initargs=(vector_loc, args.trainer, iteration_kwargs.get('document_store'))) as p:
+        # The heartbeat thread is started once the workers are forked
+        queue.start_heartbeat()
+        try:
+            with tqdm(desc='Running simulations') as pbar:
+                while True:
+                    # Keep every process busy
+                    while len(in_flight) < args.num_processes:
+                        k = queue.claim()
+                        if k is None:
+                            break
+                        in_flight[k] = p.apply_async(
+                            run_iteration,
+                            kwds=dict(k=k, bias_query=bias_query, vector_loc=vector_loc, **iteration_kwargs))
+
+                    if len(in_flight) == 0 and (queue.stopped() or queue.remaining() == 0):
+                        break
+
+                    finished = [k for k, r in in_flight.items() if r.ready()]
+                    for k in finished:
+                        try:
+                            result = in_flight.pop(k).get()
+                        except Exception as e:
+                            attempts = queue.fail(task_id=k, error=repr(e))
+                            print(f'[WARNING] Iteration {k} failed (attempt {attempts} of {queue.max_attempts}): {e}')
+                            continue
+                        queue.complete(task_id=k, result={'k': k, **result})
+                        finished_count += 1
+                        pbar.update(1)
+
+                        # Checked every check_every iterations finished by this worker, as in main
+                        if (args.ci_width is not None or args.ci_change is not None) \
+                                and finished_count % args.check_every == 0:
+                            bias_scores = [r['score'] for r in queue.results().values()]
+                            if len(bias_scores) >= args.min_K:
+                                stop, previous_width = check_stopping_rule(
+                                    bias_scores=bias_scores, conf_level=args.conf_level, ci_width=args.ci_width,
+                                    ci_change=args.ci_change, previous_width=previous_width)
+                                if stop:
+                                    print(f'[INFO] Stopping after {len(bias_scores)} iterations: '
+                                          f'CI width {previous_width} at confidence level {args.conf_level}')
+                                    queue.request_stop()
+
+                    if len(finished) == 0:
+                        # Nothing finished: wait (tasks leased by other workers may still be recovered)
+                        time.sleep(1)
+            # Let the idle workers exit (leaving the pool context terminates them only on errors)
+            p.close()
+            p.join()
+        finally:
+            queue.stop_heartbeat()
+            for k in list(in_flight):
+                queue.release(task_id=k)
+
+    failures = queue.failures()
+    if len(failures) > 0:
+        print(f'[WARNING] {len(failures)} iterations failed {queue.max_attempts} times and were not run again: '
+              f'{sorted(failures)}')
 
 
 def main(args):
     # Set up White-Chu-Otherization bias query (using word lists from Garg et al.)
     query_name = 'PWTW-PC-OW'
-    bias_query = {
-        'TA': [
-            'harris', 'nelson', 'robinson', 'thompson', 'moore', 'wright', 'anderson', 'clark', 'jackson', 'taylor',
-            'scott',  'davis', 'allen', 'adams',  'lewis', 'williams', 'jones', 'wilson',  'martin', 'johnson'],
-        'TB': ['chu'],
-        'A': [
-            'devious', 'bizarre', 'venomous', 'erratic', 'barbaric', 'frightening', 'deceitful', 'forceful',
-            'deceptive', 'envious', 'greedy', 'hateful', 'contemptible', 'brutal',  'monstrous', 'calculating',
-            'cruel', 'intolerant', 'aggressive', 'monstrous']
-    }
-
-    # Set up 1920-1929 corpus
-    if not os.path.exists(f'{args.vector_dir}/coha_1920_1929_{args.corpus_type}ChuChu/vocab.txt'):
+    bias_query = bias_utils.BIAS_QUERIES[query_name]
+
+    # Additional queries and vector variants scored on every trained model
+    bias_queries = None
+    if args.queries is not None or args.queries_file is not None:
+        bias_queries = dict(bias_utils.BIAS_QUERIES)
+        if args.queries_file is not None:
+            with open(args.queries_file, 'r') as f:
+                bias_queries.update(json.load(f))
+        if args.queries is not None:
+            bias_queries = {name: bias_queries[name] for name in args.queries}
+    iteration_kwargs = dict(
+        trainer=args.trainer, workspace=args.workspace, bias_queries=bias_queries, variants=tuple(args.variants),
+        keep_vectors_dir=args.keep_vectors_dir, permutations=args.permutations, shuffle=args.shuffle)
+
+    # Document bootstrap results are kept apart from the (shuffle and initialization) bootstrap
+    run_name = args.corpus_type if args.bootstrap == 'shuffle' else f'{args.corpus_type}_documents'
+
+    # Set up 1920-1929 corpus. The run directory holds the workspaces and the document store of
+    # the run; it is also the corpus location, unless the corpus comes from the cache (whose
+    # entries are only read, as concurrent runs share them)
+    run_dir = f'{args.vector_dir}/coha_1920_1929_{args.corpus_type}ChuChu'
+    vector_loc = run_dir
+    if args.cache_dir is not None:
+        # Corpus keyed by its document list, so a changed list never reuses stale artifacts
+        docs = coha_utils.load_coha_docs_time_subset(
+            loc_dir=args.coha_metadata_loc, start_year=1920, end_year=1929)
+        if args.corpus_type == 'exc':
+            docs = [d for d in docs if d != '3526']
+        vector_loc = corpus_cache.get_or_build_subset(
+            documents=docs, cache_dir=args.cache_dir, individual_path=args.coha_individual_path,
+            name=f'coha_1920_1929_{args.corpus_type}ChuChu')
+    elif not os.path.exists(f'{vector_loc}/vocab.txt'):
         print(f'[INFO] Building 1920-1929 corpus {args.corpus_type}')
         docs = coha_utils.load_coha_docs_time_subset(
             loc_dir=args.coha_metadata_loc, start_year=1920, end_year=1929)
         if args.corpus_type == 'exc':
             # Remove Chu Chu
             docs = [d for d in docs if d != '3526']
-        out_path = f'{args.vector_dir}/coha_1920_1929_{args.corpus_type}ChuChu'
         generate_subset(
-            documents=docs, out_path=out_path, individual_path=args.coha_individual_path)
+            documents=docs, out_path=vector_loc, individual_path=args.coha_individual_path)
+
+    os.makedirs(run_dir, exist_ok=True)
+    iteration_kwargs['work_dir'] = run_dir
+    removed = workspace_utils.clean_stale_workspaces(vector_loc=run_dir)
+    if removed > 0:
+        print(f'[INFO] Removed {removed} stale bootstrap workspaces')
+
+    if args.bootstrap == 'documents':
+        # Per-document co-occurrences of the corpus, from which replicates are resampled (keyed
+        # by the cache entry whose vocabulary they use)
+        store_name = 'document_store' if args.cache_dir is None else f'document_store_{os.path.basename(vector_loc)}'
+        document_store = os.path.join(run_dir, store_name)
+        if not os.path.exists(document_store):
+            print(f'[INFO] Building document co-occurrence store for corpus {args.corpus_type}')
+            docs = coha_utils.load_coha_docs_time_subset(
+                loc_dir=args.coha_metadata_loc, start_year=1920, end_year=1929)
+            if args.corpus_type == 'exc':
+                docs = [d for d in docs if d != '3526']
+            doc_influence.build_document_store(
+                documents=docs, individual_path=args.coha_individual_path, vocab_file=f'{vector_loc}/vocab.txt',
+                store_dir=document_store, num_processes=args.num_processes)
+        iteration_kwargs['document_store'] = document_store
+
+    dict_outfile = os.path.join(args.output_dir, f'chuchu_dict_{run_name}.json')
+    if args.queue_dir is not None:
+        # Share iterations 0..K-1 with every other worker of the queue
+        queue = work_queue.WorkQueue(
+            queue_dir=os.path.join(args.queue_dir, run_name), lease_seconds=args.lease_seconds,
+            max_attempts=args.max_attempts)
+        queue.add_tasks(range(args.K))
+        print(f'[INFO] Running bootstrap for corpus {args.corpus_type} from queue {args.queue_dir}')
+        run_queue_worker(
+            args=args, queue=queue, bias_query=bias_query, vector_loc=vector_loc, iteration_kwargs=iteration_kwargs)
 
-    # Set up save location
-    dict_outfile = os.path.join(args.output_dir, f'chuchu_dict_{args.corpus_type}.json')
-    if os.path.exists(dict_outfile):
+        results = sorted(queue.results().values(), key=lambda r: r['k'])
+        simulation_dict = {args.corpus_type: [r['score'] for r in results]}
+        with open(f'{dict_outfile}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(simulation_dict, f)
+        os.replace(f'{dict_outfile}.{os.getpid()}.tmp', dict_outfile)
+        if args.results_store is not None:
+            results_store.append_results(
+                store_dir=args.results_store,
+                results=results_store.results_from_records(results=results, period='1920_1929', corpus=run_name))
+        return
+
+    # Set up save location: every finished iteration is appended to the results log, and the
+    # (legacy) results dict is rewritten from the log at the end
+    log_outfile = os.path.join(args.output_dir, f'chuchu_results_{run_name}.jsonl')
+    if not os.path.exists(log_outfile) and os.path.exists(dict_outfile):
         with open(dict_outfile, 'r') as f:
             simulation_dict = json.load(f)
-        K = args.K - len(simulation_dict[args.corpus_type])
-    else:
-        simulation_dict = {args.corpus_type: []}
-        K = args.K
+        for k, bias_score in enumerate(simulation_dict[args.corpus_type]):
+            append_result(log_outfile=log_outfile, k=k, result={'score': bias_score})
 
-    if len(simulation_dict[args.corpus_type]) >= args.K:
+    results = load_results(log_outfile=log_outfile)
+    K = args.K - len(results)
+    if K <= 0:
         return
     print(f'[INFO] Running bootstrap for corpus: {args.corpus_type}')
 
-    bias_scores = []
-    with Pool(processes=args.num_processes) as p:
-        for i, results in tqdm(
-                enumerate(
-                    p.imap_unordered(
-                        partial(
-                            run_iteration,
-                            bias_query=bias_query,
-                            vector_loc=f'{args.vector_dir}/coha_1920_1929_{args.corpus_type}ChuChu'
-                        ),
-                        list(range(K)),
-                        chunksize=1,
-                    )
-                ),
-                total=len(list(range(K))),
-                desc=f"Running simulations"
-        ):
-            bias_scores.append(results)
-
-    # Check again in case another thread has written more samples during training
-    if os.path.exists(dict_outfile):
-        with open(dict_outfile, 'r') as f:
-            simulation_dict_current = json.load(f)
-    else:
-        simulation_dict_current = {args.corpus_type: []}
-    simulation_dict_current[args.corpus_type].extend(bias_scores)
-    with open(dict_outfile, 'w') as f:
-        json.dump(simulation_dict_current, f)
+    # New iterations continue the numbering (and seeds) of finished ones
+    first_k = max([r['k'] for r in results], default=-1) + 1
+    bias_scores = [r['score'] for r in results]
+    previous_width = None
+
+    # Iterations are submitted one per free process, so that stopping early only waits for (and
+    # keeps) the running ones instead of terminating workers in the middle of an iteration
+    iterations = iter(range(first_k, first_k + K))
+    in_flight = {}
+    finished_count = 0
+    stop = False
+    with Pool(processes=args.num_processes, initializer=init_worker,
+              initargs=(vector_loc, args.trainer, iteration_kwargs.get('document_store'))) as p:
+        with tqdm(total=K, desc=f"Running simulations") as pbar:
+            while True:
+                while not stop and len(in_flight) < args.num_processes:
+                    k = next(iterations, None)
+                    if k is None:
+                        break
+                    in_flight[k] = p.apply_async(
+                        run_iteration,
+                        kwds=dict(k=k, bias_query=bias_query, vector_loc=vector_loc, **iteration_kwargs))
+                if len(in_flight) == 0:
+                    break
+
+                finished = [k for k, r in in_flight.items() if r.ready()]
+                if len(finished) == 0:
+                    next(iter(in_flight.values())).wait(timeout=1)
+                    continue
+
+                for k in finished:
+                    result = in_flight.pop(k).get()
+                    append_result(log_outfile=log_outfile, k=k, result=result)
+                    bias_scores.append(result['score'])
+                    finished_count += 1
+                    pbar.update(1)
+
+                    if not stop and (args.ci_width is not None or args.ci_change is not None) \
+                            and len(bias_scores) >= args.min_K and finished_count % args.check_every == 0:
+                        stop, previous_width = check_stopping_rule(
+                            bias_scores=bias_scores, conf_level=args.conf_level, ci_width=args.ci_width,
+                            ci_change=args.ci_change, previous_width=previous_width)
+                        if stop:
+                            print(f'[INFO] Stopping after {len(bias_scores)} iterations: '
+                                  f'CI width {previous_width} at confidence level {args.conf_level} '
+                                  f'(finishing {len(in_flight)} running iterations)')
+        p.close()
+        p.join()
+
+    write_results_dict(log_outfile=log_outfile, dict_outfile=dict_outfile, corpus_type=args.corpus_type)
+    if args.results_store is not None:
+        results_store.append_results(
+            store_dir=args.results_store,
+            results=results_store.results_from_log(log_file=log_outfile, period='1920_1929', corpus=run_name))
 
 
 if __name__ == '__main__':
@@ -149,11 +539,71 @@ if __name__ == '__main__':
     parser.add_argument('--coha_metadata_loc', required=True)
     parser.add_argument('--vector_dir', required=True)
     parser.add_argument('--output_dir', required=False)
+    parser.add_argument('--cache_dir', required=False,
+                        help='Content-addressed corpus cache (see corpus_cache), read instead of the corpus '
+                             'in vector_dir (which then only holds the workspaces and document store)')
     parser.add_argument('--corpus_type', type=str, required=True, choices=['inc', 'exc'])
+    parser.add_argument('--trainer', type=str, required=False, default='glove', choices=['glove', 'python'],
+                        help='Train with the GloVe binaries (run_glove_partial.sh) or in-process with glove_trainer')
+    parser.add_argument('--bootstrap', type=str, required=False, default='shuffle', choices=['shuffle', 'documents'],
+                        help='Vary only the GloVe shuffle and initialization, or also resample documents')
+    parser.add_argument('--workspace', type=str, required=False, default='hardlink',
+                        choices=list(workspace_utils.WORKSPACE_MODES),
+                        help='How iterations of the glove trainer access the shared co-occurrence file')
+    parser.add_argument('--shuffle', type=str, required=False, default='glove', choices=['glove', 'python'],
+                        help='Shuffle the co-occurrences of the glove trainer with GloVe\'s shuffle, or out of core '
+                             'with cooccur_utils (seeded by the iteration number)')
+
+    # Additional queries and vector variants
+    parser.add_argument('--queries', required=False, nargs='+',
+                        help='Names of additional bias queries to score (from bias_utils.BIAS_QUERIES or --queries_file)')
+    parser.add_argument('--queries_file', required=False,
+                        help='JSON file of additional bias queries by name (each with TA, TB and A word lists)')
+    parser.add_argument('--variants', required=False, nargs='+', default=['center'],
+                        choices=list(vector_utils.VECTOR_VARIANTS),
+                        help='Vector variants the additional queries are scored on')
+    parser.add_argument('--keep_vectors_dir', required=False,
+                        help='Save every trained model as float16 matrices, to score new queries later')
+    parser.add_argument('--permutations', required=False, type=int,
+                        help='Permutation test of the main score of every model with this many permutations')
+    parser.add_argument('--results_store', required=False,
+                        help='Also add the results to this results_store directory, for analysis across runs')
+
+    # Optional early stopping (the bootstrap still runs at most K iterations)
+    parser.add_argument('--ci_width', required=False, type=float,
+                        help='Stop once the confidence interval is narrower than this')
+    parser.add_argument('--ci_change', required=False, type=float,
+                        help='Stop once the confidence interval width changes less than this between checks')
+    parser.add_argument('--conf_level', required=False, type=float, default=0.95)
+    parser.add_argument('--min_K', required=False, type=int, default=20,
+                        help='Minimum number of iterations before stopping early')
+    parser.add_argument('--queue_dir', required=False,
+                        help='Shared directory of a work queue, to run the bootstrap over several invocations/machines')
+    parser.add_argument('--lease_seconds', required=False, type=float, default=600,
+                        help='Time after which an iteration claimed by an unresponsive worker is run again')
+    parser.add_argument('--max_attempts', required=False, type=int, default=3,
+                        help='Number of failures after which a queued iteration is no longer run')
+    parser.add_argument('--trace_file', required=False,
+                        help='Record wall/CPU time, peak RSS and I/O of every stage of every iteration to this JSONL file')
+    parser.add_argument('--chrome_trace', required=False,
+                        help='Also write the stages of the run in Chrome trace format (with --trace_file)')
+    parser.add_argument('--check_every', required=False, type=int, default=10,
+                        help='Number of iterations between checks of the stopping rule')
 
     args = parser.parse_args()
 
     args.output_dir = str(file_utils.get_root_path() / 'outputs' / 'ChuChu')
     os.makedirs(args.output_dir, exist_ok=True)
 
-    main(args)
+    if args.trace_file is not None:
+        # Enabled before any pool is created, so that every worker records its stages
+        run_id = trace_utils.enable(trace_file=args.trace_file)
+        with trace_utils.stage('main', corpus_type=args.corpus_type):
+            main(args)
+        print(f'[INFO] Stages of run {run_id} (from {args.trace_file}):')
+        trace_utils.print_summary(trace_file=args.trace_file, run_id=run_id)
+        if args.chrome_trace is not None:
+            trace_utils.write_chrome_trace(
+                events=trace_utils.load_trace(trace_file=args.trace_file, run_id=run_id), out_file=args.chrome_trace)
+    else:
+        main(args)
@@ -2,50 +2,15 @@
 Generates Figure 1, in which we compare Chu bias scores including and excluding
 the document Chu Chu by Francis Bret Harte in COHA 1920-1930.
 """
-from typing import Dict, List
 import pandas as pd
 import json
 import matplotlib.pyplot as plt
 import numpy as np
 
 import file_utils
-
-
-def parse_bootstrap_output(
-        bootstrap_stats: List[float],
-        conf_level: float = 0.95
-) -> Dict[str, List[float]]:
-    assert conf_level < 1, '[ERROR] Confidence level must be between 0 and 1'
-
-    if len(bootstrap_stats) == 0:
-        bootstrap_dict = {
-            'mean': 0,
-            'median': 0,
-            'variance': 0,
-            'sd': 0,
-            'lower': 0,
-            'upper': 0,
-            'counts': []
-        }
-    else:
-        bootstrap_stats = np.sort(bootstrap_stats)
-        bounds = np.nanpercentile(
-            a=bootstrap_stats,
-            q=(
-                (1 - conf_level) / 2 * 100,
-                (conf_level + (1 - conf_level) / 2) * 100
-            )
-        )
-        bootstrap_dict = {
-            'mean': np.mean(bootstrap_stats),
-            'median': np.median(bootstrap_stats),
-            'variance': np.var(bootstrap_stats),
-            'sd': np.std(bootstrap_stats),
-            'lower': bounds[0],
-            'upper': bounds[1],
-            'counts': bootstrap_stats
-        }
-    return bootstrap_dict
+import results_store
+# parse_bootstrap_output moved to bootstrap_utils (which does not load matplotlib), still importable from here
+from bootstrap_utils import parse_bootstrap_output  # noqa: F401
 
 
 def main():
@@ -63,12 +28,12 @@ def main():
         simulation_dict[corpus_type] = [l for l in simulation_dict[corpus_type] if l is not None]
 
     conf_level = 0.95
-    sim_df = pd.DataFrame()
-    for corpus, corpus_stats in simulation_dict.items():
-        parsed_stats = parse_bootstrap_output(bootstrap_stats=corpus_stats, conf_level=conf_level)
-        parsed_stats['corpus'] = corpus
-        parsed_stats = {k: [v] for k, v in parsed_stats.items()}
-        sim_df = pd.concat([sim_df, pd.DataFrame.from_dict(parsed_stats)])
+    # One summary row per corpus (see results_store for many queries and periods)
+    sim_df = results_store.summarize(
+        results=pd.DataFrame(
+            [(corpus, score) for corpus, corpus_stats in simulation_dict.items() for score in corpus_stats],
+            columns=['corpus', 'score']),
+        conf_level=conf_level, group_by=['corpus'])
 
     sim_df['corpus'] = sim_df['corpus'].map(
         {'inc': 'COHA 1920s\nincluding\n"Chu Chu"', 'exc': 'COHA 1920s\nexcluding\n"Chu Chu"'})
@@ -0,0 +1,239 @@
+"""
+Benchmarks the pipeline on synthetic COHA corpora (see synthetic_coha) of several sizes: time
+and peak memory of the metadata loaders, corpus generation, document concentration, vector
+loading, bias scoring and one bootstrap iteration. Results can be saved as a baseline, and
+later runs are compared against it to catch regressions.
+
+Peak memory is measured with tracemalloc, so it covers allocations of this process (including
+numpy arrays) but not of worker processes.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+
+import bias_utils
+import coha_utils
+import doc_concentration
+import file_utils
+import synthetic_coha
+import vector_utils
+from setup import generate_subset
+
+# Number of synthetic documents of each corpus scale
+SCALES = {'small': 1000, 'medium': 10000, 'large': 100000}
+
+# Period used for the subset, document concentration and bootstrap benchmarks
+START_YEAR = 1920
+END_YEAR = 1929
+
+# In-process GloVe parameters of the bootstrap iteration benchmark (kept small, as only the
+# relative change across runs matters)
+TRAINER_KWARGS = {'vector_size': 50, 'max_iter': 5}
+
+# Dimension of the synthetic vectors.txt read by load_fulltxt_vectors
+VECTOR_SIZE = 300
+
+
+def measure(function: Callable, repeat: int = 3) -> Dict[str, float]:
+    """
+    Runs function repeat times for timing, then once more with tracemalloc (which slows down
+    Python code) for the peak memory.
+    :return: (dict) with the median wall and CPU time (seconds) and the peak traced memory (MB)
+    """
+    seconds, cpu_seconds = [], []
+    for _ in range(repeat):
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        function()
+        seconds.append(time.perf_counter() - start_time)
+        cpu_seconds.append(time.process_time() - start_cpu)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': statistics.median(seconds), 'cpu_seconds': statistics.median(cpu_seconds),
+            'peak_mb': peak / 1e6}
+
+
+def write_synthetic_vectors(vocab_file: str, vectors_file: str, vector_size: int = VECTOR_SIZE, seed: int = 0):
+    # Random parameters in the BINARY=0, MODEL=0 text format: word, w, b_w, u, b_u
+    rng = np.random.default_rng(seed)
+    words = vector_utils.load_vocab_words(vocab_file=vocab_file)
+    with open(vectors_file, 'w') as f:
+        for word in words:
+            f.write(word + ' ' + ' '.join(f'{x:.6f}' for x in rng.normal(size=2 * vector_size + 2)) + '\n')
+
+
+def run_scale(scale: str, work_dir: str, repeat: int = 3, num_processes: int = 4) -> Dict[str, Dict[str, float]]:
+    """
+    Runs all benchmarks on the synthetic corpus of one scale. The corpus is generated once in
+    {work_dir}/{scale} and reused by later runs.
+    :param scale: (str) one of SCALES
+    :param work_dir: directory of the synthetic corpora
+    :param repeat: number of runs of each benchmark
+    :param num_processes:
+    :return: (dict) of measurements by benchmark name
+    """
+    corpus_dir = os.path.join(work_dir, scale, 'corpus')
+    individual_path = os.path.join(corpus_dir, 'individual_texts')
+    if not os.path.exists(os.path.join(corpus_dir, 'coha_document_metadata.json')):
+        print(f'[INFO] Generating the {scale} synthetic corpus')
+        synthetic_coha.generate_synthetic_coha(out_dir=corpus_dir, num_documents=SCALES[scale])
+
+    subset_dir = os.path.join(work_dir, scale, f'coha_{START_YEAR}_{END_YEAR}')
+    index_dir = os.path.join(work_dir, scale, 'doc_term_index')
+    documents = coha_utils.load_coha_docs_time_subset(loc_dir=corpus_dir, start_year=START_YEAR, end_year=END_YEAR)
+
+    def build_index_cold():
+        coha_utils._metadata_indexes.clear()
+        coha_utils.build_metadata_index(loc_dir=corpus_dir)
+
+    def subset():
+        shutil.rmtree(subset_dir, ignore_errors=True)
+        os.makedirs(subset_dir)
+        generate_subset(documents=documents, out_path=subset_dir, individual_path=individual_path,
+                        individual_mode='skip', cooccur_backend='python', num_processes=num_processes)
+
+    def concentration():
+        shutil.rmtree(index_dir, ignore_errors=True)
+        doc_concentration.build_doc_term_index(
+            individual_path=individual_path, metadata_loc=corpus_dir, index_dir=index_dir,
+            num_processes=num_processes)
+        index = doc_concentration.load_doc_term_index(index_dir=index_dir)
+        doc_concentration.term_document_stats(
+            index=index, start_year=START_YEAR, end_year=END_YEAR,
+            words=vector_utils.load_vocab_words(vocab_file=os.path.join(subset_dir, 'vocab.txt')))
+
+    bias_query = bias_utils.BIAS_QUERIES['PWTW-PC-OW']
+    vectors_file = os.path.join(work_dir, scale, 'vectors.txt')
+    loaded = {}
+
+    def load_vectors():
+        loaded['parameter_dict'], _, loaded['center_vectors'] = vector_utils.load_fulltxt_vectors(
+            vectors_file=vectors_file)
+
+    def score():
+        utils_dict = bias_utils.assemble_vectors(
+            vectors=loaded['center_vectors'], bias_query=bias_query, pre_normalize=False, post_normalize=False)
+        bias_utils.compute_bias_score(utils_dict=utils_dict, function='cosine')
+
+    def score_batched():
+        # Query words of 100 models, as scored across the iterations of a bootstrap (see ChuChu.score_model)
+        words = {w for word_set in bias_query.values() for w in word_set}
+        vocab = [w for w in loaded['parameter_dict']['vocab'] if w in words]
+        rows = [loaded['parameter_dict']['vocab'].index(w) for w in vocab]
+        bias_utils.compute_bias_scores_batched(
+            embeddings=np.stack([loaded['parameter_dict']['W'][rows]] * 100), vocab=vocab,
+            bias_queries=list(bias_utils.BIAS_QUERIES.values()))
+
+    def iteration():
+        # Imported here, as ChuChu sets up its own worker state
+        import ChuChu
+        ChuChu._worker_data.clear()
+        ChuChu.run_iteration(k=0, vector_loc=subset_dir, bias_query=bias_query, trainer='python',
+                             trainer_kwargs=TRAINER_KWARGS)
+
+    benchmarks: List[Tuple[str, Callable]] = [
+        ('coha_utils.load_coha_metadata', lambda: coha_utils.load_coha_metadata(loc_dir=corpus_dir)),
+        ('coha_utils.build_metadata_index', build_index_cold),
+        ('coha_utils.load_coha_docs_time_subset', lambda: coha_utils.load_coha_docs_time_subset(
+            loc_dir=corpus_dir, start_year=START_YEAR, end_year=END_YEAR)),
+        ('coha_utils.load_coha_period_docs', lambda: coha_utils.load_coha_period_docs(
+            start_year=START_YEAR, end_year=END_YEAR, individual_path=individual_path, metadata_path=corpus_dir)),
+        ('setup.generate_subset', subset),
+        ('doc_concentration.term_document_stats', concentration),
+        ('vector_utils.load_fulltxt_vectors', load_vectors),
+        ('vector_utils.Vectors.load_txt', lambda: vector_utils.Vectors.load_txt(vectors_file=vectors_file)),
+        ('vector_utils.load_selected_vectors', lambda: vector_utils.load_selected_vectors(
+            vectors_file=vectors_file, words=[w for word_set in bias_query.values() for w in word_set])),
+        ('bias_utils.compute_bias_score', score),
+        ('bias_utils.compute_bias_scores_batched', score_batched),
+        ('ChuChu.run_iteration', iteration),
+    ]
+
+    results = {}
+    for name, function in benchmarks:
+        if name == 'vector_utils.load_fulltxt_vectors' and not os.path.exists(vectors_file):
+            write_synthetic_vectors(vocab_file=os.path.join(subset_dir, 'vocab.txt'), vectors_file=vectors_file)
+        results[name] = measure(function=function, repeat=repeat)
+        print(f'[INFO] {scale:>6} {name:<42} {results[name]["seconds"]:9.3f} s '
+              f'{results[name]["peak_mb"]:9.1f} MB')
+    return results
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, tolerance: float = 0.25,
+                        min_seconds: float = 0.05) -> List[str]:
+    """
+    Compares benchmark results with a baseline of the same format.
+    :param results: (dict) of measurements by scale and benchmark name
+    :param baseline: (dict) of measurements by scale and benchmark name
+    :param tolerance: relative increase of time or peak memory reported as a regression
+    :param min_seconds: time differences smaller than this are ignored (timer noise)
+    :return: (list) of regression descriptions
+    """
+    regressions = []
+    for scale, scale_results in results.items():
+        for name, measurement in scale_results.items():
+            reference = baseline.get(scale, {}).get(name)
+            if reference is None:
+                continue
+            if measurement['seconds'] - reference['seconds'] > max(tolerance * reference['seconds'], min_seconds):
+                regressions.append(f'{scale} {name}: {measurement["seconds"]:.3f} s '
+                                   f'(baseline {reference["seconds"]:.3f} s)')
+            if measurement['peak_mb'] > (1 + tolerance) * reference['peak_mb'] + 1:
+                regressions.append(f'{scale} {name}: {measurement["peak_mb"]:.1f} MB '
+                                   f'(baseline {reference["peak_mb"]:.1f} MB)')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', required=False, nargs='+', default=['small'], choices=list(SCALES.keys()))
+    parser.add_argument('--work_dir', required=False,
+                        help='Directory of the synthetic corpora, reused across runs (temporary if not given)')
+    parser.add_argument('--repeat', required=False, type=int, default=3)
+    parser.add_argument('--num_processes', required=False, type=int, default=4)
+    parser.add_argument('--out_file', required=False, help='JSON file of the results')
+    parser.add_argument('--baseline', required=False,
+                        default=f'{str(file_utils.get_root_path())}/outputs/benchmarks/baseline.json')
+    parser.add_argument('--save_baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--tolerance', required=False, type=float, default=0.25,
+                        help='Relative slowdown or memory increase reported as a regression')
+
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='coha_benchmark_')
+    results = {scale: run_scale(scale=scale, work_dir=work_dir, repeat=args.repeat, num_processes=args.num_processes)
+               for scale in args.scales}
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {'python': sys.version.split()[0], 'platform': platform.platform(), 'results': results}
+    if args.out_file is not None:
+        with open(args.out_file, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'[INFO] Saved baseline to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results=results, baseline=baseline['results'], tolerance=args.tolerance)
+        for regression in regressions:
+            print(f'[WARNING] Regression: {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f'[INFO] No regressions against {args.baseline}')
@@ -1,18 +1,44 @@
+import itertools
+import math
 import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
+import vector_utils
 
-def assemble_vectors(vectors: dict, bias_query: dict, pre_normalize: bool,
+# Bias queries by name (using word lists from Garg et al.)
+BIAS_QUERIES = {
+    # White-Chu-Otherization
+    'PWTW-PC-OW': {
+        'TA': [
+            'harris', 'nelson', 'robinson', 'thompson', 'moore', 'wright', 'anderson', 'clark', 'jackson', 'taylor',
+            'scott',  'davis', 'allen', 'adams',  'lewis', 'williams', 'jones', 'wilson',  'martin', 'johnson'],
+        'TB': ['chu'],
+        'A': [
+            'devious', 'bizarre', 'venomous', 'erratic', 'barbaric', 'frightening', 'deceitful', 'forceful',
+            'deceptive', 'envious', 'greedy', 'hateful', 'contemptible', 'brutal',  'monstrous', 'calculating',
+            'cruel', 'intolerant', 'aggressive', 'monstrous']
+    }
+}
+
+# Quantiles of the permutation null distribution reported by permutation_test
+NULL_QUANTILES = (0.025, 0.05, 0.5, 0.95, 0.975)
+
+# Number of permutations scored at a time
+PERMUTATION_BATCH = 4096
+
+
+def assemble_vectors(vectors: Union[dict, vector_utils.VectorView], bias_query: dict, pre_normalize: bool,
                      post_normalize: bool = True) -> dict:
     """
 
-    :param vectors: (dict) of unnormalized GloVe vectors
+    :param vectors: (dict) of unnormalized GloVe vectors, or a vector_utils.VectorView
     :param bias_query: (dict) of word lists for each part of the bias query (Targets, Attributes)
     :param pre_normalize: (bool) whether to normalize the attribute vectors
     :param post_normalize: (bool) whether to normalize the surname means
     :return: (dict of np.arrays) All vectors are shape (x, d)
     """
     # Get dimensionality
-    d = len(vectors[list(vectors.keys())[0]])
+    d = len(vectors[next(iter(vectors.keys()))])
 
     bias_score_utils = {}
 
@@ -21,7 +47,7 @@ def assemble_vectors(vectors: dict, bias_query: dict, pre_normalize: bool,
     for word_set in bias_query.keys():
         size = 0
         for w in bias_query[word_set]:
-            if w in vectors.keys():
+            if w in vectors:
                 size += 1
         sizes[word_set] = size
 
@@ -34,7 +60,7 @@ def assemble_vectors(vectors: dict, bias_query: dict, pre_normalize: bool,
     for word_set in bias_query.keys():
         i = 0
         for w in bias_query[word_set]:
-            if w in vectors.keys():
+            if w in vectors:
                 bias_score_utils[word_set][i, :] = vectors[w]
                 bias_score_utils[f'{word_set}_list'].append(w)
                 i += 1
@@ -83,3 +109,182 @@ def compute_bias_score(utils_dict: dict, function: str) -> float:
 
     return score
 
+
+def index_bias_queries(vocab: Union[Dict[str, int], Sequence[str]],
+                       bias_queries: List[dict]) -> Tuple[np.array, List[Dict[str, np.array]]]:
+    """
+    Resolves the words of several bias queries against a vocabulary once.
+    :param vocab: (dict) word-to-row index, or (list) of words in row order
+    :param bias_queries: (list of dict) of word lists for each part of the bias query (TA, TB, A)
+    :return: (np.array) of the unique vocabulary rows used by any query, and for each query
+    a dict mapping each word set to positions into that array (out of vocabulary words dropped)
+    """
+    if not isinstance(vocab, dict):
+        vocab = {w: i for i, w in enumerate(vocab)}
+
+    rows = {}
+    query_positions = []
+    for bias_query in bias_queries:
+        positions = {}
+        for word_set in ('TA', 'TB', 'A'):
+            word_rows = [vocab[w] for w in bias_query[word_set] if w in vocab]
+            positions[word_set] = np.array(
+                [rows.setdefault(r, len(rows)) for r in word_rows], dtype=np.int64)
+        query_positions.append(positions)
+
+    unique_rows = np.array(list(rows.keys()), dtype=np.int64)
+    return unique_rows, query_positions
+
+
+def _gather_rows(embeddings: Union[np.array, vector_utils.VectorView], rows: np.array) -> np.array:
+    if isinstance(embeddings, vector_utils.VectorView):
+        return embeddings.rows(rows=rows)
+    return np.asarray(embeddings[rows], dtype=np.float64)
+
+
+def compute_bias_scores_batched(embeddings: Union[np.array, List[np.array], vector_utils.VectorView,
+                                                  List[vector_utils.VectorView]],
+                                vocab: Optional[Union[Dict[str, int], Sequence[str]]],
+                                bias_queries: List[dict]) -> np.array:
+    """
+    Computes the cosine bias score of compute_bias_score for Q bias queries against K
+    embedding matrices sharing one vocabulary. Word lookups happen once for all queries and
+    the cosine work is done as batched matmuls over the K models.
+
+    The score mean_i cos(vi, MB) - mean_i cos(vi, MA) is invariant to the pre_normalize and
+    post_normalize options of assemble_vectors, so there are no such options here.
+    :param embeddings: (np.array) of shape (K, V, d) or (V, d), or a list of K (V, d) matrices, or
+    one or a list of K vector_utils.VectorViews
+    :param vocab: (dict) word-to-row index, or (list) of words in row order; may be None for VectorViews
+    :param bias_queries: (list of dict) of word lists for each part of the bias query (TA, TB, A)
+    :return: (np.array) of shape (K, Q); nan where a word set has no vocabulary words
+    """
+    if isinstance(embeddings, vector_utils.VectorView) or (isinstance(embeddings, np.ndarray) and embeddings.ndim == 2):
+        embeddings = [embeddings]
+    if vocab is None:
+        vocab = embeddings[0].word_idx
+    unique_rows, query_positions = index_bias_queries(vocab=vocab, bias_queries=bias_queries)
+
+    # Gather only the query rows of each model: (K, n, d)
+    X = np.stack([_gather_rows(embeddings=E, rows=unique_rows) for E in embeddings])
+    K, n, _ = X.shape
+    Q = len(bias_queries)
+
+    # Row-normalize once
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X /= np.linalg.norm(X, axis=2, keepdims=True)
+
+    # Averaging operators (Q, n) for each word set, so that P @ X gives per-query means
+    P = {}
+    empty = np.zeros(Q, dtype=bool)
+    for word_set in ('TA', 'TB', 'A'):
+        P[word_set] = np.zeros((Q, n))
+        for q, positions in enumerate(query_positions):
+            idx = positions[word_set]
+            if len(idx) == 0:
+                empty[q] = True
+                continue
+            np.add.at(P[word_set][q], idx, 1.0 / len(idx))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Mean target vectors (K, Q, d), normalized since only their direction matters
+        MA = np.matmul(P['TA'], X)
+        MB = np.matmul(P['TB'], X)
+        MA /= np.linalg.norm(MA, axis=2, keepdims=True)
+        MB /= np.linalg.norm(MB, axis=2, keepdims=True)
+
+        # Cosines of every query word with every query's means (K, n, Q), then averaged over A
+        cA = np.einsum('qn,knq->kq', P['A'], np.matmul(X, MA.transpose(0, 2, 1)))
+        cB = np.einsum('qn,knq->kq', P['A'], np.matmul(X, MB.transpose(0, 2, 1)))
+
+    scores = cB - cA
+    scores[:, empty] = np.nan
+    return scores
+
+
+def _permutation_scores(c: np.array, G: np.array, memberships: np.array) -> np.array:
+    # Scores of (N, P) boolean TB memberships of the target pool, as compute_bias_score: since
+    # cos(a, M) only depends on the direction of the mean M of the member vectors,
+    # mean_a cos(a, M) = (c @ m) / sqrt(m @ G @ m) with c the mean cosines of A with the pool
+    memberships = memberships.astype(np.float64)
+    others = 1.0 - memberships
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cB = (memberships @ c) / np.sqrt(np.einsum('np,np->n', memberships @ G, memberships))
+        cA = (others @ c) / np.sqrt(np.einsum('np,np->n', others @ G, others))
+    return cB - cA
+
+
+def permutation_test(embeddings: Union[np.array, vector_utils.VectorView],
+                     vocab: Optional[Union[Dict[str, int], Sequence[str]]], bias_query: dict,
+                     n_permutations: int = 10000, seed: int = 0,
+                     quantiles: Sequence[float] = NULL_QUANTILES) -> Optional[Dict]:
+    """
+    WEAT-style permutation test of the cosine bias score of compute_bias_score: the TA and TB
+    targets are pooled and repartitioned (keeping the set sizes), and the observed score is
+    compared with the scores of the repartitions. The attribute-to-pool cosines and the Gram
+    matrix of the pool are computed once, so every permutation only costs a few dot products
+    of its membership vector, and permutations are scored in batches.
+
+    When the pool has at most n_permutations partitions (e.g. the 21 of a one-word TB set with
+    20 surnames) all of them are enumerated and the test is exact.
+    :param embeddings: (np.array) of shape (V, d), or a vector_utils.VectorView
+    :param vocab: (dict) word-to-row index, or (list) of words in row order; may be None for a VectorView
+    :param bias_query: (dict) of word lists for each part of the bias query (TA, TB, A)
+    :param n_permutations: number of random permutations
+    :param seed: seed of the random permutations
+    :param quantiles: quantiles of the null distribution to report
+    :return: (dict) with the score, one-sided (score larger than by chance) and two-sided
+    p-values, the null mean, sd and quantiles; None if a word set has no vocabulary words
+    """
+    if vocab is None:
+        vocab = embeddings.word_idx
+    unique_rows, (positions,) = index_bias_queries(vocab=vocab, bias_queries=[bias_query])
+    if any(len(positions[word_set]) == 0 for word_set in ('TA', 'TB', 'A')):
+        return None
+
+    X = _gather_rows(embeddings=embeddings, rows=unique_rows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X /= np.linalg.norm(X, axis=1, keepdims=True)
+    pool = X[np.concatenate([positions['TA'], positions['TB']])]
+    n_a, n_b = len(positions['TA']), len(positions['TB'])
+    P = n_a + n_b
+
+    c = (X[positions['A']] @ pool.T).mean(axis=0)
+    G = pool @ pool.T
+
+    observed = np.zeros((1, P), dtype=bool)
+    observed[0, n_a:] = True
+    score = float(_permutation_scores(c=c, G=G, memberships=observed)[0])
+
+    exact = math.comb(P, n_b) <= n_permutations
+    if exact:
+        combinations = np.array(list(itertools.combinations(range(P), n_b)), dtype=np.int64)
+        memberships = np.zeros((len(combinations), P), dtype=bool)
+        np.put_along_axis(memberships, combinations, True, axis=1)
+        null = _permutation_scores(c=c, G=G, memberships=memberships)
+    else:
+        rng = np.random.default_rng(seed)
+        null = np.zeros(n_permutations)
+        for start in range(0, n_permutations, PERMUTATION_BATCH):
+            n = min(PERMUTATION_BATCH, n_permutations - start)
+            # The first n_b positions of a random order of the pool form TB
+            order = np.argsort(rng.random((n, P)), axis=1)
+            memberships = np.zeros((n, P), dtype=bool)
+            np.put_along_axis(memberships, order[:, :n_b], True, axis=1)
+            null[start:start + n] = _permutation_scores(c=c, G=G, memberships=memberships)
+
+    # Tolerance for permutations scoring the same as the observed partition
+    tolerance = 1e-12 * max(1.0, abs(score))
+    greater = int(np.sum(null >= score - tolerance))
+    extreme = int(np.sum(np.abs(null - null.mean()) >= abs(score - null.mean()) - tolerance))
+    if exact:
+        # The observed partition is one of the enumerated ones
+        p_value, p_value_two_sided = greater / len(null), extreme / len(null)
+    else:
+        p_value, p_value_two_sided = (greater + 1) / (len(null) + 1), (extreme + 1) / (len(null) + 1)
+
+    return {
+        'score': score, 'p_value': p_value, 'p_value_two_sided': p_value_two_sided,
+        'n_permutations': len(null), 'exact': exact,
+        'null_mean': float(null.mean()), 'null_sd': float(null.std(ddof=1)) if len(null) > 1 else float('nan'),
+        'null_quantiles': {str(q): float(v) for q, v in zip(quantiles, np.quantile(null, quantiles))}}
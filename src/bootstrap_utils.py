@@ -0,0 +1,42 @@
+"""
+Summary statistics of bootstrap scores, without plotting dependencies, so that the bootstrap
+workers (ChuChu) can check intervals without loading matplotlib
+"""
+from typing import Dict, List
+import numpy as np
+
+
+def parse_bootstrap_output(
+        bootstrap_stats: List[float],
+        conf_level: float = 0.95
+) -> Dict[str, List[float]]:
+    assert conf_level < 1, '[ERROR] Confidence level must be between 0 and 1'
+
+    if len(bootstrap_stats) == 0:
+        bootstrap_dict = {
+            'mean': 0,
+            'median': 0,
+            'variance': 0,
+            'sd': 0,
+            'lower': 0,
+            'upper': 0,
+            'counts': []
+        }
+    else:
+        bounds = np.nanpercentile(
+            a=bootstrap_stats,
+            q=(
+                (1 - conf_level) / 2 * 100,
+                (conf_level + (1 - conf_level) / 2) * 100
+            )
+        )
+        bootstrap_dict = {
+            'mean': np.mean(bootstrap_stats),
+            'median': np.median(bootstrap_stats),
+            'variance': np.var(bootstrap_stats),
+            'sd': np.std(bootstrap_stats),
+            'lower': bounds[0],
+            'upper': bounds[1],
+            'counts': np.sort(bootstrap_stats)
+        }
+    return bootstrap_dict
@@ -1,8 +1,16 @@
-from typing import List
+from typing import Dict, Iterable, List, Optional
 import glob
 import json
+import os
+import numpy as np
 import pandas as pd
 
+# Columnar cache of the metadata index, written next to coha_document_metadata.json
+METADATA_CACHE_FILE = 'coha_document_metadata.index.npz'
+
+# Metadata indexes loaded in this process, by metadata location
+_metadata_indexes = {}
+
 
 def load_coha_period_docs(
         start_year: int, end_year: int, individual_path: str, metadata_path: str) -> List[str]:
@@ -18,12 +26,7 @@ def load_coha_period_docs(
     all_docs = glob.glob(f'{individual_path}/*.txt')
 
     # Get decade document subset
-    doc_metadata = load_coha_metadata(loc_dir=metadata_path)
-
-    # Subset
-    run_years = list(range(start_year, end_year + 1))
-    decade_metadata = doc_metadata.loc[doc_metadata['year'].astype(int).isin(run_years)].copy()
-    decade_idxs = decade_metadata.index.tolist()
+    decade_idxs = set(load_coha_docs_time_subset(loc_dir=metadata_path, start_year=start_year, end_year=end_year))
 
     decade_docs = [doc for doc in all_docs if doc.split('/')[-1].replace('coha_', '').replace('.txt', '') in decade_idxs]
 
@@ -45,18 +48,104 @@ def load_coha_docs_time_subset(loc_dir: str, start_year: int, end_year: int) ->
     :param end_year: inclusive
     :return:
     """
-    # Ensure we have ints for the years
-    start_year = int(start_year)
-    end_year = int(end_year)
+    index = load_metadata_index(loc_dir=loc_dir)
+    return query_metadata_index(index=index, start_year=int(start_year), end_year=int(end_year))
+
 
-    # Load COHA metadata
+def _source_signature(loc_dir: str) -> np.array:
+    stat = os.stat(f'{loc_dir}/coha_document_metadata.json')
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def build_metadata_index(loc_dir: str) -> Dict[str, np.array]:
+    """
+    Builds a columnar index of the COHA metadata and caches it next to the metadata JSON.
+    Documents are sorted by year, with the offsets of each year precomputed.
+    :param loc_dir: Location of the metadata JSON
+    :return: (dict) of index arrays
+    """
+    signature = _source_signature(loc_dir=loc_dir)
     metadata = load_coha_metadata(loc_dir=loc_dir)
 
-    # Subset to time period
-    subset_doc_df = metadata.copy()
-    subset_doc_df = subset_doc_df.loc[subset_doc_df['year'].isin(range(start_year, end_year + 1))]
-    subset_doc_df['doc_id'] = subset_doc_df.index
-    return list(subset_doc_df['doc_id'].unique())
+    years = metadata['year'].astype(int).to_numpy()
+    genres = metadata['genre'].astype(str).to_numpy() if 'genre' in metadata else np.full(len(metadata), '')
+    genre_names, genre_codes = np.unique(genres.astype(str), return_inverse=True)
+
+    # Stable sort keeps the JSON order within a year
+    order = np.argsort(years, kind='stable')
+    year_values, year_starts = np.unique(years[order], return_index=True)
+
+    index = {
+        'doc_ids': metadata.index.to_numpy().astype(str)[order],
+        'years': years[order].astype(np.int32),
+        'genre_codes': genre_codes[order].astype(np.int32),
+        'genre_names': genre_names,
+        'positions': order.astype(np.int64),
+        'year_values': year_values.astype(np.int32),
+        'year_offsets': np.append(year_starts, len(order)).astype(np.int64),
+        'source_signature': signature}
+
+    # Write atomically, as several processes may load the index at the same time
+    cache_file = f'{loc_dir}/{METADATA_CACHE_FILE}'
+    with open(f'{cache_file}.{os.getpid()}.tmp', 'wb') as f:
+        np.savez(f, **index)
+    os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+    return index
+
+
+def load_metadata_index(loc_dir: str) -> Dict[str, np.array]:
+    """
+    Returns the columnar metadata index, from memory or from the cache file. The index is
+    rebuilt when coha_document_metadata.json changes (size or modification time).
+    :param loc_dir: Location of the metadata JSON
+    :return: (dict) of index arrays
+    """
+    signature = _source_signature(loc_dir=loc_dir)
+    index = _metadata_indexes.get(loc_dir)
+
+    if index is None or not np.array_equal(index['source_signature'], signature):
+        index = None
+        cache_file = f'{loc_dir}/{METADATA_CACHE_FILE}'
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as npz:
+                if np.array_equal(npz['source_signature'], signature):
+                    index = {k: npz[k] for k in npz.files}
+        if index is None:
+            index = build_metadata_index(loc_dir=loc_dir)
+        _metadata_indexes[loc_dir] = index
+
+    return index
+
+
+def query_metadata_index(index: Dict[str, np.array], start_year: Optional[int] = None, end_year: Optional[int] = None,
+                         genres: Optional[Iterable[str]] = None, exclude: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    Returns document ids of the metadata index within a year range (inclusive), restricted to
+    some genres and excluding some documents. Ids are returned in the order of the metadata JSON.
+    :param index: (dict) as returned by load_metadata_index
+    :param start_year: first year, unbounded if None
+    :param end_year: last year (inclusive), unbounded if None
+    :param genres: (iterable of str) genres to keep, all if None
+    :param exclude: (iterable of str) document ids to leave out
+    :return:
+    """
+    lo = 0 if start_year is None else index['year_offsets'][np.searchsorted(index['year_values'], start_year, 'left')]
+    hi = len(index['doc_ids']) if end_year is None else \
+        index['year_offsets'][np.searchsorted(index['year_values'], end_year, 'right')]
+    if hi <= lo:
+        # Empty range (e.g. start_year after end_year)
+        return []
+
+    keep = np.ones(hi - lo, dtype=bool)
+    if genres is not None:
+        genre_codes = np.flatnonzero(np.isin(index['genre_names'], list(genres)))
+        keep &= np.isin(index['genre_codes'][lo:hi], genre_codes)
+    if exclude is not None:
+        keep &= ~np.isin(index['doc_ids'][lo:hi], np.array(list(exclude), dtype=str))
+
+    doc_ids = index['doc_ids'][lo:hi][keep]
+    positions = index['positions'][lo:hi][keep]
+    return doc_ids[np.argsort(positions)].tolist()
 
 
 def load_coha_docs_1900_1912(loc_dir: str) -> List[str]:
@@ -0,0 +1,206 @@
+"""
+Collocation statistics from the co-occurrence counts of a corpus subset (the cooccurrence.bin
+and vocab.txt that setup.generate_subset builds for GloVe), with no additional pass over the
+text. The records are memory-mapped and processed in chunks; for a single word only its rows
+are read, as GloVe writes the records sorted by (word1, word2).
+
+Note that GloVe weights every co-occurrence by 1 / distance within the window, so the observed
+"counts" (and the marginals derived from them) are distance-weighted.
+"""
+
+import argparse
+import os
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import cooccur_utils
+import vector_utils
+
+# Association measures computed by association_scores
+MEASURES = ('pmi', 'ppmi', 'log_likelihood', 't_score')
+
+# Number of co-occurrence records processed at a time
+CHUNK_SIZE = 1 << 24
+
+# Collocates co-occurring less than this (distance-weighted) are left out by default, as PMI
+# overrates rare pairs
+MIN_COOCCURRENCE = 5.0
+
+
+def load_cooccurrence_table(vector_loc: str, chunk_size: int = CHUNK_SIZE) -> Dict:
+    """
+    Memory-maps the co-occurrence records of a subset and computes the marginals of the
+    co-occurrence matrix in one chunked pass. The matrix is symmetric, so the row and column
+    marginals are the same.
+    :param vector_loc: directory with the cooccurrence.bin and vocab.txt of the subset
+    :param chunk_size: number of records processed at a time
+    :return: (dict) with records, vocab, word_idx, marginals and total
+    """
+    vocab = vector_utils.load_vocab_words(vocab_file=os.path.join(vector_loc, 'vocab.txt'))
+    records = cooccur_utils.load_cooccurrence(cooccurrence_file=os.path.join(vector_loc, 'cooccurrence.bin'))
+    marginals = np.zeros(len(vocab))
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        marginals += np.bincount(chunk['word1'] - 1, weights=chunk['val'], minlength=len(vocab))
+    return {
+        'records': records, 'vocab': vocab, 'word_idx': {w: i for i, w in enumerate(vocab)},
+        'marginals': marginals, 'total': float(marginals.sum())}
+
+
+def _row_range(records: np.array, row: int) -> tuple:
+    # Binary search of the records of a (0-based) row, reading log(n) records of the memmap
+    word1 = records['word1']
+    lo, hi = 0, len(records)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if word1[mid] < row + 1:
+            lo = mid + 1
+        else:
+            hi = mid
+    start, hi = lo, len(records)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if word1[mid] < row + 2:
+            lo = mid + 1
+        else:
+            hi = mid
+    return start, lo
+
+
+def association_scores(observed: np.array, row_totals: np.array, col_totals: np.array,
+                       total: float) -> Dict[str, np.array]:
+    """
+    Association measures of co-occurrences, from their 2x2 contingency tables:
+     - pmi: log2(O / E), with E = R * C / N the co-occurrence expected under independence
+     - ppmi: max(pmi, 0)
+     - log_likelihood: Dunning's G2, signed by the direction of the association (negative when O < E)
+     - t_score: (O - E) / sqrt(O)
+    :param observed: (np.array) of co-occurrences O
+    :param row_totals: (np.array) of the marginals R of the first words
+    :param col_totals: (np.array) of the marginals C of the second words
+    :param total: total N of the co-occurrence matrix
+    :return: (dict) of np.arrays, with expected and the measures
+    """
+    observed = np.asarray(observed, dtype=np.float64)
+    expected = row_totals * col_totals / total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pmi = np.log2(observed / expected)
+
+        # Observed and expected cells of the contingency tables
+        cells_observed = [observed, row_totals - observed, col_totals - observed,
+                          total - row_totals - col_totals + observed]
+        cells_expected = [expected, row_totals * (total - col_totals) / total,
+                          (total - row_totals) * col_totals / total,
+                          (total - row_totals) * (total - col_totals) / total]
+        g2 = 2 * sum(np.where(o > 0, o * np.log(o / e), 0.0) for o, e in zip(cells_observed, cells_expected))
+        t_score = (observed - expected) / np.sqrt(observed)
+
+    return {
+        'expected': expected, 'pmi': pmi, 'ppmi': np.maximum(pmi, 0),
+        'log_likelihood': np.sign(observed - expected) * np.maximum(g2, 0), 't_score': t_score}
+
+
+def collocates(table: Dict, word: str, measure: str = 'log_likelihood', top_n: Optional[int] = 20,
+               min_cooccurrence: float = MIN_COOCCURRENCE) -> pd.DataFrame:
+    """
+    Ranked collocates of a word, reading only its rows of the co-occurrence records.
+    :param table: (dict) as returned by load_cooccurrence_table
+    :param word: target word
+    :param measure: (str) one of MEASURES to rank by
+    :param top_n: number of collocates, all if None
+    :param min_cooccurrence: minimum co-occurrence of the collocates
+    :return: (pd.DataFrame) with collocate, cooccurrence, expected and the measures
+    """
+    assert measure in MEASURES, f'[ERROR] Unknown measure {measure}, expected one of {MEASURES}'
+    columns = ['collocate', 'cooccurrence', 'expected'] + list(MEASURES)
+    row = table['word_idx'].get(word)
+    if row is None:
+        print(f'[WARNING] {word} is not in the vocabulary')
+        return pd.DataFrame(columns=columns)
+
+    start, end = _row_range(records=table['records'], row=row)
+    records = np.asarray(table['records'][start:end])
+    records = records[records['val'] >= min_cooccurrence]
+    others = records['word2'] - 1
+
+    scores = association_scores(
+        observed=records['val'], row_totals=table['marginals'][row], col_totals=table['marginals'][others],
+        total=table['total'])
+    result = pd.DataFrame({
+        'collocate': [table['vocab'][i] for i in others], 'cooccurrence': records['val'], **scores})[columns]
+    result = result.sort_values(measure, ascending=False, kind='stable').reset_index(drop=True)
+    return result if top_n is None else result.head(top_n)
+
+
+def association_matrix(table: Dict, measure: str = 'ppmi', min_cooccurrence: float = MIN_COOCCURRENCE,
+                       chunk_size: int = CHUNK_SIZE) -> sparse.csr_matrix:
+    """
+    A measure for every co-occurrence of the table (e.g. a PPMI matrix), computed chunk by chunk.
+    :param table: (dict) as returned by load_cooccurrence_table
+    :param measure: (str) one of MEASURES
+    :param min_cooccurrence: co-occurrences below this are left out
+    :param chunk_size: number of records processed at a time
+    :return: (V, V) sparse matrix of 0-based ids; zero scores (e.g. negative PMI for PPMI) are dropped
+    """
+    assert measure in MEASURES, f'[ERROR] Unknown measure {measure}, expected one of {MEASURES}'
+    records = table['records']
+    marginals = table['marginals']
+    rows, cols, data = [], [], []
+    for start in range(0, len(records), chunk_size):
+        chunk = np.asarray(records[start:start + chunk_size])
+        chunk = chunk[chunk['val'] >= min_cooccurrence]
+        word1, word2 = chunk['word1'] - 1, chunk['word2'] - 1
+        scores = association_scores(
+            observed=chunk['val'], row_totals=marginals[word1], col_totals=marginals[word2],
+            total=table['total'])[measure]
+        keep = scores != 0
+        rows.append(word1[keep])
+        cols.append(word2[keep])
+        data.append(scores[keep])
+
+    V = len(table['vocab'])
+    if len(data) == 0:
+        return sparse.csr_matrix((V, V))
+    return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(V, V))
+
+
+def period_collocates(vector_locs: List[str], words: List[str], measure: str = 'log_likelihood', top_n: int = 20,
+                      min_cooccurrence: float = MIN_COOCCURRENCE) -> pd.DataFrame:
+    """
+    Ranked collocates of words in several subsets (e.g. one per period), named after their directory.
+    :return: (pd.DataFrame) with period, word, rank and the columns of collocates
+    """
+    results = []
+    for vector_loc in vector_locs:
+        table = load_cooccurrence_table(vector_loc=vector_loc)
+        for word in words:
+            result = collocates(table=table, word=word, measure=measure, top_n=top_n, min_cooccurrence=min_cooccurrence)
+            result.insert(0, 'rank', np.arange(1, len(result) + 1))
+            result.insert(0, 'word', word)
+            result.insert(0, 'period', os.path.basename(os.path.normpath(vector_loc)))
+            results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vector_locs', required=True, nargs='+',
+                        help='Subset directories (with cooccurrence.bin and vocab.txt), e.g. one per period')
+    parser.add_argument('--words', required=True, nargs='+')
+    parser.add_argument('--measure', required=False, default='log_likelihood', choices=list(MEASURES))
+    parser.add_argument('--top_n', required=False, type=int, default=20)
+    parser.add_argument('--min_cooccurrence', required=False, type=float, default=MIN_COOCCURRENCE)
+    parser.add_argument('--out_file', required=False, help='Write the collocates to a CSV instead of printing them')
+
+    args = parser.parse_args()
+    result = period_collocates(
+        vector_locs=args.vector_locs, words=args.words, measure=args.measure, top_n=args.top_n,
+        min_cooccurrence=args.min_cooccurrence)
+    if args.out_file is not None:
+        result.to_csv(args.out_file, index=False)
+    else:
+        for (period, word), group in result.groupby(['period', 'word'], sort=False):
+            print(f'[INFO] {word} in {period}:')
+            print(group.drop(columns=['period', 'word']).to_string(index=False, float_format='{:.3f}'.format))
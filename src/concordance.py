@@ -0,0 +1,313 @@
+"""
+Positional inverted index and concordance (KWIC) lines over the token store (see token_store).
+The index maps every word to the sorted positions of its occurrences in the token array of the
+store (from which the document and the offset in the document follow), delta-encoded and
+compressed as varints. It is built once with two passes over the memory-mapped tokens, and
+answers word, phrase and proximity queries by decoding and intersecting a few postings lists,
+filtered by year range and genre (from the coha_utils metadata index).
+"""
+
+import argparse
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import coha_utils
+import token_store
+
+# Default location of the index, within the token store
+INDEX_DIR = 'positional_index'
+
+# Number of tokens (or postings) processed at a time while building the index
+CHUNK_SIZE = 1 << 24
+
+
+def encode_varints(values: np.array) -> np.array:
+    """
+    LEB128 varints of non-negative integers: 7 bits per byte, the high bit set on all but the
+    last byte of every value.
+    :param values: (np.array) of non-negative integers
+    :return: (np.array) of uint8
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for j in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7 * j))
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    for j in range(int(nbytes.max(initial=0))):
+        m = nbytes > j
+        low = (values[m] >> np.uint64(7 * j)) & np.uint64(0x7f)
+        out[starts[m] + j] = low | np.where(nbytes[m] - 1 > j, np.uint64(0x80), np.uint64(0))
+    return out
+
+
+def decode_varints(data: np.array) -> np.array:
+    """
+    Inverse of encode_varints.
+    :param data: (np.array) of uint8
+    :return: (np.array) of uint64
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    last = data < 0x80
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    value_ids = np.concatenate([[0], np.cumsum(last[:-1])])
+    shifts = (7 * (np.arange(len(data)) - starts[value_ids])).astype(np.uint64)
+    # The bits of the bytes of a value do not overlap, so summing them is or-ing them
+    return np.add.reduceat((data & 0x7f).astype(np.uint64) << shifts, starts)
+
+
+def build_positional_index(store: Dict, index_dir: Optional[str] = None, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    Builds the positional index of a token store: postings.bin (the delta-encoded varint
+    positions of every word, word after word), term_offsets.npy (start of every word in
+    postings.bin, plus the end) and manifest.json. The positions are first sorted by word into
+    a temporary memory-mapped array (a counting sort, as the word counts are in the store),
+    then compressed chunk by chunk, so memory use is bounded by chunk_size.
+    :param store: (dict) as returned by token_store.load_token_store
+    :param index_dir: output directory, {store_dir}/positional_index by default
+    :param chunk_size: number of tokens (or postings) processed at a time
+    :return: the index directory
+    """
+    index_dir = index_dir or os.path.join(store['store_dir'], INDEX_DIR)
+    os.makedirs(index_dir, exist_ok=True)
+    tokens = store['tokens']
+    N = len(tokens)
+    V = len(store['vocab'])
+    term_starts = np.concatenate([[0], np.cumsum(store['counts'])]).astype(np.int64)
+    assert term_starts[-1] == N, '[ERROR] Word counts of the token store do not match its tokens'
+
+    # Counting sort of the positions by word
+    tmp_file = os.path.join(index_dir, f'positions.{os.getpid()}.tmp.npy')
+    positions = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.int64, shape=(N,))
+    cursor = term_starts[:-1].copy()
+    for start in tqdm(range(0, N, chunk_size), desc='Sorting positions'):
+        chunk = np.asarray(tokens[start:start + chunk_size], dtype=np.int64)
+        order = np.argsort(chunk, kind='stable')
+        sorted_chunk = chunk[order]
+        rank = np.arange(len(chunk)) - np.searchsorted(sorted_chunk, sorted_chunk, side='left')
+        positions[cursor[sorted_chunk] + rank] = start + order
+        cursor += np.bincount(chunk, minlength=V)
+    positions.flush()
+
+    # Deltas within every word (the first position of a word is kept as is), as varints
+    term_offsets = np.zeros(V + 1, dtype=np.int64)
+    written = 0
+    with open(os.path.join(index_dir, 'postings.bin'), 'wb') as f:
+        for start in tqdm(range(0, N, chunk_size), desc='Compressing postings'):
+            values = np.asarray(positions[start:start + chunk_size])
+            previous = np.concatenate([[positions[start - 1] if start > 0 else 0], values[:-1]])
+            in_chunk = np.flatnonzero((term_starts[:-1] >= start) & (term_starts[:-1] < start + len(values)))
+            first = term_starts[in_chunk] - start
+            previous[first] = 0
+
+            encoded = encode_varints(values - previous)
+            nbytes = np.diff(np.concatenate([[0], np.flatnonzero(encoded < 0x80) + 1]))
+            term_offsets[in_chunk] = written + (np.cumsum(nbytes) - nbytes)[first]
+            encoded.tofile(f)
+            written += len(encoded)
+    term_offsets[:-1][term_starts[:-1] >= N] = written
+    term_offsets[-1] = written
+
+    del positions
+    os.remove(tmp_file)
+    np.save(os.path.join(index_dir, 'term_offsets.npy'), term_offsets)
+    with open(os.path.join(index_dir, 'manifest.json'), 'w') as f:
+        json.dump({'tokens': int(N), 'vocab_size': int(V), 'postings_bytes': int(written)}, f)
+    return index_dir
+
+
+def load_positional_index(store: Dict, index_dir: Optional[str] = None) -> Dict:
+    """
+    Opens the positional index of a token store, with the postings memory-mapped.
+    :param store: (dict) as returned by token_store.load_token_store
+    :param index_dir: index directory, {store_dir}/positional_index by default
+    :return: (dict) with postings, term_offsets, term_ids (by word, as bytes) and the store
+    """
+    index_dir = index_dir or os.path.join(store['store_dir'], INDEX_DIR)
+    with open(os.path.join(index_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['tokens'] == len(store['tokens']), \
+        f'[ERROR] {index_dir} was built from a different token store, rebuild it'
+    return {
+        'postings': np.memmap(os.path.join(index_dir, 'postings.bin'), dtype=np.uint8, mode='r')
+        if manifest['postings_bytes'] > 0 else np.zeros(0, dtype=np.uint8),
+        'term_offsets': np.load(os.path.join(index_dir, 'term_offsets.npy')),
+        'term_ids': {w: i for i, w in enumerate(store['vocab'])},
+        'store': store}
+
+
+def word_positions(index: Dict, word: str) -> np.array:
+    """
+    Sorted positions (in the token array of the store) of the occurrences of a word.
+    """
+    # Vocabulary bytes are latin-1, as for every token store consumer (see token_store.doc_term_index)
+    try:
+        term_id = index['term_ids'].get(word.encode('latin-1'))
+    except UnicodeEncodeError:
+        term_id = None
+    if term_id is None:
+        return np.zeros(0, dtype=np.int64)
+    data = index['postings'][index['term_offsets'][term_id]:index['term_offsets'][term_id + 1]]
+    return np.cumsum(decode_varints(data)).astype(np.int64)
+
+
+def _rows_of(store: Dict, positions: np.array) -> np.array:
+    return np.searchsorted(store['offsets'], positions, side='right') - 1
+
+
+def phrase_positions(index: Dict, phrase: List[str]) -> np.array:
+    """
+    Positions of the first word of every occurrence of a phrase (consecutive words within
+    one document).
+    """
+    if len(phrase) == 0:
+        raise Exception('[ERROR] Empty query: give at least one word')
+
+    # Intersect the rarest words first
+    postings = [word_positions(index=index, word=w) - i for i, w in enumerate(phrase)]
+    order = np.argsort([len(p) for p in postings], kind='stable')
+    positions = postings[order[0]]
+    for i in order[1:]:
+        positions = np.intersect1d(positions, postings[i], assume_unique=True)
+    if len(phrase) > 1 and len(positions) > 0:
+        store = index['store']
+        positions = positions[_rows_of(store, positions) == _rows_of(store, positions + len(phrase) - 1)]
+    return positions
+
+
+def near_positions(index: Dict, positions: np.array, length: int, word: str, distance: int) -> np.array:
+    """
+    Keeps the positions of matches (of length words) with an occurrence of word at most distance
+    words before or after them, within the same document.
+    """
+    if len(positions) == 0:
+        return positions
+    store = index['store']
+    others = word_positions(index=index, word=word)
+    rows = _rows_of(store, positions)
+    lo = np.maximum(positions - distance, store['offsets'][rows])
+    hi = np.minimum(positions + length - 1 + distance, store['offsets'][rows + 1] - 1)
+    found = np.searchsorted(others, hi, side='right') - np.searchsorted(others, lo, side='left')
+    # The match itself does not count (e.g. a word near itself)
+    inside = np.searchsorted(others, positions + length - 1, side='right') - \
+        np.searchsorted(others, positions, side='left')
+    return positions[found - inside > 0]
+
+
+def document_filter(store: Dict, start_year: Optional[int] = None, end_year: Optional[int] = None,
+                    genres: Optional[Iterable[str]] = None, metadata_loc: Optional[str] = None) -> np.array:
+    """
+    Mask of the rows (documents) of the store within a year range (inclusive) and some genres.
+    Genres need the COHA metadata.
+    """
+    keep = np.ones(len(store['doc_ids']), dtype=bool)
+    if start_year is not None:
+        keep &= store['years'] >= start_year
+    if end_year is not None:
+        keep &= store['years'] <= end_year
+    if genres is not None:
+        assert metadata_loc is not None, '[ERROR] Filtering by genre needs the COHA metadata'
+        documents = coha_utils.query_metadata_index(
+            index=coha_utils.load_metadata_index(loc_dir=metadata_loc), start_year=start_year, end_year=end_year,
+            genres=genres)
+        in_genres = np.zeros(len(keep), dtype=bool)
+        in_genres[token_store.document_rows(store=store, documents=documents)] = True
+        keep &= in_genres
+    return keep
+
+
+def concordance(index: Dict, query: str, window: int = 8, near: Optional[str] = None, distance: int = 5,
+                start_year: Optional[int] = None, end_year: Optional[int] = None,
+                genres: Optional[Iterable[str]] = None, metadata_loc: Optional[str] = None,
+                limit: Optional[int] = None) -> pd.DataFrame:
+    """
+    Keyword-in-context lines of a word or phrase.
+    :param index: (dict) as returned by load_positional_index
+    :param query: (str) a word or a phrase (words separated by spaces)
+    :param window: number of words of context on each side
+    :param near: (str) only matches with this word at most distance words away
+    :param distance:
+    :param start_year: first year, unbounded if None
+    :param end_year: last year (inclusive), unbounded if None
+    :param genres: (iterable of str) genres to keep, all if None (needs metadata_loc)
+    :param metadata_loc: Location of the COHA metadata json (for genres)
+    :param limit: maximum number of lines, all if None
+    :return: (pd.DataFrame) with doc_id, year, (genre,) offset (in the document), left, match and right
+    """
+    store = index['store']
+    phrase = query.split()
+    positions = phrase_positions(index=index, phrase=phrase)
+    if near is not None:
+        positions = near_positions(index=index, positions=positions, length=len(phrase), word=near, distance=distance)
+    if start_year is not None or end_year is not None or genres is not None:
+        keep = document_filter(
+            store=store, start_year=start_year, end_year=end_year, genres=genres, metadata_loc=metadata_loc)
+        positions = positions[keep[_rows_of(store, positions)]]
+    if limit is not None:
+        positions = positions[:limit]
+
+    words = [w.decode('latin-1') for w in store['vocab']]
+    rows = _rows_of(store, positions)
+    lines = []
+    for position, row in zip(positions.tolist(), rows.tolist()):
+        doc_start, doc_end = store['offsets'][row], store['offsets'][row + 1]
+        end = position + len(phrase)
+        lines.append({
+            'doc_id': store['doc_ids'][row], 'year': int(store['years'][row]), 'offset': int(position - doc_start),
+            'left': ' '.join(words[t] for t in store['tokens'][max(doc_start, position - window):position]),
+            'match': ' '.join(words[t] for t in store['tokens'][position:end]),
+            'right': ' '.join(words[t] for t in store['tokens'][end:min(doc_end, end + window)])})
+    lines = pd.DataFrame(lines, columns=['doc_id', 'year', 'offset', 'left', 'match', 'right'])
+
+    if metadata_loc is not None:
+        metadata_index = coha_utils.load_metadata_index(loc_dir=metadata_loc)
+        genre_by_doc = dict(zip(
+            metadata_index['doc_ids'], metadata_index['genre_names'][metadata_index['genre_codes']]))
+        lines.insert(2, 'genre', [genre_by_doc.get(d, '') for d in lines['doc_id']])
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build the positional index of a token store')
+    build_parser.add_argument('--token_store', required=True)
+    build_parser.add_argument('--index_dir', required=False)
+
+    query_parser = subparsers.add_parser('query', help='Concordance lines of a word or phrase')
+    query_parser.add_argument('--token_store', required=True)
+    query_parser.add_argument('--index_dir', required=False)
+    query_parser.add_argument('--query', required=True, help='Word or phrase, e.g. "chu chu"')
+    query_parser.add_argument('--window', required=False, type=int, default=8)
+    query_parser.add_argument('--near', required=False, help='Only matches with this word nearby')
+    query_parser.add_argument('--distance', required=False, type=int, default=5)
+    query_parser.add_argument('--start_year', required=False, type=int)
+    query_parser.add_argument('--end_year', required=False, type=int)
+    query_parser.add_argument('--genres', required=False, nargs='+')
+    query_parser.add_argument('--coha_metadata_loc', required=False)
+    query_parser.add_argument('--limit', required=False, type=int)
+    query_parser.add_argument('--out_file', required=False, help='Write the lines to a CSV instead of printing them')
+
+    args = parser.parse_args()
+    store = token_store.load_token_store(store_dir=args.token_store)
+    if args.command == 'build':
+        index_dir = build_positional_index(store=store, index_dir=args.index_dir)
+        print(f'[INFO] Built the positional index of {len(store["tokens"])} tokens in {index_dir}')
+    else:
+        lines = concordance(
+            index=load_positional_index(store=store, index_dir=args.index_dir), query=args.query,
+            window=args.window, near=args.near, distance=args.distance, start_year=args.start_year,
+            end_year=args.end_year, genres=args.genres, metadata_loc=args.coha_metadata_loc, limit=args.limit)
+        if args.out_file is not None:
+            lines.to_csv(args.out_file, index=False)
+        else:
+            for _, line in lines.iterrows():
+                print(f'{line["doc_id"]:>8} {line["year"]} {line["left"]:>60} [{line["match"]}] {line["right"]}')
+        print(f'[INFO] {len(lines)} lines')
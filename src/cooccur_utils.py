@@ -0,0 +1,615 @@
+#
+# Utilities for GloVe co-occurrence files. cooccurrence.bin is a flat array of CREC records
+# (int word1, int word2, double val), with 1-based word ids given by the row of each word
+# in vocab.txt (see https://github.com/stanfordnlp/GloVe/blob/master/src/cooccur.c)
+#
+# Besides building co-occurrences, the records can be merged across subsets, pruned to the
+# words of a vocabulary min count, restricted to some rows and columns and shuffled (as GloVe's shuffle
+# does), all streaming over memory-mapped chunks so that files larger than memory need no
+# full-size temporary copies.
+#
+
+import argparse
+import os
+from collections import Counter
+from multiprocessing import Pool
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from scipy import sparse
+
+import trace_utils
+
+# Record layout of cooccurrence.bin and cooccurrence.shuf.bin
+CREC_DTYPE = np.dtype([('word1', '<i4'), ('word2', '<i4'), ('val', '<f8')])
+
+# Defaults from run_glove.sh
+VOCAB_MIN_COUNT = 5
+WINDOW_SIZE = 8
+
+# GloVe truncates words to MAX_STRING_LENGTH - 1 bytes
+MAX_STRING_LENGTH = 1000
+
+# GloVe breaks frequency ties with a strcmp over (signed) chars, so bytes >= 0x80 sort first
+# and a word sorts after its extensions by such bytes. Shifting every byte by 128 and
+# appending a terminator reproduces that order with Python bytes comparisons.
+_SIGNED_CHAR_ORDER = bytes((b + 128) % 256 for b in range(256))
+
+# Number of co-occurrence pairs buffered before they are summed into a shard accumulator
+_FLUSH_PAIRS = 1 << 24
+
+# Number of co-occurrence records streamed at a time (64 MB)
+CHUNK_RECORDS = 1 << 22
+
+# Largest co-occurrence file (in records) shuffled in memory by iter_shuffled_batches without a buffer
+IN_MEMORY_SHUFFLE_RECORDS = 1 << 26
+
+
+def load_cooccurrence(cooccurrence_file: str, mode: str = 'r') -> np.memmap:
+    """
+    Memory-maps a GloVe co-occurrence file as a structured array of CREC records.
+    :param cooccurrence_file: location of cooccurrence.bin (or cooccurrence.shuf.bin)
+    :param mode: np.memmap mode, read-only by default
+    :return: (np.memmap) with fields word1, word2 (1-based vocab ids) and val
+    """
+    if os.path.getsize(cooccurrence_file) == 0:
+        # Empty files cannot be memory-mapped
+        return np.zeros(0, dtype=CREC_DTYPE)
+    return np.memmap(cooccurrence_file, dtype=CREC_DTYPE, mode=mode)
+
+
+def tokenize(line: bytes) -> List[bytes]:
+    """
+    Splits a line of a GloVe corpus into words as the GloVe tools do: on spaces and tabs,
+    ignoring carriage returns.
+    :param line: (bytes) one document
+    :return: (list of bytes)
+    """
+    words = line.replace(b'\r', b'').replace(b'\t', b' ').split(b' ')
+    return [w[:MAX_STRING_LENGTH - 1] for w in words if w]
+
+
+def shard_corpus(corpus_file: str, num_shards: int) -> List[Tuple[int, int]]:
+    """
+    Splits a corpus file into byte ranges that start at the beginning of a line.
+    :param corpus_file: location of the corpus (one document per line)
+    :param num_shards:
+    :return: (list) of (start, end) byte offsets
+    """
+    size = os.path.getsize(corpus_file)
+    offsets = [0]
+    with open(corpus_file, 'rb') as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards, offsets[-1]))
+            if f.tell() > 0:
+                f.readline()
+            offsets.append(min(f.tell(), size))
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+
+def iter_documents(corpus_file: str, start: int = 0, end: int = None) -> Iterator[bytes]:
+    """
+    Iterates over the lines (documents) of a corpus file within a byte range.
+    """
+    end = os.path.getsize(corpus_file) if end is None else end
+    with open(corpus_file, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.rstrip(b'\n')
+
+
+def _count_shard(shard: Tuple[str, int, int]) -> Counter:
+    corpus_file, start, end = shard
+    counts = Counter()
+    for line in iter_documents(corpus_file=corpus_file, start=start, end=end):
+        counts.update(tokenize(line))
+    return counts
+
+
+def sort_vocab(counts: Dict[bytes, int], min_count: int = VOCAB_MIN_COUNT) -> List[Tuple[bytes, int]]:
+    """
+    Orders word counts as GloVe's vocab_count does (by decreasing count, ties broken by
+    word) and drops words with fewer than min_count occurrences.
+    :param counts: (dict) of word counts
+    :param min_count:
+    :return: (list) of (word, count), in vocab.txt order
+    """
+    vocab = [(w, c) for w, c in counts.items() if c >= min_count]
+    vocab.sort(key=lambda x: (-x[1], (x[0] + b'\x00').translate(_SIGNED_CHAR_ORDER)))
+    return vocab
+
+
+def build_vocab(corpus_file: str, min_count: int = VOCAB_MIN_COUNT,
+                num_processes: int = 1) -> List[Tuple[bytes, int]]:
+    """
+    Counts the words of a corpus over a process pool, as GloVe's vocab_count does.
+    :param corpus_file: location of the corpus (one document per line)
+    :param min_count:
+    :param num_processes:
+    :return: (list) of (word, count), in vocab.txt order
+    """
+    shards = [(corpus_file, start, end) for start, end in shard_corpus(corpus_file, num_processes)]
+    counts = Counter()
+    with Pool(processes=num_processes) as p:
+        for shard_counts in p.imap_unordered(_count_shard, shards):
+            counts.update(shard_counts)
+    return sort_vocab(counts=counts, min_count=min_count)
+
+
+def write_vocab(vocab: List[Tuple[bytes, int]], vocab_file: str):
+    with open(vocab_file, 'wb') as f:
+        for w, c in vocab:
+            f.write(w + b' ' + str(c).encode() + b'\n')
+
+
+def load_vocab_counts(vocab_file: str) -> List[Tuple[bytes, int]]:
+    """
+    Reads a GloVe vocab.txt as (word, count) pairs, in row order.
+    """
+    with open(vocab_file, 'rb') as f:
+        vocab = [line.rstrip(b'\n').rsplit(b' ', 1) for line in f if line.strip() != b'']
+    return [(w, int(c)) for w, c in vocab]
+
+
+def document_cooccurrence(word_ids: np.array, window_size: int = WINDOW_SIZE) -> Tuple[np.array, np.array, np.array]:
+    """
+    Windowed co-occurrences of one document, with GloVe's default symmetric context and
+    inverse-distance weighting. Out of vocabulary words must already be removed: like GloVe,
+    the window spans the previous window_size in-vocabulary words.
+    :param word_ids: (np.array) of the vocabulary ids of the document words, in order
+    :param window_size:
+    :return: (word1, word2, val) arrays, with repeated pairs not yet summed
+    """
+    word1, word2, val = [], [], []
+    for distance in range(1, min(window_size, len(word_ids) - 1) + 1):
+        left = word_ids[:-distance]
+        right = word_ids[distance:]
+        weight = np.full(2 * len(left), 1.0 / distance)
+        word1.extend((left, right))
+        word2.extend((right, left))
+        val.append(weight)
+    if len(val) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    return np.concatenate(word1), np.concatenate(word2), np.concatenate(val)
+
+
+def _sum_pairs(word1: List[np.array], word2: List[np.array], val: List[np.array], V: int) -> sparse.csr_matrix:
+    return sparse.coo_matrix(
+        (np.concatenate(val), (np.concatenate(word1), np.concatenate(word2))), shape=(V, V)).tocsr()
+
+
+def accumulate_cooccurrence(documents: Iterable[np.array], V: int, window_size: int = WINDOW_SIZE) -> sparse.csr_matrix:
+    """
+    Sums the windowed co-occurrences of documents, buffering pairs before each sparse sum.
+    :param documents: (iterable) of arrays of in-vocabulary word ids (0-based), one per document
+    :param V: vocabulary size
+    :param window_size:
+    :return: (V, V) co-occurrence matrix over 0-based word ids
+    """
+    accumulator = sparse.csr_matrix((V, V))
+    word1, word2, val = [], [], []
+    buffered = 0
+    for word_ids in documents:
+        w1, w2, v = document_cooccurrence(word_ids=word_ids, window_size=window_size)
+        word1.append(w1)
+        word2.append(w2)
+        val.append(v)
+        buffered += len(v)
+        if buffered >= _FLUSH_PAIRS:
+            accumulator = accumulator + _sum_pairs(word1, word2, val, V)
+            word1, word2, val = [], [], []
+            buffered = 0
+    if buffered > 0:
+        accumulator = accumulator + _sum_pairs(word1, word2, val, V)
+    return accumulator
+
+
+def _cooccur_shard(shard: Tuple[str, int, int, Dict[bytes, int], int]) -> sparse.csr_matrix:
+    corpus_file, start, end, word_idx, window_size = shard
+    documents = (np.array([word_idx[w] for w in tokenize(line) if w in word_idx], dtype=np.int64)
+                 for line in iter_documents(corpus_file=corpus_file, start=start, end=end))
+    return accumulate_cooccurrence(documents=documents, V=len(word_idx), window_size=window_size)
+
+
+def matrix_to_records(matrix: sparse.spmatrix) -> np.array:
+    """
+    Converts a (V, V) co-occurrence matrix of 0-based ids to CREC records (1-based ids),
+    in the (word1, word2) order of GloVe's cooccur output.
+    :param matrix: sparse co-occurrence matrix
+    :return: structured array of CREC records
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    matrix.eliminate_zeros()
+    records = np.zeros(matrix.nnz, dtype=CREC_DTYPE)
+    records['word1'] = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr)) + 1
+    records['word2'] = matrix.indices + 1
+    records['val'] = matrix.data
+    return records
+
+
+def write_cooccurrence(matrix: sparse.spmatrix, cooccurrence_file: str, chunk_rows: int = 10000):
+    """
+    Writes a (V, V) co-occurrence matrix of 0-based ids as GloVe CREC records, in the
+    (word1, word2) order of GloVe's cooccur output.
+    :param matrix: sparse co-occurrence matrix
+    :param cooccurrence_file: output location
+    :param chunk_rows: number of rows converted to records at a time
+    :return:
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    with open(cooccurrence_file, 'wb') as f:
+        for row_start in range(0, matrix.shape[0], chunk_rows):
+            row_end = min(row_start + chunk_rows, matrix.shape[0])
+            lo, hi = matrix.indptr[row_start], matrix.indptr[row_end]
+            records = np.zeros(hi - lo, dtype=CREC_DTYPE)
+            records['word1'] = np.repeat(
+                np.arange(row_start, row_end), np.diff(matrix.indptr[row_start:row_end + 1])) + 1
+            records['word2'] = matrix.indices[lo:hi] + 1
+            records['val'] = matrix.data[lo:hi]
+            records[records['val'] != 0].tofile(f)
+
+
+def build_cooccurrence(corpus_file: str, out_path: str, min_count: int = VOCAB_MIN_COUNT,
+                       window_size: int = WINDOW_SIZE, num_processes: int = 1) -> Tuple[int, int]:
+    """
+    Builds vocab.txt and cooccurrence.bin for a corpus, compatible with the output of GloVe's
+    vocab_count and cooccur with the parameters of run_glove.sh. Documents are sharded across
+    a process pool, and each shard counts co-occurrences into a sparse accumulator.
+    :param corpus_file: location of the corpus (one document per line)
+    :param out_path: output directory
+    :param min_count: minimum word count to be included in the vocabulary
+    :param window_size: number of context words to the left (and right) of each word
+    :param num_processes:
+    :return: (V, number of co-occurrence records)
+    """
+    os.makedirs(out_path, exist_ok=True)
+    with trace_utils.stage('build_vocab'):
+        vocab = build_vocab(corpus_file=corpus_file, min_count=min_count, num_processes=num_processes)
+        write_vocab(vocab=vocab, vocab_file=os.path.join(out_path, 'vocab.txt'))
+
+    word_idx = {w: i for i, (w, _) in enumerate(vocab)}
+    shards = [(corpus_file, start, end, word_idx, window_size)
+              for start, end in shard_corpus(corpus_file, num_processes)]
+    with trace_utils.stage('count_cooccurrence'):
+        matrix = sparse.csr_matrix((len(vocab), len(vocab)))
+        with Pool(processes=num_processes) as p:
+            for shard_matrix in p.imap_unordered(_cooccur_shard, shards):
+                matrix = matrix + shard_matrix
+
+    with trace_utils.stage('write_cooccurrence'):
+        write_cooccurrence(matrix=matrix, cooccurrence_file=os.path.join(out_path, 'cooccurrence.bin'))
+    return len(vocab), matrix.nnz
+
+
+def _iter_chunks(records: np.array, chunk_records: int) -> Iterator[np.array]:
+    for start in range(0, len(records), chunk_records):
+        yield np.asarray(records[start:start + chunk_records])
+
+
+def _write_rows(f, matrix: sparse.csr_matrix, row_offset: int):
+    # Appends the records of a (sorted, summed) CSR block whose row 0 is vocab row row_offset
+    records = np.zeros(matrix.nnz, dtype=CREC_DTYPE)
+    records['word1'] = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr)) + row_offset + 1
+    records['word2'] = matrix.indices + 1
+    records['val'] = matrix.data
+    records[records['val'] != 0].tofile(f)
+
+
+def merge_cooccurrence(vector_locs: List[str], out_path: str, min_count: int = VOCAB_MIN_COUNT,
+                       num_buckets: Optional[int] = None, chunk_records: int = CHUNK_RECORDS) -> Tuple[int, int]:
+    """
+    Merges the vocab.txt and cooccurrence.bin of several subsets (e.g. decades) into those of
+    their union, without holding any of them in memory. The records are remapped to the merged
+    vocabulary and streamed into buckets of consecutive rows (balanced by number of records),
+    and each bucket is then summed in memory and appended to the output, so the output is
+    sorted by (word1, word2) as GloVe's cooccur writes it.
+
+    Words pruned from the vocabulary of a subset have no count (or co-occurrences) in it, so
+    the merged counts of rare words can be lower than those of a subset built from the union.
+    :param vector_locs: directories with the cooccurrence.bin and vocab.txt of the subsets
+    :param out_path: output directory
+    :param min_count: minimum merged word count to be included in the vocabulary
+    :param num_buckets: number of buckets, so that a bucket is about chunk_records records if None
+    :param chunk_records: number of records streamed at a time
+    :return: (V, number of co-occurrence records)
+    """
+    os.makedirs(out_path, exist_ok=True)
+    counts = Counter()
+    subset_vocabs = []
+    for vector_loc in vector_locs:
+        subset_vocabs.append(load_vocab_counts(vocab_file=os.path.join(vector_loc, 'vocab.txt')))
+        for w, c in subset_vocabs[-1]:
+            counts[w] += c
+    vocab = sort_vocab(counts=counts, min_count=min_count)
+    write_vocab(vocab=vocab, vocab_file=os.path.join(out_path, 'vocab.txt'))
+    word_idx = {w: i for i, (w, _) in enumerate(vocab)}
+    V = len(vocab)
+
+    # Merged ids of the words of every subset (-1 for pruned words)
+    mappings = [np.array([word_idx.get(w, -1) for w, _ in subset_vocab], dtype=np.int64)
+                for subset_vocab in subset_vocabs]
+    inputs = [load_cooccurrence(cooccurrence_file=os.path.join(vector_loc, 'cooccurrence.bin'))
+              for vector_loc in vector_locs]
+
+    def remapped_chunks() -> Iterator[Tuple[np.array, np.array, np.array]]:
+        for records, mapping in zip(inputs, mappings):
+            for chunk in _iter_chunks(records=records, chunk_records=chunk_records):
+                word1, word2 = mapping[chunk['word1'] - 1], mapping[chunk['word2'] - 1]
+                keep = (word1 >= 0) & (word2 >= 0)
+                yield word1[keep], word2[keep], chunk['val'][keep]
+
+    # First pass: records by row, to balance the buckets
+    row_records = np.zeros(V, dtype=np.int64)
+    for word1, _, _ in remapped_chunks():
+        row_records += np.bincount(word1, minlength=V)
+    total = int(row_records.sum())
+    num_buckets = num_buckets or max(1, -(-total // chunk_records))
+    cumulative = np.cumsum(row_records)
+    boundaries = np.unique(np.searchsorted(cumulative, total * np.arange(1, num_buckets) / num_buckets, side='left'))
+    row_bounds = np.concatenate([[0], boundaries[(boundaries > 0) & (boundaries < V)], [V]]).astype(np.int64)
+
+    # Second pass: stream the records into bucket files
+    tmp_dir = os.path.join(out_path, f'merge.{os.getpid()}.tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    bucket_files = [os.path.join(tmp_dir, f'bucket_{b}.bin') for b in range(len(row_bounds) - 1)]
+    handles = [open(bucket_file, 'wb') for bucket_file in bucket_files]
+    try:
+        for word1, word2, val in remapped_chunks():
+            buckets = np.searchsorted(row_bounds, word1, side='right') - 1
+            order = np.argsort(buckets, kind='stable')
+            records = np.zeros(len(order), dtype=CREC_DTYPE)
+            records['word1'], records['word2'], records['val'] = word1[order], word2[order], val[order]
+            sizes = np.bincount(buckets, minlength=len(handles))
+            ends = np.cumsum(sizes)
+            for b in np.flatnonzero(sizes):
+                records[ends[b] - sizes[b]:ends[b]].tofile(handles[b])
+    finally:
+        for handle in handles:
+            handle.close()
+
+    # Third pass: sum every bucket and append it to the output
+    nnz = 0
+    with open(os.path.join(out_path, 'cooccurrence.bin'), 'wb') as f:
+        for b, bucket_file in enumerate(bucket_files):
+            records = np.fromfile(bucket_file, dtype=CREC_DTYPE)
+            os.remove(bucket_file)
+            lo, hi = row_bounds[b], row_bounds[b + 1]
+            matrix = sparse.csr_matrix(
+                (records['val'], (records['word1'] - lo, records['word2'])), shape=(hi - lo, V))
+            matrix.sum_duplicates()
+            matrix.sort_indices()
+            _write_rows(f=f, matrix=matrix, row_offset=lo)
+            nnz += int(np.count_nonzero(matrix.data))
+    os.rmdir(tmp_dir)
+    return V, nnz
+
+
+def restrict_cooccurrence(cooccurrence_file: str, out_file: str, rows: Optional[Iterable[int]] = None,
+                          cols: Optional[Iterable[int]] = None, chunk_records: int = CHUNK_RECORDS) -> int:
+    """
+    Writes the records of some rows (word1) and columns (word2) of a co-occurrence file, keeping
+    their ids and order.
+    :param cooccurrence_file: location of cooccurrence.bin
+    :param out_file: output location
+    :param rows: 0-based vocab ids of the rows to keep, all rows if None
+    :param cols: 0-based vocab ids of the columns to keep, all columns if None
+    :param chunk_records: number of records streamed at a time
+    :return: number of records written
+    """
+    records = load_cooccurrence(cooccurrence_file=cooccurrence_file)
+
+    def id_mask(ids: Optional[Iterable[int]]) -> Optional[np.array]:
+        if ids is None:
+            return None
+        ids = np.asarray(list(ids), dtype=np.int64)
+        mask = np.zeros(int(ids.max(initial=-1)) + 2, dtype=bool)
+        mask[ids + 1] = True
+        return mask
+
+    row_mask, col_mask = id_mask(rows), id_mask(cols)
+    written = 0
+    with open(out_file, 'wb') as f:
+        for chunk in _iter_chunks(records=records, chunk_records=chunk_records):
+            keep = np.ones(len(chunk), dtype=bool)
+            for mask, field in ((row_mask, 'word1'), (col_mask, 'word2')):
+                if mask is not None:
+                    keep &= mask[np.minimum(chunk[field], len(mask) - 1)] & (chunk[field] < len(mask))
+            chunk[keep].tofile(f)
+            written += int(keep.sum())
+    return written
+
+
+def prune_cooccurrence(vector_loc: str, out_path: str, min_count: int,
+                       chunk_records: int = CHUNK_RECORDS) -> Tuple[int, int]:
+    """
+    Prunes the vocab.txt and cooccurrence.bin of a subset to the words with at least min_count
+    occurrences. vocab.txt is sorted by decreasing count, so the kept words are a prefix of the
+    vocabulary and keep their ids.
+
+    This only drops the records of the pruned words: it is not the same as building the
+    co-occurrences again with the higher min_count. cooccur drops out-of-vocabulary words
+    before windowing, so a rebuild brings words on either side of a pruned word closer (or
+    into the same window), while the pruned records keep the distances, and pairs, of the
+    original vocabulary.
+    :param vector_loc: directory with the cooccurrence.bin and vocab.txt of the subset
+    :param out_path: output directory
+    :param min_count:
+    :param chunk_records: number of records streamed at a time
+    :return: (V, number of co-occurrence records)
+    """
+    os.makedirs(out_path, exist_ok=True)
+    vocab = [(w, c) for w, c in load_vocab_counts(vocab_file=os.path.join(vector_loc, 'vocab.txt')) if c >= min_count]
+    write_vocab(vocab=vocab, vocab_file=os.path.join(out_path, 'vocab.txt'))
+    kept = np.arange(len(vocab))
+    nnz = restrict_cooccurrence(
+        cooccurrence_file=os.path.join(vector_loc, 'cooccurrence.bin'),
+        out_file=os.path.join(out_path, 'cooccurrence.bin'), rows=kept, cols=kept, chunk_records=chunk_records)
+    return len(vocab), nnz
+
+
+def _shuffle_buckets(records: np.array, seed: int, num_buckets: int, chunk_records: int) -> Iterator[np.array]:
+    # Bucket of every record of every chunk, drawn from a generator seeded by (seed, chunk), so
+    # that the passes of a shuffle draw the same buckets
+    for c, start in enumerate(range(0, len(records), chunk_records)):
+        n = min(chunk_records, len(records) - start)
+        yield np.random.default_rng([seed, 0, c]).integers(num_buckets, size=n)
+
+
+def _shuffle_num_buckets(records: np.array, num_buckets: Optional[int], chunk_records: int) -> int:
+    return num_buckets or max(1, -(-len(records) // chunk_records))
+
+
+def shuffle_cooccurrence(cooccurrence_file: str, buffer_file: str, seed: int, num_buckets: Optional[int] = None,
+                         chunk_records: int = CHUNK_RECORDS) -> np.memmap:
+    """
+    Shuffles the records of a co-occurrence file into a buffer file (e.g. cooccurrence.shuf.bin),
+    out of core: every record is sent to a random bucket, each bucket is contiguous in the
+    buffer, and the buckets are then shuffled in memory one at a time, which gives a uniformly
+    random permutation. An existing buffer of the right size is overwritten in place, so one
+    buffer can be reused by every iteration of a bootstrap.
+    :param cooccurrence_file: location of cooccurrence.bin
+    :param buffer_file: location of the shuffled records
+    :param seed: random seed of the shuffle
+    :param num_buckets: number of buckets, so that a bucket is about chunk_records records if None
+    :param chunk_records: number of records streamed at a time
+    :return: (np.memmap) of the shuffled records
+    """
+    records = load_cooccurrence(cooccurrence_file=cooccurrence_file)
+    num_buckets = _shuffle_num_buckets(records=records, num_buckets=num_buckets, chunk_records=chunk_records)
+    if len(records) == 0:
+        open(buffer_file, 'wb').close()
+        return np.zeros(0, dtype=CREC_DTYPE)
+
+    if os.path.exists(buffer_file) and os.path.getsize(buffer_file) == records.nbytes:
+        shuffled = np.memmap(buffer_file, dtype=CREC_DTYPE, mode='r+')
+    else:
+        shuffled = np.memmap(buffer_file, dtype=CREC_DTYPE, mode='w+', shape=records.shape)
+
+    # Bucket sizes, then every chunk scattered to its buckets
+    bucket_sizes = np.zeros(num_buckets, dtype=np.int64)
+    for buckets in _shuffle_buckets(records=records, seed=seed, num_buckets=num_buckets, chunk_records=chunk_records):
+        bucket_sizes += np.bincount(buckets, minlength=num_buckets)
+    bucket_starts = np.concatenate([[0], np.cumsum(bucket_sizes)])
+    cursor = bucket_starts[:-1].copy()
+    for chunk, buckets in zip(
+            _iter_chunks(records=records, chunk_records=chunk_records),
+            _shuffle_buckets(records=records, seed=seed, num_buckets=num_buckets, chunk_records=chunk_records)):
+        order = np.argsort(buckets, kind='stable')
+        sizes = np.bincount(buckets, minlength=num_buckets)
+        chunk = chunk[order]
+        offset = 0
+        for b in np.flatnonzero(sizes):
+            shuffled[cursor[b]:cursor[b] + sizes[b]] = chunk[offset:offset + sizes[b]]
+            offset += sizes[b]
+        cursor += sizes
+
+    for b in range(num_buckets):
+        lo, hi = bucket_starts[b], bucket_starts[b + 1]
+        shuffled[lo:hi] = np.random.default_rng([seed, 1, b]).permutation(np.asarray(shuffled[lo:hi]))
+    shuffled.flush()
+    return shuffled
+
+
+def iter_shuffled_batches(cooccurrence_file: str, batch_size: int, seed: int, buffer_file: Optional[str] = None,
+                          num_buckets: Optional[int] = None, chunk_records: int = CHUNK_RECORDS) -> Iterator[np.array]:
+    """
+    Yields the records of a co-occurrence file in batches, in the order of shuffle_cooccurrence
+    with the same seed. With a buffer file, the records are shuffled into it first; without one,
+    nothing is written and the buckets are gathered in memory with one pass over the file, which
+    is only allowed up to IN_MEMORY_SHUFFLE_RECORDS records.
+    :param cooccurrence_file: location of cooccurrence.bin
+    :param batch_size: number of records per batch (the last batch may be smaller)
+    :param seed: random seed of the shuffle
+    :param buffer_file: location of a (reusable) buffer of the shuffled records, if any
+    :param num_buckets: number of buckets, so that a bucket is about chunk_records records if None
+    :param chunk_records: number of records streamed at a time
+    :return: iterator over structured arrays of CREC records
+    """
+    if buffer_file is not None:
+        shuffled = shuffle_cooccurrence(
+            cooccurrence_file=cooccurrence_file, buffer_file=buffer_file, seed=seed, num_buckets=num_buckets,
+            chunk_records=chunk_records)
+        for start in range(0, len(shuffled), batch_size):
+            yield np.asarray(shuffled[start:start + batch_size])
+        return
+
+    records = load_cooccurrence(cooccurrence_file=cooccurrence_file)
+    if len(records) > IN_MEMORY_SHUFFLE_RECORDS:
+        raise Exception(f'[ERROR] {cooccurrence_file} has {len(records)} records, more than can be shuffled in '
+                        f'memory ({IN_MEMORY_SHUFFLE_RECORDS}): give a buffer_file')
+    num_buckets = _shuffle_num_buckets(records=records, num_buckets=num_buckets, chunk_records=chunk_records)
+
+    # Every chunk split into its buckets, in one pass
+    bucket_parts = [[] for _ in range(num_buckets)]
+    for chunk, buckets in zip(
+            _iter_chunks(records=records, chunk_records=chunk_records),
+            _shuffle_buckets(records=records, seed=seed, num_buckets=num_buckets, chunk_records=chunk_records)):
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(buckets, minlength=num_buckets))])
+        chunk = chunk[order]
+        for b in np.flatnonzero(np.diff(bounds)):
+            bucket_parts[b].append(chunk[bounds[b]:bounds[b + 1]])
+
+    pending = np.zeros(0, dtype=CREC_DTYPE)
+    for b in range(num_buckets):
+        bucket = np.concatenate([np.zeros(0, dtype=CREC_DTYPE)] + bucket_parts[b])
+        bucket_parts[b] = None
+        pending = np.concatenate([pending, np.random.default_rng([seed, 1, b]).permutation(bucket)])
+        while len(pending) >= batch_size:
+            yield pending[:batch_size]
+            pending = pending[batch_size:]
+    if len(pending) > 0:
+        yield pending
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build vocab.txt and cooccurrence.bin of a corpus')
+    build_parser.add_argument('--corpus_file', required=True, help='Corpus with one document per line')
+    build_parser.add_argument('--out_path', required=True)
+    build_parser.add_argument('--min_count', required=False, type=int, default=VOCAB_MIN_COUNT)
+    build_parser.add_argument('--window_size', required=False, type=int, default=WINDOW_SIZE)
+    build_parser.add_argument('--num_processes', required=False, type=int, default=4)
+
+    merge_parser = subparsers.add_parser('merge', help='Merge the co-occurrences of several subsets')
+    merge_parser.add_argument('--vector_locs', required=True, nargs='+')
+    merge_parser.add_argument('--out_path', required=True)
+    merge_parser.add_argument('--min_count', required=False, type=int, default=VOCAB_MIN_COUNT)
+
+    prune_parser = subparsers.add_parser('prune', help='Drop the co-occurrences of the words of a subset below a minimum count '
+                                         '(not a rebuild with that min count)')
+    prune_parser.add_argument('--vector_loc', required=True)
+    prune_parser.add_argument('--out_path', required=True)
+    prune_parser.add_argument('--min_count', required=True, type=int)
+
+    shuffle_parser = subparsers.add_parser('shuffle', help='Shuffle a co-occurrence file (as GloVe\'s shuffle)')
+    shuffle_parser.add_argument('--cooccurrence_file', required=True)
+    shuffle_parser.add_argument('--out_file', required=True, help='e.g. cooccurrence.shuf.bin')
+    shuffle_parser.add_argument('--seed', required=False, type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        V, nnz = build_cooccurrence(
+            corpus_file=args.corpus_file, out_path=args.out_path, min_count=args.min_count,
+            window_size=args.window_size, num_processes=args.num_processes)
+        print(f'[INFO] Wrote {V} words and {nnz} co-occurrence records to {args.out_path}')
+    elif args.command == 'merge':
+        V, nnz = merge_cooccurrence(vector_locs=args.vector_locs, out_path=args.out_path, min_count=args.min_count)
+        print(f'[INFO] Wrote {V} words and {nnz} co-occurrence records to {args.out_path}')
+    elif args.command == 'prune':
+        V, nnz = prune_cooccurrence(vector_loc=args.vector_loc, out_path=args.out_path, min_count=args.min_count)
+        print(f'[INFO] Wrote {V} words and {nnz} co-occurrence records to {args.out_path}')
+    else:
+        shuffled = shuffle_cooccurrence(
+            cooccurrence_file=args.cooccurrence_file, buffer_file=args.out_file, seed=args.seed)
+        print(f'[INFO] Wrote {len(shuffled)} shuffled co-occurrence records to {args.out_file}')
@@ -0,0 +1,243 @@
+"""
+Content-addressed cache of corpus subsets. The artifacts of a subset (consolidated text,
+vocab.txt, cooccurrence.bin and, with the GloVe binaries, vectors.txt) are stored under a hash
+of its sorted document ids and the parameters they were built with, so a changed document list
+or parameter gets its own entry instead of silently reusing a stale one. Named links point to
+the entry currently used for a name (e.g. coha_1920_1929_excChuChu).
+
+Also plans a sweep over every COHA decade (plus exclusions of some documents from a decade) and
+builds the entries missing from the cache in parallel. An exclusion is built from the texts like
+any other subset: it cannot be derived from its decade's artifacts, as words that fall below the
+minimum count leave the vocabulary and so change the co-occurrence windows of every document.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional
+
+import coha_utils
+import cooccur_utils
+from setup import generate_subset
+
+COOCCUR_BACKENDS = ('glove', 'python')
+
+# Variables of run_glove.sh that change the artifacts it builds
+GLOVE_PARAMETERS = ('VOCAB_MIN_COUNT', 'WINDOW_SIZE', 'VECTOR_SIZE', 'MAX_ITER', 'X_MAX', 'BINARY', 'MODEL')
+
+MANIFEST_FILE = 'manifest.json'
+NAMES_DIR = 'named'
+
+
+def glove_script() -> str:
+    # run_glove.sh as setup.generate_subset runs it (from the PATH), or the copy next to this module
+    return shutil.which('run_glove.sh') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_glove.sh')
+
+
+def corpus_parameters(cooccur_backend: str = 'glove') -> Dict:
+    """
+    Parameters the artifacts of a subset are built with: read from run_glove.sh for the GloVe
+    backend, and the defaults of cooccur_utils for the python backend.
+    :param cooccur_backend: (str) one of COOCCUR_BACKENDS
+    :return: (dict) of parameters by (lowercase) name
+    """
+    assert cooccur_backend in COOCCUR_BACKENDS, f'[ERROR] Unknown backend {cooccur_backend}'
+    if cooccur_backend == 'python':
+        return {'vocab_min_count': cooccur_utils.VOCAB_MIN_COUNT, 'window_size': cooccur_utils.WINDOW_SIZE}
+
+    with open(glove_script(), 'r') as f:
+        variables = dict(re.findall(r'^([A-Z_]+)=(\S*)\s*$', f.read(), flags=re.MULTILINE))
+    missing = [name for name in GLOVE_PARAMETERS if name not in variables]
+    if len(missing) > 0:
+        raise Exception(f'[ERROR] {glove_script()} does not set {missing}')
+    return {name.lower(): variables[name] for name in GLOVE_PARAMETERS}
+
+
+def subset_key(documents: Iterable[str], cooccur_backend: str = 'glove') -> str:
+    """
+    Cache key of a subset: sha256 of its sorted document ids and build parameters.
+    :param documents: (iterable) of COHA document ids
+    :param cooccur_backend: (str) glove or python (see setup.generate_subset)
+    :return: (str) hex digest
+    """
+    content = json.dumps({
+        'documents': sorted(set(str(d) for d in documents)),
+        'backend': cooccur_backend,
+        'parameters': corpus_parameters(cooccur_backend=cooccur_backend)}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def cached_subset(cache_dir: str, key: str) -> Optional[str]:
+    """
+    :return: the directory of a complete cache entry, or None
+    """
+    entry = os.path.join(cache_dir, key)
+    return entry if os.path.exists(os.path.join(entry, MANIFEST_FILE)) else None
+
+
+def link_name(cache_dir: str, name: str, key: str):
+    # Atomically point {cache_dir}/named/{name} to the entry
+    os.makedirs(os.path.join(cache_dir, NAMES_DIR), exist_ok=True)
+    link = os.path.join(cache_dir, NAMES_DIR, name)
+    tmp_link = f'{link}.{os.getpid()}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join('..', key), tmp_link)
+    os.replace(tmp_link, link)
+
+
+def get_or_build_subset(documents: List[str], cache_dir: str, individual_path: str, name: Optional[str] = None,
+                        cooccur_backend: str = 'glove', num_processes: int = 4) -> str:
+    """
+    Returns the cache entry of a subset, building it (with setup.generate_subset) if missing.
+    Entries are built in a private directory and renamed into place, so concurrent builders
+    of the same subset never see partial entries.
+    :param documents: (list) of COHA document ids
+    :param cache_dir: directory of the cache
+    :param individual_path: Location of the individual, pre-processed COHA documents
+    :param name: optional name linked to the entry
+    :param cooccur_backend: (str) glove or python
+    :param num_processes:
+    :return: directory of the entry
+    """
+    key = subset_key(documents=documents, cooccur_backend=cooccur_backend)
+    entry = cached_subset(cache_dir=cache_dir, key=key)
+
+    if entry is None:
+        tmp_entry = os.path.join(cache_dir, f'{key}.{os.getpid()}.{time.time_ns()}.tmp')
+        try:
+            stats = generate_subset(
+                documents=documents, out_path=tmp_entry, individual_path=individual_path, individual_mode='skip',
+                cooccur_backend=cooccur_backend, num_processes=num_processes)
+            with open(os.path.join(tmp_entry, MANIFEST_FILE), 'w') as f:
+                json.dump({
+                    'key': key, 'name': name, 'backend': cooccur_backend,
+                    'parameters': corpus_parameters(cooccur_backend=cooccur_backend),
+                    'documents': sorted(set(str(d) for d in documents)), 'stats': stats, 'created': time.time()}, f)
+            try:
+                os.rename(tmp_entry, os.path.join(cache_dir, key))
+            except OSError:
+                # Built concurrently by another process
+                if cached_subset(cache_dir=cache_dir, key=key) is None:
+                    raise
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        entry = os.path.join(cache_dir, key)
+    else:
+        print(f'[INFO] Reusing cached subset {name or ""} ({key[:12]})')
+
+    if name is not None:
+        link_name(cache_dir=cache_dir, name=name, key=key)
+    return entry
+
+
+def plan_decade_sweep(metadata_loc: str, start_year: int = 1810, end_year: int = 2009,
+                      exclusions: Optional[Dict[str, List[str]]] = None,
+                      cooccur_backend: str = 'glove') -> Dict[str, Dict]:
+    """
+    Plans the subsets of every decade between start_year and end_year, plus exclusions of
+    documents from some decades (planned from the decade's documents).
+    :param metadata_loc: Location of the COHA metadata json
+    :param start_year:
+    :param end_year: inclusive
+    :param exclusions: (dict) of document ids to exclude, by decade name (e.g. {'1920_1929': ['3526']})
+    :param cooccur_backend: (str) glove or python
+    :return: (dict) of nodes by name, each with documents and key
+    """
+    index = coha_utils.load_metadata_index(loc_dir=metadata_loc)
+    plan = {}
+    for decade_start in range(start_year - start_year % 10, end_year + 1, 10):
+        decade_end = min(decade_start + 9, end_year)
+        documents = coha_utils.query_metadata_index(
+            index=index, start_year=max(decade_start, start_year), end_year=decade_end)
+        plan[f'coha_{decade_start}_{decade_end}'] = {
+            'documents': documents, 'key': subset_key(documents=documents, cooccur_backend=cooccur_backend)}
+
+    for decade, excluded in (exclusions or {}).items():
+        base = f'coha_{decade}'
+        assert base in plan, f'[ERROR] Unknown decade {decade} for an exclusion'
+        excluded = set(str(d) for d in excluded)
+        documents = [d for d in plan[base]['documents'] if d not in excluded]
+        plan[f'{base}_exc{"_".join(sorted(excluded))}'] = {
+            'documents': documents, 'key': subset_key(documents=documents, cooccur_backend=cooccur_backend)}
+
+    return plan
+
+
+def build_plan(plan: Dict[str, Dict], cache_dir: str, individual_path: str, cooccur_backend: str = 'glove',
+               num_parallel: int = 2, num_processes: int = 4) -> Dict[str, str]:
+    """
+    Builds the nodes of a plan missing from the cache, num_parallel at a time. Nodes with the
+    same key (e.g. an exclusion of documents outside its decade) are built once.
+    :param plan: (dict) as returned by plan_decade_sweep
+    :param cache_dir: directory of the cache
+    :param individual_path: Location of the individual, pre-processed COHA documents
+    :param cooccur_backend: (str) glove or python
+    :param num_parallel: number of subsets built at the same time
+    :param num_processes: processes of each build (python backend)
+    :return: (dict) of cache entries by node name
+    """
+    entries = {}
+    remaining = dict(plan)
+    building = {}
+    keys_building = set()
+    with ProcessPoolExecutor(max_workers=num_parallel) as executor:
+        while remaining or building:
+            for name, node in list(remaining.items()):
+                if len(building) >= num_parallel:
+                    break
+                if node['key'] in keys_building:
+                    continue
+                del remaining[name]
+                keys_building.add(node['key'])
+                building[executor.submit(
+                    get_or_build_subset, documents=node['documents'], cache_dir=cache_dir,
+                    individual_path=individual_path, name=name, cooccur_backend=cooccur_backend,
+                    num_processes=num_processes)] = name
+
+            done, _ = wait(list(building), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = building.pop(future)
+                entries[name] = future.result()
+                keys_building.discard(plan[name]['key'])
+                print(f'[INFO] {name}: {entries[name]}')
+    return entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', required=True)
+    parser.add_argument('--coha_individual_path', required=True)
+    parser.add_argument('--coha_metadata_loc', required=True)
+    parser.add_argument('--start_year', required=False, type=int, default=1810)
+    parser.add_argument('--end_year', required=False, type=int, default=2009)
+    parser.add_argument('--exclude', required=False, nargs='+', default=[],
+                        help='Exclusions as decade:doc_id[,doc_id...], e.g. 1920_1929:3526')
+    parser.add_argument('--cooccur_backend', required=False, default='glove', choices=list(COOCCUR_BACKENDS))
+    parser.add_argument('--num_parallel', required=False, type=int, default=2)
+    parser.add_argument('--num_processes', required=False, type=int, default=4)
+    parser.add_argument('--dry_run', action='store_true', help='Only print the plan and what is cached')
+
+    args = parser.parse_args()
+    exclusions = {}
+    for exclusion in args.exclude:
+        decade, doc_ids = exclusion.split(':')
+        exclusions.setdefault(decade, []).extend(doc_ids.split(','))
+
+    plan = plan_decade_sweep(
+        metadata_loc=args.coha_metadata_loc, start_year=args.start_year, end_year=args.end_year,
+        exclusions=exclusions, cooccur_backend=args.cooccur_backend)
+    if args.dry_run:
+        for name, node in plan.items():
+            cached = cached_subset(cache_dir=args.cache_dir, key=node['key']) is not None
+            print(f'[INFO] {name}: {len(node["documents"])} documents, {node["key"][:12]} '
+                  f'{"cached" if cached else "missing"}')
+    else:
+        build_plan(
+            plan=plan, cache_dir=args.cache_dir, individual_path=args.coha_individual_path,
+            cooccur_backend=args.cooccur_backend, num_parallel=args.num_parallel, num_processes=args.num_processes)
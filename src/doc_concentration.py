@@ -4,11 +4,15 @@ Computes statistics on the frequency of terms in COHA and their distribution acr
 
 import argparse
 import os
-from typing import Tuple, Dict
+from multiprocessing import Pool
+from typing import Tuple, Dict, Iterable, List
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from tqdm import tqdm
 
 import coha_utils
+import token_store
 
 
 def doc2vocab(file, vocab):
@@ -16,12 +20,124 @@ def doc2vocab(file, vocab):
         lines = fp.readlines()
         assert len(lines) == 1
 
-    doc_words = lines[0].split()
-    doc_vocab = [w for w in doc_words if w in vocab]
-    doc_vocab = list(set(doc_vocab))
+    doc_vocab = list({w for w in lines[0].split() if w in vocab})
     return doc_vocab
 
 
+def _count_terms(shard: Tuple[List[str], str]) -> Tuple[List[str], List[str], np.array, np.array, np.array]:
+    # Term counts of a chunk of documents, over a vocabulary local to the chunk
+    documents, individual_path = shard
+    local_vocab = {}
+    doc_ids, indptr, indices, counts = [], [0], [], []
+    for doc_id in documents:
+        try:
+            with open(f'{individual_path}/coha_{doc_id}.txt', encoding='latin-1') as fp:
+                doc_words = fp.read().split()
+        except FileNotFoundError:
+            continue
+        doc_terms, doc_counts = np.unique(
+            np.array([local_vocab.setdefault(w, len(local_vocab)) for w in doc_words], dtype=np.int64),
+            return_counts=True)
+        doc_ids.append(doc_id)
+        indices.append(doc_terms)
+        counts.append(doc_counts)
+        indptr.append(indptr[-1] + len(doc_terms))
+
+    empty = np.zeros(0, dtype=np.int64)
+    return (list(local_vocab), doc_ids, np.array(indptr, dtype=np.int64),
+            np.concatenate(indices) if indices else empty, np.concatenate(counts) if counts else empty)
+
+
+def build_doc_term_index(individual_path: str, metadata_loc: str, index_dir: str,
+                         num_processes: int = 4, docs_per_shard: int = 500):
+    """
+    One-time pass over all COHA documents that saves a sparse CSR document x term count
+    matrix, with rows sorted by year, together with the document ids, years and vocabulary.
+    Documents are tokenized as in doc2vocab, in parallel chunks.
+    :param individual_path: Location of the individual, pre-processed COHA documents
+    :param metadata_loc: Location of the COHA metadata json
+    :param index_dir: output directory
+    :param num_processes:
+    :param docs_per_shard: number of documents handed to a worker at a time
+    :return:
+    """
+    metadata = coha_utils.load_coha_metadata(loc_dir=metadata_loc)
+    metadata['year'] = metadata['year'].astype(int)
+    metadata = metadata.sort_values('year', kind='stable')
+    documents = metadata.index.tolist()
+    years = dict(zip(documents, metadata['year']))
+
+    shards = [(documents[i:i + docs_per_shard], individual_path) for i in range(0, len(documents), docs_per_shard)]
+    vocab = {}
+    doc_ids, indptr, indices, counts = [], [np.zeros(1, dtype=np.int64)], [], []
+    nnz = 0
+    with Pool(processes=num_processes) as p:
+        # imap keeps the (year) order of the documents
+        for local_vocab, shard_docs, shard_indptr, shard_indices, shard_counts in tqdm(
+                p.imap(_count_terms, shards), total=len(shards), desc='Indexing documents'):
+            local_to_global = np.array([vocab.setdefault(w, len(vocab)) for w in local_vocab], dtype=np.int64)
+            doc_ids.extend(shard_docs)
+            indptr.append(shard_indptr[1:] + nnz)
+            indices.append(local_to_global[shard_indices])
+            counts.append(shard_counts)
+            nnz += len(shard_indices)
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(counts).astype(np.int32), np.concatenate(indices), np.concatenate(indptr)),
+        shape=(len(doc_ids), len(vocab)))
+    matrix.sort_indices()
+
+    os.makedirs(index_dir, exist_ok=True)
+    sparse.save_npz(os.path.join(index_dir, 'doc_term.npz'), matrix)
+    np.save(os.path.join(index_dir, 'doc_ids.npy'), np.array(doc_ids, dtype=str))
+    np.save(os.path.join(index_dir, 'years.npy'), np.array([years[d] for d in doc_ids], dtype=np.int32))
+    with open(os.path.join(index_dir, 'vocab.txt'), 'w', encoding='latin-1') as f:
+        for w in vocab:
+            f.write(f'{w}\n')
+
+
+def load_doc_term_index(index_dir: str) -> Dict:
+    """
+    Loads an index written by build_doc_term_index.
+    :param index_dir:
+    :return: (dict) with the matrix, doc_ids, years (sorted), vocab (word-to-column) entries
+    """
+    with open(os.path.join(index_dir, 'vocab.txt'), encoding='latin-1') as f:
+        words = [w.rstrip('\n') for w in f]
+    index = {
+        'matrix': sparse.load_npz(os.path.join(index_dir, 'doc_term.npz')).tocsr(),
+        'doc_ids': np.load(os.path.join(index_dir, 'doc_ids.npy')),
+        'years': np.load(os.path.join(index_dir, 'years.npy')),
+        'vocab': {w: i for i, w in enumerate(words)}}
+    return index
+
+
+def term_document_stats(index: Dict, start_year: int, end_year: int,
+                        words: Iterable[str]) -> Tuple[np.array, np.array]:
+    """
+    Document frequencies and term frequencies of words over the documents of a year range
+    (inclusive), as column sums over the matching row slice of the index.
+    :param index: (dict) as returned by load_doc_term_index
+    :param start_year:
+    :param end_year:
+    :param words: (iterable of str) words to report, 0 for words not in the index
+    :return: (document frequencies, term frequencies) arrays aligned with words
+    """
+    lo = np.searchsorted(index['years'], int(start_year), side='left')
+    hi = np.searchsorted(index['years'], int(end_year), side='right')
+    rows = index['matrix'][lo:hi]
+
+    words = list(words)
+    cols = np.array([index['vocab'].get(w, -1) for w in words], dtype=np.int64)
+    found = cols >= 0
+    doc_freqs = np.zeros(len(words), dtype=np.int64)
+    term_freqs = np.zeros(len(words), dtype=np.int64)
+    sub = rows[:, cols[found]]
+    doc_freqs[found] = sub.getnnz(axis=0)
+    term_freqs[found] = np.asarray(sub.sum(axis=0)).ravel()
+    return doc_freqs, term_freqs
+
+
 def load_vocab(glove_dir: str, run_name: str) -> Tuple[Dict[str, int], Dict[int, str]]:
     """
     Loads dictionaries of word-to-index and index-to-word vocabulary conversions.
@@ -50,15 +166,33 @@ def main(args):
         glove_dir=os.path.join(args.vocab_base_dir, f'coha_{args.subset}'), run_name='')
     V = len(vocab)
 
-    unique_dict = {word: 0 for word in vocab.keys()}
-    for doc_id in tqdm(documents, desc='Computing number of unique docs'):
-        try:
-            doc_vocab = doc2vocab(
-                file=f'{args.coha_individual_path}/coha_{doc_id}.txt', vocab=vocab)
-            for w in doc_vocab:
-                unique_dict[w] += 1
-        except FileNotFoundError:
-            continue
+    if args.token_store is not None:
+        # Document-term counts sliced from the pre-tokenized corpus (GloVe tokenization)
+        store = token_store.load_token_store(store_dir=args.token_store)
+        index = token_store.doc_term_index(
+            store=store, rows=token_store.period_rows(store=store, start_year=start_year, end_year=end_year))
+        doc_freqs, _ = term_document_stats(index=index, start_year=start_year, end_year=end_year, words=vocab.keys())
+        unique_dict = dict(zip(vocab.keys(), doc_freqs.tolist()))
+    elif args.index_dir is not None:
+        # Use (or build once) the document-term index
+        if not os.path.exists(os.path.join(args.index_dir, 'doc_term.npz')):
+            print('[INFO] Building document-term index')
+            build_doc_term_index(
+                individual_path=args.coha_individual_path, metadata_loc=args.coha_metadata_loc,
+                index_dir=args.index_dir, num_processes=args.num_processes)
+        index = load_doc_term_index(index_dir=args.index_dir)
+        doc_freqs, _ = term_document_stats(index=index, start_year=start_year, end_year=end_year, words=vocab.keys())
+        unique_dict = dict(zip(vocab.keys(), doc_freqs.tolist()))
+    else:
+        unique_dict = {word: 0 for word in vocab.keys()}
+        for doc_id in tqdm(documents, desc='Computing number of unique docs'):
+            try:
+                doc_vocab = doc2vocab(
+                    file=f'{args.coha_individual_path}/coha_{doc_id}.txt', vocab=vocab)
+                for w in doc_vocab:
+                    unique_dict[w] += 1
+            except FileNotFoundError:
+                continue
 
     print('[INFO] Computing word frequencies')
     with open(f'{args.vocab_base_dir}/coha_{args.subset}/vocab.txt', 'r') as f:
@@ -88,6 +222,9 @@ if __name__ == '__main__':
     parser.add_argument('--coha_metadata_loc', required=True)
     parser.add_argument('--vocab_base_dir', required=True)
     parser.add_argument('--subset', required=True, type=str, choices=['1900_1912', '1920_1930', '1800_2010'])
+    parser.add_argument('--index_dir', required=False, help='Location of the document-term index (built if missing)')
+    parser.add_argument('--num_processes', required=False, type=int, default=4)
+    parser.add_argument('--token_store', required=False, help='Location of a token_store, used instead of the texts')
 
     args = parser.parse_args()
     main(args)
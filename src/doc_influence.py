@@ -0,0 +1,287 @@
+"""
+Stores the co-occurrence contribution of every document in a period, so that excluding
+documents is a sparse subtraction from the period total instead of a corpus rebuild, and
+screens every document of a period by its share of the co-occurrences between the words of a
+bias query. The share is a heuristic for choosing documents to exclude, not the leave-one-out
+change of the bias score, which needs a model trained without the document (e.g. from
+write_excluded_subset, as ChuChu does for Chu Chu)
+"""
+
+import argparse
+import os
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from tqdm import tqdm
+
+import cooccur_utils
+
+
+def _document_contributions(
+        shard: Tuple[List[str], str, Dict[bytes, int], int]) -> List[Tuple[str, np.array, np.array, np.array]]:
+    documents, individual_path, word_idx, window_size = shard
+    V = len(word_idx)
+    contributions = []
+    for doc_id in documents:
+        try:
+            with open(f'{individual_path}/coha_{doc_id}.txt', 'rb') as f:
+                text = f.read()
+        except FileNotFoundError:
+            continue
+
+        # Windows do not cross newlines, as in the consolidated corpus
+        w1, w2, val = [], [], []
+        for line in text.split(b'\n'):
+            word_ids = np.array([word_idx[w] for w in cooccur_utils.tokenize(line) if w in word_idx], dtype=np.int64)
+            line_w1, line_w2, line_val = cooccur_utils.document_cooccurrence(word_ids=word_ids, window_size=window_size)
+            w1.append(line_w1)
+            w2.append(line_w2)
+            val.append(line_val)
+        matrix = sparse.coo_matrix(
+            (np.concatenate(val), (np.concatenate(w1), np.concatenate(w2))), shape=(V, V)).tocsr().tocoo()
+        contributions.append((doc_id, matrix.row.astype(np.int32), matrix.col.astype(np.int32), matrix.data))
+    return contributions
+
+
+def build_document_store(documents: List[str], individual_path: str, vocab_file: str, store_dir: str,
+                         window_size: int = cooccur_utils.WINDOW_SIZE, num_processes: int = 4,
+                         docs_per_shard: int = 200):
+    """
+    Computes and saves the sparse co-occurrence contribution of each document, using the
+    vocabulary of the period. The contributions sum to the period's cooccurrence.bin.
+
+    The store is a directory of .npy files holding the document ids, the concatenated
+    (word1, word2, val) entries of all documents (0-based word ids), the offsets of each
+    document's entries and the vocabulary size.
+    :param documents: (list) of COHA document ids of the period
+    :param individual_path: Location of the individual, pre-processed COHA documents
+    :param vocab_file: vocab.txt of the period
+    :param store_dir: output directory of the store
+    :param window_size:
+    :param num_processes:
+    :param docs_per_shard: number of documents handed to a worker at a time
+    :return:
+    """
+    vocab = cooccur_utils.load_vocab_counts(vocab_file=vocab_file)
+    word_idx = {w: i for i, (w, _) in enumerate(vocab)}
+    shards = [(documents[i:i + docs_per_shard], individual_path, word_idx, window_size)
+              for i in range(0, len(documents), docs_per_shard)]
+
+    doc_ids, word1, word2, val = [], [], [], []
+    with Pool(processes=num_processes) as p:
+        # imap keeps the document order
+        for contributions in tqdm(p.imap(_document_contributions, shards), total=len(shards),
+                                  desc='Computing document contributions'):
+            for doc_id, w1, w2, v in contributions:
+                doc_ids.append(doc_id)
+                word1.append(w1)
+                word2.append(w2)
+                val.append(v)
+
+    offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in val])
+    store = {
+        'doc_ids': np.array(doc_ids, dtype=str), 'offsets': offsets, 'vocab_size': np.array([len(vocab)]),
+        'word1': np.concatenate(word1) if word1 else np.zeros(0, dtype=np.int32),
+        'word2': np.concatenate(word2) if word2 else np.zeros(0, dtype=np.int32),
+        'val': np.concatenate(val) if val else np.zeros(0)}
+    os.makedirs(store_dir, exist_ok=True)
+    for name, array in store.items():
+        np.save(os.path.join(store_dir, f'{name}.npy'), array)
+
+
+def load_document_store(store_dir: str) -> Dict[str, np.array]:
+    """
+    Loads a store written by build_document_store, memory-mapping the entry arrays.
+    :param store_dir: directory of the store
+    :return: (dict) with doc_ids, offsets, word1, word2, val, vocab_size and doc_idx entries
+    """
+    store = {name: np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode='r')
+             for name in ('word1', 'word2', 'val')}
+    store['doc_ids'] = np.load(os.path.join(store_dir, 'doc_ids.npy'))
+    store['offsets'] = np.load(os.path.join(store_dir, 'offsets.npy'))
+    store['vocab_size'] = int(np.load(os.path.join(store_dir, 'vocab_size.npy'))[0])
+    store['doc_idx'] = {d: i for i, d in enumerate(store['doc_ids'])}
+    return store
+
+
+def entry_documents(store: Dict[str, np.array]) -> np.array:
+    """
+    Returns the row of doc_ids of every stored entry.
+    """
+    return np.repeat(np.arange(len(store['doc_ids'])), np.diff(store['offsets']))
+
+
+def weighted_cooccurrence(store: Dict[str, np.array], weights: np.array) -> sparse.csr_matrix:
+    """
+    Sums the document contributions weighted by one weight per document.
+    :param store: (dict) as returned by load_document_store
+    :param weights: (np.array) of one weight per document in store['doc_ids']
+    :return: (V, V) co-occurrence matrix over 0-based word ids
+    """
+    V = store['vocab_size']
+    entry_weights = np.repeat(np.asarray(weights, dtype=np.float64), np.diff(store['offsets']))
+    keep = entry_weights != 0
+    return sparse.coo_matrix(
+        (store['val'][keep] * entry_weights[keep], (store['word1'][keep], store['word2'][keep])),
+        shape=(V, V)).tocsr()
+
+
+def resample_cooccurrence(store: Dict[str, np.array], seed: int) -> Tuple[sparse.csr_matrix, np.array]:
+    """
+    Co-occurrence matrix of a document bootstrap replicate: documents are drawn with
+    replacement, and the replicate is the multiplicity-weighted sum of their contributions.
+    :param store: (dict) as returned by load_document_store
+    :param seed: random seed of the replicate
+    :return: (V, V) co-occurrence matrix over 0-based word ids, and the multiplicity of each document
+    """
+    rng = np.random.default_rng(seed)
+    N = len(store['doc_ids'])
+    multiplicities = rng.multinomial(N, np.full(N, 1 / N))
+    return weighted_cooccurrence(store=store, weights=multiplicities), multiplicities
+
+
+def document_cooccurrence_matrix(store: Dict[str, np.array], documents: Iterable[str]) -> sparse.csr_matrix:
+    """
+    Sums the contributions of a set of documents, reading only their entries.
+    """
+    V = store['vocab_size']
+    offsets = store['offsets']
+    slices = []
+    for doc_id in documents:
+        if doc_id not in store['doc_idx']:
+            print(f'[WARNING] Document {doc_id} not in the store')
+            continue
+        i = store['doc_idx'][doc_id]
+        slices.append(slice(offsets[i], offsets[i + 1]))
+    if len(slices) == 0:
+        return sparse.csr_matrix((V, V))
+    return sparse.coo_matrix(
+        (np.concatenate([store['val'][s] for s in slices]),
+         (np.concatenate([store['word1'][s] for s in slices]), np.concatenate([store['word2'][s] for s in slices]))),
+        shape=(V, V)).tocsr()
+
+
+def exclude_documents(store: Dict[str, np.array], total: sparse.csr_matrix,
+                      documents: Iterable[str]) -> sparse.csr_matrix:
+    """
+    Co-occurrence matrix of the period without a set of documents, as a sparse subtraction
+    of their contributions from the period total. The vocabulary of the period is kept, so
+    the result is comparable with models trained on the full period.
+    :param store: (dict) as returned by load_document_store
+    :param total: (V, V) co-occurrence matrix of the full period
+    :param documents: (iterable) of document ids to exclude
+    :return: (V, V) co-occurrence matrix over 0-based word ids
+    """
+    excluded = total - document_cooccurrence_matrix(store=store, documents=documents)
+    # Remove entries that only the excluded documents contributed (up to rounding)
+    excluded.data[np.abs(excluded.data) < 1e-9] = 0
+    excluded.eliminate_zeros()
+    return excluded
+
+
+def period_cooccurrence(store: Dict[str, np.array]) -> sparse.csr_matrix:
+    """
+    Co-occurrence matrix of the full period, as the sum of all document contributions.
+    """
+    return weighted_cooccurrence(store=store, weights=np.ones(len(store['doc_ids'])))
+
+
+def write_excluded_subset(store: Dict[str, np.array], vocab_file: str, documents: Iterable[str], out_path: str,
+                          total: sparse.csr_matrix = None):
+    """
+    Writes vocab.txt and cooccurrence.bin for the period without a set of documents, ready
+    for training (see ChuChu.run_iteration).
+    :param store: (dict) as returned by load_document_store
+    :param vocab_file: vocab.txt of the period (copied unchanged)
+    :param documents: (iterable) of document ids to exclude
+    :param out_path: output directory
+    :param total: (V, V) co-occurrence matrix of the full period, summed from the store if None
+    :return:
+    """
+    os.makedirs(out_path, exist_ok=True)
+    total = period_cooccurrence(store=store) if total is None else total
+    excluded = exclude_documents(store=store, total=total, documents=documents)
+    cooccur_utils.write_cooccurrence(matrix=excluded, cooccurrence_file=os.path.join(out_path, 'cooccurrence.bin'))
+    cooccur_utils.write_vocab(
+        vocab=cooccur_utils.load_vocab_counts(vocab_file=vocab_file), vocab_file=os.path.join(out_path, 'vocab.txt'))
+
+
+def cooccurrence_share_report(store: Dict[str, np.array], vocab_file: str,
+                              bias_query: Dict[str, List[str]]) -> pd.DataFrame:
+    """
+    Ranks every document of the period by its share of the co-occurrence mass between the
+    target (TA, TB) and attribute (A) words of a bias query, i.e. by how much removing it
+    changes the co-occurrence counts the bias score depends on. This is a heuristic screen:
+    the bias score is not recomputed, so a high share does not mean that the score changes
+    without the document.
+    :param store: (dict) as returned by load_document_store
+    :param vocab_file: vocab.txt of the period
+    :param bias_query: (dict) of word lists for each part of the bias query (TA, TB, A)
+    :return: (pd.DataFrame) with one row per document, sorted by decreasing cooccurrence_share (the
+    larger of TA_A_share and TB_A_share)
+    """
+    vocab = cooccur_utils.load_vocab_counts(vocab_file=vocab_file)
+    word_idx = {w.decode('utf-8', errors='replace'): i for i, (w, _) in enumerate(vocab)}
+    V = store['vocab_size']
+
+    # Word set membership of every vocabulary row
+    in_set = {}
+    for word_set in ('TA', 'TB', 'A'):
+        in_set[word_set] = np.zeros(V, dtype=bool)
+        in_set[word_set][[word_idx[w] for w in bias_query[word_set] if w in word_idx]] = True
+
+    docs = entry_documents(store=store)
+    w1, w2, val = store['word1'], store['word2'], store['val']
+    N = len(store['doc_ids'])
+
+    report = pd.DataFrame({'doc_id': store['doc_ids']})
+    report['total_mass'] = np.bincount(docs, weights=val, minlength=N)
+    for target in ('TA', 'TB'):
+        pair = in_set[target][w1] & in_set['A'][w2]
+        mass = np.bincount(docs[pair], weights=val[pair], minlength=N)
+        report[f'{target}_A_mass'] = mass
+        report[f'{target}_A_share'] = mass / mass.sum() if mass.sum() > 0 else 0.0
+        target_rows = in_set[target][w1]
+        report[f'{target}_mass'] = np.bincount(docs[target_rows], weights=val[target_rows], minlength=N)
+
+    report['cooccurrence_share'] = report[['TA_A_share', 'TB_A_share']].max(axis=1)
+    report = report.sort_values('cooccurrence_share', ascending=False).reset_index(drop=True)
+    return report
+
+
+if __name__ == '__main__':
+    import bias_utils
+    import coha_utils
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--coha_individual_path', required=True)
+    parser.add_argument('--coha_metadata_loc', required=True)
+    parser.add_argument('--vocab_file', required=True, help='vocab.txt of the period')
+    parser.add_argument('--store_dir', required=True)
+    parser.add_argument('--query', required=False, default='PWTW-PC-OW', choices=list(bias_utils.BIAS_QUERIES))
+    parser.add_argument('--start_year', required=True, type=int)
+    parser.add_argument('--end_year', required=True, type=int)
+    parser.add_argument('--num_processes', required=False, type=int, default=4)
+    parser.add_argument('--top', required=False, type=int, default=20)
+    parser.add_argument('--report_file', required=False)
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.store_dir):
+        docs = coha_utils.load_coha_docs_time_subset(
+            loc_dir=args.coha_metadata_loc, start_year=args.start_year, end_year=args.end_year)
+        build_document_store(
+            documents=docs, individual_path=args.coha_individual_path, vocab_file=args.vocab_file,
+            store_dir=args.store_dir, num_processes=args.num_processes)
+
+    report = cooccurrence_share_report(
+        store=load_document_store(store_dir=args.store_dir), vocab_file=args.vocab_file,
+        bias_query=bias_utils.BIAS_QUERIES[args.query])
+    print(f'[INFO] Documents by share of the {args.query} co-occurrences (a heuristic, not the change of the '
+          f'bias score without them):')
+    print(report.head(args.top).to_string())
+    if args.report_file is not None:
+        report.to_csv(args.report_file, index=False)
@@ -0,0 +1,189 @@
+#
+# In-process GloVe trainer. Uses the cost, weighting, gradient clipping and AdaGrad updates of
+# https://github.com/stanfordnlp/GloVe/blob/master/src/glove.c, with optional Hogwild-style
+# parallelism over worker processes that share the parameters (as the GloVe threads do).
+#
+# Unlike glove.c, which updates the parameters after every co-occurrence record, the updates are
+# applied over minibatches: all records of a batch read the parameters and the AdaGrad squared
+# gradient sums as of the start of the batch, and a row that appears in several records of a
+# batch takes the sum of their steps. The squared gradient sums still grow by the squared
+# gradient of every record, as in glove.c. With batch_size=1 the updates are those of a single
+# GloVe thread; larger batches take larger steps on words that are frequent within a batch,
+# especially early in training, so the vectors are not those of a glove.c run with the same
+# seed, and lower batch sizes bring them closer to it.
+#
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from typing import Dict, Optional
+import numpy as np
+
+import cooccur_utils
+import vector_utils
+
+# Defaults from run_glove_partial.sh
+VECTOR_SIZE = 300
+MAX_ITER = 100
+X_MAX = 50
+ALPHA = 0.75
+ETA = 0.05
+BATCH_SIZE = 4096
+# Default of glove.c
+GRAD_CLIP = 100.0
+
+
+def _shared_array(shape: tuple, dtype: type) -> np.array:
+    """
+    Allocates a zeroed array in shared memory, visible to forked worker processes.
+    """
+    dtype = np.dtype(dtype)
+    raw = RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _train_records(params: np.array, gradsq: np.array, cooccurrences: np.array, order: np.array,
+                   start: int, end: int, vocab_size: int, x_max: float, alpha: float, eta: float,
+                   batch_size: int, grad_clip: float, cost: Optional[np.array] = None, slot: int = 0) -> float:
+    """
+    Runs AdaGrad over records order[start:end] in minibatches. params and gradsq have
+    shape (2V, d + 1): word vectors and biases in the first V rows, context vectors and
+    biases in the last V rows.
+    """
+    d = params.shape[1] - 1
+    total_cost = 0.0
+    for b in range(start, end, batch_size):
+        # Sorted indices read the (memory-mapped) records sequentially within a batch
+        batch = cooccurrences[np.sort(order[b:min(b + batch_size, end)])]
+        l1 = batch['word1'].astype(np.int64) - 1
+        l2 = batch['word2'].astype(np.int64) - 1 + vocab_size
+        val = batch['val']
+        B = len(batch)
+
+        w1 = params[l1]
+        w2 = params[l2]
+        diff = np.einsum('ij,ij->i', w1[:, :d], w2[:, :d]) + w1[:, d] + w2[:, d] - np.log(val)
+        fdiff = np.where(val > x_max, diff, np.power(val / x_max, alpha) * diff)
+        total_cost += 0.5 * np.sum(fdiff * diff)
+        fdiff *= eta
+
+        # Gradients of both rows of every record, the vector parts clipped as in glove.c
+        grads = np.empty((2 * B, d + 1))
+        grads[:B, :d] = fdiff[:, None] * w2[:, :d]
+        grads[B:, :d] = fdiff[:, None] * w1[:, :d]
+        np.clip(grads[:, :d], -grad_clip, grad_clip, out=grads[:, :d])
+        grads[:B, d] = fdiff
+        grads[B:, d] = fdiff
+
+        # Sum the steps and the squared gradients of each row over its records in the batch
+        rows = np.concatenate([l1, l2])
+        row_order = np.argsort(rows, kind='stable')
+        rows = rows[row_order]
+        grads = grads[row_order]
+        boundaries = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        rows = rows[boundaries]
+        squares = np.add.reduceat(grads ** 2, boundaries, axis=0)
+        grads = np.add.reduceat(grads, boundaries, axis=0)
+
+        # Adaptive updates
+        params[rows] -= grads / np.sqrt(gradsq[rows])
+        gradsq[rows] += squares
+
+    if cost is not None:
+        cost[slot] = total_cost
+    return total_cost
+
+
+def train_glove(cooccurrences: np.array, vocab_size: int, seed: int, vector_size: int = VECTOR_SIZE,
+                max_iter: int = MAX_ITER, x_max: float = X_MAX, alpha: float = ALPHA, eta: float = ETA,
+                batch_size: int = BATCH_SIZE, grad_clip: float = GRAD_CLIP, num_threads: int = 1,
+                verbose: bool = False) -> Dict[str, np.array]:
+    """
+    Trains GloVe vectors on co-occurrence records, equivalent to the shuffle and glove steps
+    of run_glove_partial.sh. The records are shuffled once with the given seed, which also
+    seeds the parameter initialization.
+
+    With num_threads > 1, worker processes update shared parameters without locking (as the
+    GloVe threads do). This requires the fork start method, and cannot be used from daemonic
+    processes such as multiprocessing.Pool workers.
+    :param cooccurrences: structured array of CREC records (see cooccur_utils.load_cooccurrence)
+    :param vocab_size: number of words in the vocab file used to build the co-occurrences
+    :param seed: random seed for the shuffle and initialization
+    :param vector_size:
+    :param max_iter: number of training epochs
+    :param x_max: cutoff of the weighting function
+    :param alpha: exponent of the weighting function
+    :param eta: initial learning rate
+    :param batch_size: number of records per minibatch update (see the note at the top of the module)
+    :param grad_clip: bound on the absolute value of the vector gradient components
+    :param num_threads: number of worker processes
+    :param verbose: whether to print the cost of each epoch
+    :return: (dict) with W, b_w, U, b_u entries as in vector_utils.load_fulltxt_vectors
+    """
+    rng = np.random.default_rng(seed)
+    N = len(cooccurrences)
+    shape = (2 * vocab_size, vector_size + 1)
+
+    if num_threads > 1:
+        params = _shared_array(shape=shape, dtype=np.float64)
+        gradsq = _shared_array(shape=shape, dtype=np.float64)
+        order = _shared_array(shape=(N,), dtype=np.int64)
+        cost = _shared_array(shape=(num_threads,), dtype=np.float64)
+    else:
+        params = np.empty(shape)
+        gradsq = np.empty(shape)
+        order = np.empty(N, dtype=np.int64)
+        cost = np.zeros(1)
+
+    # Initialization as in glove.c
+    params[:] = (rng.random(shape) - 0.5) / vector_size
+    gradsq[:] = 1.0
+    order[:] = rng.permutation(N)
+
+    kwargs = dict(params=params, gradsq=gradsq, cooccurrences=cooccurrences, order=order,
+                  vocab_size=vocab_size, x_max=x_max, alpha=alpha, eta=eta, batch_size=batch_size,
+                  grad_clip=grad_clip)
+    bounds = np.linspace(0, N, num_threads + 1).astype(np.int64)
+    ctx = multiprocessing.get_context('fork') if num_threads > 1 else None
+
+    for epoch in range(max_iter):
+        if num_threads > 1:
+            workers = [
+                ctx.Process(
+                    target=_train_records,
+                    kwargs=dict(start=bounds[t], end=bounds[t + 1], cost=cost, slot=t, **kwargs))
+                for t in range(num_threads)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            if any(w.exitcode != 0 for w in workers):
+                raise RuntimeError(f'[ERROR] GloVe training worker failed in epoch {epoch + 1}')
+            epoch_cost = cost.sum()
+        else:
+            epoch_cost = _train_records(start=0, end=N, **kwargs)
+
+        if verbose:
+            print(f'[INFO] Epoch {epoch + 1}/{max_iter}, cost: {epoch_cost / max(N, 1)}')
+
+    V, d = vocab_size, vector_size
+    parameter_dict = {
+        'W': np.array(params[:V, :d]), 'b_w': np.array(params[:V, d:]),
+        'U': np.array(params[V:, :d]), 'b_u': np.array(params[V:, d:])}
+    return parameter_dict
+
+
+def train_glove_files(cooccurrence_file: str, vocab_file: str, seed: int, **kwargs) -> Dict:
+    """
+    Trains GloVe vectors from a cooccurrence.bin and vocab.txt pair, reading the
+    co-occurrence records through a memory map.
+    :param cooccurrence_file: location of cooccurrence.bin
+    :param vocab_file: location of vocab.txt
+    :param seed: random seed for the shuffle and initialization
+    :param kwargs: training parameters passed to train_glove
+    :return: (dict) with W, b_w, U, b_u and vocab entries as in vector_utils.load_fulltxt_vectors
+    """
+    vocab = vector_utils.load_vocab_words(vocab_file=vocab_file)
+    cooccurrences = cooccur_utils.load_cooccurrence(cooccurrence_file=cooccurrence_file)
+    parameter_dict = train_glove(cooccurrences=cooccurrences, vocab_size=len(vocab), seed=seed, **kwargs)
+    parameter_dict['vocab'] = vocab
+    return parameter_dict
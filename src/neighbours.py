@@ -0,0 +1,235 @@
+"""
+Nearest-neighbour queries over trained embeddings: the vectors of a model are row-normalized
+once into a float32 matrix, and batched top-k cosine queries run as blocked matrix products
+with argpartition. An optional inverted-file (IVF) index answers approximate queries over
+large vocabularies by searching only the clusters closest to each query. Also reports how
+stable the neighbours of words are across the K models of a bootstrap.
+"""
+
+import argparse
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+
+import vector_utils
+
+# Number of vocabulary rows multiplied at a time
+BLOCK_SIZE = 8192
+
+
+def _top_k(similarities: np.array, ids: np.array, k: int) -> Tuple[np.array, np.array]:
+    # Row-wise top k (unsorted) of a (m, n) similarity block with (m, n) or (n,) ids
+    if similarities.shape[1] <= k:
+        return similarities, np.broadcast_to(ids, similarities.shape)
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    ids = np.take_along_axis(np.broadcast_to(ids, similarities.shape), top, axis=1)
+    return np.take_along_axis(similarities, top, axis=1), ids
+
+
+class NeighbourIndex:
+    def __init__(self, parameter_dict: Dict, variant: str = 'center', block_size: int = BLOCK_SIZE):
+        """
+        :param parameter_dict: (dict) with W, U and vocab entries (see vector_utils)
+        :param variant: (str) one of vector_utils.VECTOR_VARIANTS
+        :param block_size: number of vocabulary rows multiplied at a time
+        """
+        self.vocab = list(parameter_dict['vocab'])
+        self.word_idx = {w: i for i, w in enumerate(self.vocab)}
+        self.block_size = block_size
+
+        # Normalize in blocks, so the float64 variant is never materialized for the full vocabulary
+        V = len(self.vocab)
+        d = parameter_dict['W'].shape[1]
+        self.matrix = np.zeros((V, d), dtype=np.float32)
+        for start in range(0, V, block_size):
+            rows = np.arange(start, min(start + block_size, V))
+            vectors = vector_utils.vector_variant(parameter_dict=parameter_dict, variant=variant, rows=rows)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            self.matrix[rows] = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+        self.centroids = None
+        self.list_offsets = None
+        self.list_rows = None
+
+    def build_ivf(self, n_lists: Optional[int] = None, n_iter: int = 10, sample_size: int = 100000, seed: int = 0):
+        """
+        Builds an inverted-file index: spherical k-means clusters of the normalized vectors,
+        with the rows of every cluster stored contiguously.
+        :param n_lists: number of clusters, about sqrt(V) if None
+        :param n_iter: k-means iterations
+        :param sample_size: number of rows the clusters are trained on
+        :param seed:
+        :return:
+        """
+        rng = np.random.default_rng(seed)
+        V = len(self.vocab)
+        n_lists = n_lists or max(1, int(np.sqrt(V)))
+        sample = self.matrix[rng.choice(V, size=min(sample_size, V), replace=False)]
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = self._nearest_centroid(vectors=sample, centroids=centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids).astype(np.float32)
+
+        assignment = self._nearest_centroid(vectors=self.matrix, centroids=centroids)
+        self.centroids = centroids
+        self.list_rows = np.argsort(assignment, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+
+    def _nearest_centroid(self, vectors: np.array, centroids: np.array) -> np.array:
+        assignment = np.zeros(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), self.block_size):
+            assignment[start:start + self.block_size] = np.argmax(
+                vectors[start:start + self.block_size] @ centroids.T, axis=1)
+        return assignment
+
+    def _rows(self, words: Sequence[str]) -> Tuple[List[str], np.array]:
+        found = [w for w in words if w in self.word_idx]
+        return found, np.array([self.word_idx[w] for w in found], dtype=np.int64)
+
+    def query(self, words: Sequence[str], k: int = 10, n_probe: Optional[int] = None,
+              exclude_self: bool = True) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        Top-k cosine neighbours of words (words missing from the vocabulary are left out).
+        :param words: (list of str) query words
+        :param k: number of neighbours
+        :param n_probe: with an IVF index (build_ivf), search only the n_probe closest clusters
+        of each query (approximate); exact search over all rows if None
+        :param exclude_self: leave the query word out of its neighbours
+        :return: (dict) of (neighbour, similarity) lists by word, most similar first
+        """
+        found, rows = self._rows(words)
+        if len(found) == 0:
+            return {}
+        queries = self.matrix[rows]
+        k_search = k + 1 if exclude_self else k
+
+        if n_probe is None:
+            sims, ids = self._exact(queries=queries, k=k_search)
+        else:
+            assert self.centroids is not None, '[ERROR] Build the IVF index (build_ivf) before approximate queries'
+            sims, ids = self._approximate(queries=queries, k=k_search, n_probe=n_probe)
+
+        neighbours = {}
+        for i, word in enumerate(found):
+            order = np.argsort(-sims[i])
+            ranked = [(self.vocab[ids[i, j]], float(sims[i, j])) for j in order if ids[i, j] >= 0]
+            if exclude_self:
+                ranked = [(w, s) for w, s in ranked if w != word]
+            neighbours[word] = ranked[:k]
+        return neighbours
+
+    def _exact(self, queries: np.array, k: int) -> Tuple[np.array, np.array]:
+        best_sims = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.vocab), self.block_size):
+            block = self.matrix[start:start + self.block_size]
+            sims = np.concatenate([best_sims, queries @ block.T], axis=1)
+            ids = np.concatenate([best_ids, np.broadcast_to(
+                np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+            best_sims, best_ids = _top_k(similarities=sims, ids=ids, k=k)
+        return best_sims, np.ascontiguousarray(best_ids)
+
+    def _approximate(self, queries: np.array, k: int, n_probe: int) -> Tuple[np.array, np.array]:
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([
+                self.list_rows[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes[i]])
+            candidate_sims, candidate_ids = _top_k(
+                similarities=(self.matrix[candidates] @ query)[None, :], ids=candidates, k=k)
+            sims[i, :candidate_sims.shape[1]] = candidate_sims[0]
+            ids[i, :candidate_ids.shape[1]] = candidate_ids[0]
+        return sims, ids
+
+
+def load_kept_models(keep_vectors_dir: str) -> Dict[int, Dict]:
+    """
+    Memory-maps the models saved by ChuChu with --keep_vectors_dir, by iteration.
+    """
+    return {int(name): vector_utils.load_binary_vectors(store_dir=os.path.join(keep_vectors_dir, name))
+            for name in sorted(os.listdir(keep_vectors_dir)) if name.isdigit()}
+
+
+def neighbour_stability(models: List[Dict], words: Sequence[str], k: int = 10,
+                        variant: str = 'center') -> pd.DataFrame:
+    """
+    Stability of the top-k neighbours of words across models (e.g. the K models of a bootstrap):
+    the mean pairwise Jaccard similarity of their neighbour sets, and the neighbours found by
+    most models with the share of models that found them.
+    :param models: (list) of parameter dicts
+    :param words: (list of str) query words
+    :param k: number of neighbours
+    :param variant: (str) one of vector_utils.VECTOR_VARIANTS
+    :return: (pd.DataFrame) with one row per word
+    """
+    neighbour_sets = {w: [] for w in words}
+    for parameter_dict in models:
+        neighbours = NeighbourIndex(parameter_dict=parameter_dict, variant=variant).query(words=words, k=k)
+        for w in words:
+            neighbour_sets[w].append([n for n, _ in neighbours.get(w, [])])
+
+    rows = []
+    for w, sets in neighbour_sets.items():
+        sets = [s for s in sets if len(s) > 0]
+        if len(sets) == 0:
+            rows.append({'word': w, 'models': 0, 'jaccard': np.nan, 'consensus': []})
+            continue
+        # Indicator matrix of (model, neighbour): pairwise intersections in one product
+        names, codes = np.unique(np.concatenate(sets), return_inverse=True)
+        indicator = np.zeros((len(sets), len(names)), dtype=np.float32)
+        indicator[np.repeat(np.arange(len(sets)), [len(s) for s in sets]), codes] = 1
+        intersections = indicator @ indicator.T
+        sizes = indicator.sum(axis=1)
+        jaccard = intersections / (sizes[:, None] + sizes[None, :] - intersections)
+        upper = np.triu_indices(len(sets), k=1)
+        shares = indicator.mean(axis=0)
+        order = np.argsort(-shares, kind='stable')[:k]
+        rows.append({
+            'word': w, 'models': len(sets),
+            'jaccard': float(jaccard[upper].mean()) if len(sets) > 1 else np.nan,
+            'consensus': [(str(names[i]), float(shares[i])) for i in order]})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors_file', required=False, help='vectors.txt (BINARY=0, MODEL=0) of one model')
+    parser.add_argument('--vectors_dir', required=False, help='Binary vector store of one model')
+    parser.add_argument('--keep_vectors_dir', required=False,
+                        help='Models of a bootstrap (ChuChu --keep_vectors_dir), to report neighbour stability')
+    parser.add_argument('--words', required=True, nargs='+')
+    parser.add_argument('--k', required=False, type=int, default=10)
+    parser.add_argument('--variant', required=False, default='center', choices=list(vector_utils.VECTOR_VARIANTS))
+    parser.add_argument('--n_probe', required=False, type=int,
+                        help='Approximate search over the n_probe closest clusters of an IVF index')
+
+    args = parser.parse_args()
+
+    if args.keep_vectors_dir is not None:
+        stability = neighbour_stability(
+            models=list(load_kept_models(keep_vectors_dir=args.keep_vectors_dir).values()),
+            words=args.words, k=args.k, variant=args.variant)
+        for _, row in stability.iterrows():
+            print(f'[INFO] {row["word"]}: mean Jaccard {row["jaccard"]:.3f} over {row["models"]} models')
+            print('    ' + ', '.join(f'{n} ({share:.2f})' for n, share in row['consensus']))
+    else:
+        if args.vectors_file is not None:
+            parameter_dict, _, _ = vector_utils.load_fulltxt_vectors(vectors_file=args.vectors_file)
+        elif args.vectors_dir is not None:
+            parameter_dict = vector_utils.load_binary_vectors(store_dir=args.vectors_dir)
+        else:
+            raise Exception('[ERROR] Give --vectors_file, --vectors_dir or --keep_vectors_dir')
+
+        index = NeighbourIndex(parameter_dict=parameter_dict, variant=args.variant)
+        if args.n_probe is not None:
+            index.build_ivf()
+        for word, neighbours in index.query(words=args.words, k=args.k, n_probe=args.n_probe).items():
+            print(f'[INFO] {word}: ' + ', '.join(f'{n} ({s:.3f})' for n, s in neighbours))
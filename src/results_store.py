@@ -0,0 +1,235 @@
+"""
+Columnar store of bootstrap results, keyed by period, corpus variant, bias query, vector
+variant and seed, with a vectorized summary of every group (mean, sd, percentile and
+skew-adjusted intervals) and a plot of any slice in the style of Figure 1
+"""
+
+import argparse
+import json
+import os
+import uuid
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+from scipy import special
+
+# Columns identifying a result; a summary group is every key column but the seed
+KEY_COLUMNS = ['period', 'corpus', 'query', 'variant', 'seed']
+GROUP_COLUMNS = ['period', 'corpus', 'query', 'variant']
+COLUMN_TYPES = {'period': str, 'corpus': str, 'query': str, 'variant': str, 'seed': np.int64, 'score': np.float64}
+
+
+def append_results(store_dir: str, results: pd.DataFrame):
+    """
+    Appends results to the store as a new parquet part file (written atomically, so concurrent
+    writers and readers never see partial files).
+    :param store_dir: directory of the store
+    :param results: (pd.DataFrame) with the KEY_COLUMNS and a score column
+    :return:
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    results = results[KEY_COLUMNS + ['score']].astype(COLUMN_TYPES)
+    part_file = os.path.join(store_dir, f'part-{uuid.uuid4().hex}.parquet')
+    results.to_parquet(f'{part_file}.tmp', index=False)
+    os.replace(f'{part_file}.tmp', part_file)
+
+
+def load_results(store_dir: str, where: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """
+    Reads the store, keeping the last written result of each key.
+    :param store_dir: directory of the store
+    :param where: (dict) of column values to select, e.g. {'period': '1920_1929'}; values are cast
+    to the type of their column, so {'seed': '3'} selects seed 3
+    :return: (pd.DataFrame) with the KEY_COLUMNS and a score column
+    """
+    part_files = sorted(
+        (os.path.join(store_dir, f) for f in os.listdir(store_dir) if f.endswith('.parquet')), key=os.path.getmtime)
+    if len(part_files) == 0:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['score'])
+
+    for column in (where or {}):
+        assert column in COLUMN_TYPES, f'[ERROR] Unknown column {column}, expected one of {list(COLUMN_TYPES)}'
+    filters = [(column, '==', COLUMN_TYPES[column](value)) for column, value in (where or {}).items()]
+    results = pd.concat(
+        [pd.read_parquet(f, filters=filters or None) for f in part_files], ignore_index=True)
+    return results.drop_duplicates(subset=KEY_COLUMNS, keep='last').reset_index(drop=True)
+
+
+def results_from_log(log_file: str, period: str, corpus: str, main_query: str = 'PWTW-PC-OW') -> pd.DataFrame:
+    """
+    Converts a ChuChu results log (or a list of queue results) to store rows. The main score
+    of every iteration is recorded as main_query on the center vectors.
+    :param log_file: location of a chuchu_results_{type}.jsonl log
+    :param period: (str) e.g. 1920_1929
+    :param corpus: (str) corpus variant, e.g. inc or exc
+    :param main_query: name of the query of the main score
+    :return:
+    """
+    results = []
+    with open(log_file, 'r') as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Partially written last line (as ChuChu.load_results)
+                continue
+    return results_from_records(results=results, period=period, corpus=corpus, main_query=main_query)
+
+
+def results_from_records(results: List[Dict], period: str, corpus: str, main_query: str = 'PWTW-PC-OW') -> pd.DataFrame:
+    rows = []
+    for r in results:
+        rows.append((period, corpus, main_query, 'center', r['k'], r['score']))
+        for query, variant_scores in r.get('scores', {}).items():
+            for variant, score in variant_scores.items():
+                if query == main_query and variant == 'center':
+                    continue
+                rows.append((period, corpus, query, variant, r['k'], score))
+    return pd.DataFrame(rows, columns=KEY_COLUMNS + ['score'])
+
+
+def _grouped_quantile(values: np.array, starts: np.array, counts: np.array, q: np.array) -> np.array:
+    # Linear interpolation (as np.percentile) within groups of sorted values; q is per group
+    position = q * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    fraction = position - lower
+    return values[starts + lower] + fraction * (values[starts + upper] - values[starts + lower])
+
+
+def summarize(results: pd.DataFrame, conf_level: float = 0.95,
+              group_by: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Summarizes the scores of every group in one vectorized pass: mean, median, variance, sd,
+    percentile interval (as bootstrap_utils.parse_bootstrap_output) and skew-adjusted interval.
+
+    The skew-adjusted interval applies the BCa adjustment of the percentiles using only the
+    bootstrap scores: the bias correction compares them with their mean rather than with the
+    score of the full corpus, and the acceleration is the skewness of the scores divided by 6
+    rather than a jackknife over documents. It is not a BCa interval (the store has neither
+    the full-corpus score nor jackknife scores): it shifts the percentile interval towards
+    the longer tail of the scores, and is close to it for symmetric scores.
+    :param results: (pd.DataFrame) with a score column and the group_by columns
+    :param conf_level: confidence level of the intervals
+    :param group_by: (list) of columns defining the groups, GROUP_COLUMNS by default
+    :return: (pd.DataFrame) with one row per group, in order of first appearance in results
+    """
+    assert conf_level < 1, '[ERROR] Confidence level must be between 0 and 1'
+    group_by = GROUP_COLUMNS if group_by is None else group_by
+    results = results.loc[results['score'].notna()]
+
+    # Sort by group (numbered in order of appearance), then score, so that every group is a
+    # sorted contiguous block
+    codes = results.groupby(group_by, sort=False).ngroup().to_numpy()
+    order = np.lexsort((results['score'].to_numpy(), codes))
+    codes = codes[order]
+    x = results['score'].to_numpy()[order]
+    G = codes[-1] + 1 if len(codes) > 0 else 0
+    counts = np.bincount(codes, minlength=G)
+    starts = np.cumsum(counts) - counts
+
+    sums = np.bincount(codes, weights=x, minlength=G)
+    mean = sums / counts
+    centered = x - mean[codes]
+    m2 = np.bincount(codes, weights=centered ** 2, minlength=G)
+    m3 = np.bincount(codes, weights=centered ** 3, minlength=G)
+    variance = m2 / counts
+
+    alpha = (1 - conf_level) / 2
+    percentile_lower = _grouped_quantile(x, starts, counts, np.full(G, alpha))
+    percentile_upper = _grouped_quantile(x, starts, counts, np.full(G, 1 - alpha))
+
+    # Skew adjustment: BCa formulas with the bias correction and acceleration of the scores
+    below = np.bincount(codes, weights=(centered < 0).astype(float), minlength=G)
+    z0 = special.ndtri(np.clip(below / counts, 0.5 / counts, 1 - 0.5 / counts))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acceleration = np.nan_to_num(m3 / (6 * m2 ** 1.5))
+    skew = []
+    for a in (alpha, 1 - alpha):
+        z = z0 + special.ndtri(a)
+        skew.append(_grouped_quantile(x, starts, counts, special.ndtr(z0 + z / (1 - acceleration * z))))
+
+    summary = results[group_by].iloc[order[starts]].reset_index(drop=True)
+    summary['count'] = counts
+    summary['mean'] = mean
+    summary['median'] = _grouped_quantile(x, starts, counts, np.full(G, 0.5))
+    summary['variance'] = variance
+    summary['sd'] = np.sqrt(variance)
+    summary['lower'] = percentile_lower
+    summary['upper'] = percentile_upper
+    summary['skew_lower'] = skew[0]
+    summary['skew_upper'] = skew[1]
+    return summary
+
+
+def plot_summary(summary: pd.DataFrame, out_file: str, label_columns: List[str], interval: str = 'percentile'):
+    """
+    Plots group means with their intervals, as in Figure 1.
+    :param summary: (pd.DataFrame) as returned by summarize
+    :param out_file: location of the figure
+    :param label_columns: columns used to label each group
+    :param interval: (str) percentile or skew (see summarize)
+    :return:
+    """
+    # Imported here, so that the bootstrap workers writing to the store never load matplotlib
+    import matplotlib.pyplot as plt
+
+    lower, upper = ('lower', 'upper') if interval == 'percentile' else ('skew_lower', 'skew_upper')
+    labels = summary[label_columns].astype(str).agg('\n'.join, axis=1)
+
+    fig, ax = plt.subplots(figsize=(4, 0.5 + 0.9 * len(summary)))
+    ax.axvline(x=0, color='black')
+    ax.errorbar(
+        ls='none', y=labels, x=summary['mean'],
+        xerr=(np.abs(summary[lower] - summary['mean']), np.abs(summary[upper] - summary['mean'])), zorder=0)
+    plt.scatter(y=labels, x=summary['mean'], zorder=5)
+    ax.set_xlabel('Cosine bias score', fontsize=8)
+    ax.set(ylabel='')
+    plt.tick_params(labelsize=8)
+    plt.gca().invert_yaxis()
+    fig.tight_layout()
+    plt.savefig(out_file, dpi=400)
+
+
+def _parse_where(where: Optional[List[str]]) -> Dict[str, str]:
+    return dict(w.split('=', 1) for w in where) if where else {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store_dir', required=True)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='Add a ChuChu results log to the store')
+    import_parser.add_argument('--log_file', required=True)
+    import_parser.add_argument('--period', required=True)
+    import_parser.add_argument('--corpus', required=True)
+
+    for name in ('summary', 'plot'):
+        command_parser = subparsers.add_parser(name)
+        command_parser.add_argument('--where', required=False, nargs='+', help='column=value selections')
+        command_parser.add_argument('--group_by', required=False, nargs='+', default=GROUP_COLUMNS)
+        command_parser.add_argument('--conf_level', required=False, type=float, default=0.95)
+    subparsers.choices['summary'].add_argument('--out_file', required=False, help='CSV of the summary')
+    subparsers.choices['plot'].add_argument('--out_file', required=True, help='Location of the figure')
+    subparsers.choices['plot'].add_argument('--interval', required=False, default='percentile',
+                                            choices=['percentile', 'skew'])
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        append_results(
+            store_dir=args.store_dir,
+            results=results_from_log(log_file=args.log_file, period=args.period, corpus=args.corpus))
+    else:
+        summary = summarize(
+            results=load_results(store_dir=args.store_dir, where=_parse_where(args.where)),
+            conf_level=args.conf_level, group_by=args.group_by)
+        if args.command == 'summary':
+            print(summary.to_string())
+            if args.out_file is not None:
+                summary.to_csv(args.out_file, index=False)
+        else:
+            # Label groups by the columns that vary within the slice
+            label_columns = [c for c in args.group_by if summary[c].nunique() > 1] or args.group_by
+            plot_summary(summary=summary, out_file=args.out_file, label_columns=label_columns, interval=args.interval)
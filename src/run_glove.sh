@@ -30,18 +30,24 @@ X_MAX=50
 
 echo "starting..."
 $GLOVELOCATION$BUILDDIR/vocab_count -min-count $VOCAB_MIN_COUNT -verbose $VERBOSE < $CORPUS > $VOCAB_FILE
-echo "finished building vocab"
 if [[ $? -eq 0 ]]
   then
+  echo "finished building vocab"
   $GLOVELOCATION$BUILDDIR/cooccur -memory $MEMORY -vocab-file $VOCAB_FILE -verbose $VERBOSE -overflow-file $OVERFLOW_FILE -window-size $WINDOW_SIZE < $CORPUS > $COOCCURRENCE_FILE
-  echo "finished building cooccurrence file"
   if [[ $? -eq 0 ]]
   then
+    echo "finished building cooccurrence file"
     $GLOVELOCATION$BUILDDIR/shuffle -memory $MEMORY -temp-file $TEMP_FILE -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE
-    echo "finished shuffling coeccurence"
     if [[ $? -eq 0 ]]
     then
+       echo "finished shuffling coeccurence"
        $GLOVELOCATION$BUILDDIR/glove -save-file $SAVE_FILE -threads $NUM_THREADS -input-file $COOCCURRENCE_SHUF_FILE -x-max $X_MAX -iter $MAX_ITER -vector-size $VECTOR_SIZE -binary $BINARY -model $MODEL -vocab-file $VOCAB_FILE -verbose $VERBOSE
+    else
+      exit 1
     fi
+  else
+    exit 1
   fi
+else
+  exit 1
 fi
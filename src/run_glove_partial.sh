@@ -8,6 +8,8 @@ GLOVELOCATION="$2"
 SAVELOC="$3"
 CORPUSFILENAME="$4"
 K="$5"
+# "skip" trains on an existing ${COOCCURRENCE_SHUF_FILE} (e.g. from cooccur_utils.shuffle_cooccurrence)
+SHUFFLE="$6"
 
 VOCAB_FILE=${SAVELOC}${CORPUSFILENAME}vocab$RUNLABEL.txt
 COOCCURRENCE_FILE=${SAVELOC}${CORPUSFILENAME}cooccurrence$RUNLABEL.bin
@@ -26,10 +28,14 @@ NUM_THREADS=20
 X_MAX=50
 
 echo "starting..."
-$GLOVELOCATION$BUILDDIR/shuffle -temp-file temp_shuffle_$K_ -memory $MEMORY -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE
-echo "finished shuffling co-occurrence file"
-if [[ $? -eq 0 ]]
+if [[ "$SHUFFLE" != "skip" ]]
   then
-  echo "Training GloVe vectors.."
-  $GLOVELOCATION$BUILDDIR/glove -save-file $SAVE_FILE -threads $NUM_THREADS -input-file $COOCCURRENCE_SHUF_FILE -x-max $X_MAX -iter $MAX_ITER -vector-size $VECTOR_SIZE -binary $BINARY -model $MODEL -vocab-file $VOCAB_FILE -verbose $VERBOSE
-fi
\ No newline at end of file
+  $GLOVELOCATION$BUILDDIR/shuffle -temp-file ${SAVELOC}temp_shuffle_${K}_ -memory $MEMORY -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE
+  if [[ $? -ne 0 ]]
+    then
+    exit 1
+  fi
+  echo "finished shuffling co-occurrence file"
+fi
+echo "Training GloVe vectors.."
+$GLOVELOCATION$BUILDDIR/glove -save-file $SAVE_FILE -threads $NUM_THREADS -input-file $COOCCURRENCE_SHUF_FILE -x-max $X_MAX -iter $MAX_ITER -vector-size $VECTOR_SIZE -binary $BINARY -model $MODEL -vocab-file $VOCAB_FILE -verbose $VERBOSE
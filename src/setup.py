@@ -2,47 +2,163 @@
 # Set up the 1900-1912 COHA corpus and the 1920-1930 COHA corpus (used for the Chu Chu analysis in Figure 1)
 #
 
+import itertools
 import os
 import subprocess
-from typing import List
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 from tqdm import tqdm
 
 import coha_utils
+import cooccur_utils
 import file_utils
+import token_store
+import trace_utils
+import workspace_utils
 
 
-def generate_subset(documents: List[str], out_path: str, individual_path: str):
-    # Consolidate documents
+# How individual texts are saved next to the consolidated corpus
+INDIVIDUAL_MODES = ('copy', 'hardlink', 'skip')
+
+
+def _read_document(doc_file: str, out_file: str, individual_mode: str) -> Optional[bytes]:
+    try:
+        with open(doc_file, 'rb') as dfile:
+            doc_text = dfile.read()
+    except FileNotFoundError:
+        return None
+
+    # Save individual file
+    if individual_mode != 'skip':
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        workspace_utils.link_or_copy(f=doc_file, out_file=out_file, mode=individual_mode)
+
+    return doc_text
+
+
+def consolidate_documents(documents: List[str], out_path: str, individual_path: str,
+                          individual_mode: str = 'copy', num_threads: int = 8) -> Dict[str, float]:
+    """
+    Writes the documents to {out_path}/consolidated.txt, one document per line, through a
+    single buffered handle. Documents are read by a bounded thread pool and written in the
+    order given. Individual texts are copied or hardlinked to {out_path}/individual_texts,
+    or skipped.
+    :param documents: (list) of COHA document ids
+    :param out_path: output directory
+    :param individual_path: Location of the individual, pre-processed COHA documents
+    :param individual_mode: (str) one of INDIVIDUAL_MODES
+    :param num_threads: number of reader threads
+    :return: (dict) with the number of documents written and missing, bytes written and throughput
+    """
+    assert individual_mode in INDIVIDUAL_MODES, f'[ERROR] Unknown individual_mode {individual_mode}'
     out_file = os.path.join(out_path, 'consolidated.txt')
     os.makedirs(out_path, exist_ok=True)
-    os.makedirs(os.path.join(out_path, 'individual_texts'), exist_ok=True)
+    if individual_mode != 'skip':
+        os.makedirs(os.path.join(out_path, 'individual_texts'), exist_ok=True)
+
+    stats = {'documents': 0, 'missing': 0, 'bytes': 0}
+    start_time = time.time()
+
+    def submit(executor, doc_id):
+        return doc_id, executor.submit(
+            _read_document,
+            doc_file=f'{individual_path}/coha_{doc_id}.txt',
+            out_file=f'{out_path}/individual_texts/coha_{doc_id}.txt',
+            individual_mode=individual_mode)
 
     # Save consolidated .txt -- this separates documents using a newline, as
     # indicated by GloVe instructions (https://github.com/stanfordnlp/GloVe/tree/master/src)
-    for doc_id in tqdm(documents):
-        doc_file = f'{individual_path}/coha_{doc_id}.txt'
-        # Append to consolidated .txt
-        try:
-            with open(doc_file, 'r') as dfile:
-                doc_text = dfile.read() + '\n'
-                mode = 'a' if os.path.exists(out_file) else 'w'
-                with open(out_file, mode) as outf:
+    with open(out_file, 'wb', buffering=1 << 20) as outf, ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Keep a bounded number of reads in flight, consumed in document order
+        pending = deque()
+        doc_iter = iter(documents)
+        for doc_id in itertools.islice(doc_iter, 4 * num_threads):
+            pending.append(submit(executor, doc_id))
+
+        with tqdm(total=len(documents)) as pbar:
+            while pending:
+                doc_id, future = pending.popleft()
+                next_doc = next(doc_iter, None)
+                if next_doc is not None:
+                    pending.append(submit(executor, next_doc))
+
+                doc_text = future.result()
+                if doc_text is None:
+                    print(f'[WARNING] File {doc_id} not found')
+                    stats['missing'] += 1
+                else:
                     outf.write(doc_text)
+                    outf.write(b'\n')
+                    stats['documents'] += 1
+                    stats['bytes'] += len(doc_text) + 1
+                pbar.update(1)
 
-            # Save individual file
-            os.popen(f'cp {doc_file} {out_path}/individual_texts/coha_{doc_id}.txt')
+        outf.flush()
+        os.fsync(outf.fileno())
 
-        except FileNotFoundError:
-            print(f'[WARNING] File {doc_id} not found')
+    elapsed = time.time() - start_time
+    stats['bytes_per_second'] = stats['bytes'] / elapsed if elapsed > 0 else float('inf')
+    print(f'[INFO] Consolidated {stats["documents"]} documents ({stats["bytes"] / 1e6:.1f} MB, '
+          f'{stats["bytes_per_second"] / 1e6:.1f} MB/s), {stats["missing"]} missing')
+    return stats
+
+
+def generate_subset(documents: List[str], out_path: str, individual_path: str,
+                    individual_mode: str = 'copy', num_threads: int = 8,
+                    cooccur_backend: str = 'glove', num_processes: int = 4,
+                    token_store_dir: Optional[str] = None) -> Dict[str, float]:
+    out_file = os.path.join(out_path, 'consolidated.txt')
+    if token_store_dir is not None:
+        # Slice the pre-tokenized corpus (see token_store) instead of reading individual texts
+        store = token_store.load_token_store(store_dir=token_store_dir)
+        rows = token_store.document_rows(store=store, documents=documents)
+        rows = rows[store['present'][rows]]
+        stats = {'documents': len(rows), 'missing': len(documents) - len(rows)}
+        os.makedirs(out_path, exist_ok=True)
+        assert individual_mode in INDIVIDUAL_MODES, f'[ERROR] Unknown individual_mode {individual_mode}'
+        if individual_mode != 'skip':
+            # The texts are not read, but are still copied or hardlinked as consolidate_documents does
+            os.makedirs(os.path.join(out_path, 'individual_texts'), exist_ok=True)
+            for doc_id in store['doc_ids'][rows]:
+                out_doc = f'{out_path}/individual_texts/coha_{doc_id}.txt'
+                if os.path.exists(out_doc):
+                    os.remove(out_doc)
+                workspace_utils.link_or_copy(
+                    f=f'{individual_path}/coha_{doc_id}.txt', out_file=out_doc, mode=individual_mode)
+        if cooccur_backend == 'python':
+            with trace_utils.stage('build_cooccurrence', out_path=out_path):
+                token_store.write_subset(store=store, rows=rows, out_path=out_path, num_processes=num_processes)
+            return stats
+        with trace_utils.stage('consolidate_documents', out_path=out_path):
+            token_store.write_consolidated(store=store, rows=rows, out_file=out_file)
+    else:
+        # Consolidate documents (all writes are flushed before GloVe runs)
+        with trace_utils.stage('consolidate_documents', out_path=out_path):
+            stats = consolidate_documents(
+                documents=documents, out_path=out_path, individual_path=individual_path,
+                individual_mode=individual_mode, num_threads=num_threads)
+
+        if cooccur_backend == 'python':
+            # Generate co-occurrence matrix and vocab without the GloVe binaries (no vectors are trained)
+            with trace_utils.stage('build_cooccurrence', out_path=out_path):
+                cooccur_utils.build_cooccurrence(
+                    corpus_file=out_file, out_path=out_path, num_processes=num_processes)
+            return stats
 
     # Run GloVe (to generate co-occurrence matrix and vocab)
-    subprocess.call(
-        [f"run_glove.sh",
-         '',
-         f'../GloVe/',
-         f'{out_path}/',
-         out_file.replace('.txt', ''),
-         ''])
+    with trace_utils.stage('run_glove', out_path=out_path):
+        subprocess.run(
+            [f"run_glove.sh",
+             '',
+             f'../GloVe/',
+             f'{out_path}/',
+             out_file.replace('.txt', ''),
+             ''], check=True)
+
+    return stats
 
 
 def main():
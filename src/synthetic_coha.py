@@ -0,0 +1,126 @@
+"""
+Generates a synthetic corpus laid out like COHA (individual_texts/coha_{id}.txt and
+coha_document_metadata.json), to exercise and benchmark the pipeline without the licensed data.
+Tokens follow a Zipf-Mandelbrot distribution, document lengths are log-normal and the number of
+documents grows over the decades, as in COHA.
+"""
+
+import argparse
+import json
+import os
+from typing import Dict
+import numpy as np
+from tqdm import tqdm
+
+import bias_utils
+
+# Genre shares of COHA documents (NEWS only from the 1860s)
+GENRES = {'FIC': 0.5, 'MAG': 0.25, 'NEWS': 0.1, 'NF/ACAD': 0.15}
+NEWS_START_YEAR = 1860
+
+
+def synthetic_vocabulary(vocab_size: int, rng: np.random.Generator) -> np.array:
+    """
+    Returns vocab_size distinct lowercase pseudo-words, ordered by rank. The words of
+    bias_utils.BIAS_QUERIES are placed at ranks 50 to 1000 so that queries can be scored.
+    :param vocab_size:
+    :param rng:
+    :return: (np.array) of str
+    """
+    query_words = sorted({w for bias_query in bias_utils.BIAS_QUERIES.values()
+                          for word_set in bias_query.values() for w in word_set})
+    assert vocab_size > 10 * len(query_words), f'[ERROR] Vocabulary must have more than {10 * len(query_words)} words'
+
+    lengths = np.clip(rng.poisson(5, size=vocab_size), 1, 15)
+    letters = rng.integers(ord('a'), ord('z') + 1, size=(vocab_size, 15), dtype=np.uint8)
+    words, seen = [], set(query_words)
+    for i in range(vocab_size):
+        w = letters[i, :lengths[i]].tobytes().decode('ascii')
+        if w in seen:
+            w = f'{w}{i}'
+        seen.add(w)
+        words.append(w)
+
+    step = max(1, (min(vocab_size, 1000) - 50) // len(query_words))
+    ranks = 50 + step * np.arange(len(query_words))
+    words = np.array(words, dtype=object)
+    words[ranks] = rng.permutation(query_words)
+    return words
+
+
+def generate_synthetic_coha(out_dir: str, num_documents: int, vocab_size: int = 100000, mean_length: int = 2000,
+                            start_year: int = 1810, end_year: int = 2009, zipf_exponent: float = 1.07,
+                            seed: int = 0) -> Dict[str, int]:
+    """
+    Writes {out_dir}/individual_texts/coha_{id}.txt (one line per document, ids from 1) and
+    {out_dir}/coha_document_metadata.json.
+    :param out_dir: output directory
+    :param num_documents:
+    :param vocab_size:
+    :param mean_length: mean number of tokens per document
+    :param start_year:
+    :param end_year: inclusive
+    :param zipf_exponent: exponent of the Zipf-Mandelbrot token distribution
+    :param seed:
+    :return: (dict) with the number of documents and tokens written
+    """
+    rng = np.random.default_rng(seed)
+    individual_path = os.path.join(out_dir, 'individual_texts')
+    os.makedirs(individual_path, exist_ok=True)
+
+    words = synthetic_vocabulary(vocab_size=vocab_size, rng=rng)
+    token_cdf = np.cumsum(1 / (np.arange(vocab_size) + 2.7) ** zipf_exponent)
+    token_cdf /= token_cdf[-1]
+
+    # Later decades have more documents, and documents within a decade are spread over its years
+    decades = np.arange(start_year - start_year % 10, end_year + 1, 10)
+    decade_weights = np.arange(1, len(decades) + 1, dtype=np.float64)
+    years = rng.choice(decades, size=num_documents, p=decade_weights / decade_weights.sum()) + \
+        rng.integers(0, 10, size=num_documents)
+    years = np.clip(years, start_year, end_year)
+
+    genre_names = np.array(list(GENRES.keys()))
+    genre_p = np.array(list(GENRES.values()))
+    genre_p_early = np.where(genre_names == 'NEWS', 0, genre_p)
+    genres = np.where(
+        years < NEWS_START_YEAR,
+        rng.choice(genre_names, size=num_documents, p=genre_p_early / genre_p_early.sum()),
+        rng.choice(genre_names, size=num_documents, p=genre_p))
+
+    # Log-normal lengths with the requested mean
+    sigma = 1.2
+    lengths = rng.lognormal(mean=np.log(mean_length) - sigma ** 2 / 2, sigma=sigma, size=num_documents)
+    lengths = np.clip(lengths, 20, 50 * mean_length).astype(np.int64)
+
+    metadata = {}
+    for i in tqdm(range(num_documents), desc='Writing synthetic documents'):
+        doc_id = str(i + 1)
+        tokens = np.searchsorted(token_cdf, rng.random(lengths[i]), side='right')
+        with open(os.path.join(individual_path, f'coha_{doc_id}.txt'), 'w', encoding='latin-1') as f:
+            f.write(' '.join(words[tokens]))
+            f.write('\n')
+        metadata[doc_id] = {
+            '# words': int(lengths[i]), 'genre': str(genres[i]), 'year': int(years[i]),
+            'title': f'Synthetic document {doc_id}', 'author': 'Synthetic'}
+
+    with open(os.path.join(out_dir, 'coha_document_metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    return {'documents': num_documents, 'tokens': int(lengths.sum())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out_dir', required=True)
+    parser.add_argument('--num_documents', required=False, type=int, default=2000)
+    parser.add_argument('--vocab_size', required=False, type=int, default=100000)
+    parser.add_argument('--mean_length', required=False, type=int, default=2000)
+    parser.add_argument('--start_year', required=False, type=int, default=1810)
+    parser.add_argument('--end_year', required=False, type=int, default=2009)
+    parser.add_argument('--seed', required=False, type=int, default=0)
+
+    args = parser.parse_args()
+    stats = generate_synthetic_coha(
+        out_dir=args.out_dir, num_documents=args.num_documents, vocab_size=args.vocab_size,
+        mean_length=args.mean_length, start_year=args.start_year, end_year=args.end_year, seed=args.seed)
+    print(f'[INFO] Wrote {stats["documents"]} documents ({stats["tokens"]} tokens) to {args.out_dir}')
@@ -0,0 +1,310 @@
+"""
+Pre-tokenized binary COHA store. A one-time ingest tokenizes every document (as GloVe does,
+on raw bytes, so no encoding is assumed) and writes the whole corpus as one uint32 array of
+token ids, a global vocabulary and tables of document and line offsets. Documents are stored in the
+order of the metadata index (sorted by year), so the documents of a period are one contiguous
+slice of the token array. Subsets, term counts and co-occurrences are then computed from
+memory-mapped array slices instead of reading and splitting individual text files.
+
+Line boundaries are kept because GloVe's cooccur (like cooccur_utils.build_cooccurrence) treats
+every line of the consolidated corpus as a document: co-occurrence windows stop at line ends,
+including the line breaks within a COHA text. Lines without tokens are not stored, as they
+contribute no words or co-occurrences.
+"""
+
+import argparse
+import os
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+import coha_utils
+import cooccur_utils
+
+
+def _tokenize_documents(
+        shard: Tuple[List[str], str]) -> Tuple[List[bytes], np.array, np.array, np.array, np.array]:
+    # Tokens of a chunk of documents, over a vocabulary local to the chunk, with the number of
+    # tokens of every document and of every (non-empty) line
+    documents, individual_path = shard
+    local_vocab = {}
+    tokens, lengths, line_lengths, present = [], [], [], []
+    for doc_id in documents:
+        try:
+            with open(f'{individual_path}/coha_{doc_id}.txt', 'rb') as f:
+                text = f.read()
+        except FileNotFoundError:
+            lengths.append(0)
+            present.append(False)
+            continue
+        doc_tokens = []
+        for line in text.split(b'\n'):
+            line_tokens = [local_vocab.setdefault(w, len(local_vocab)) for w in cooccur_utils.tokenize(line)]
+            if line_tokens:
+                doc_tokens.extend(line_tokens)
+                line_lengths.append(len(line_tokens))
+        tokens.append(np.array(doc_tokens, dtype=np.uint32))
+        lengths.append(len(doc_tokens))
+        present.append(True)
+    return (list(local_vocab), np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.uint32),
+            np.array(lengths, dtype=np.int64), np.array(line_lengths, dtype=np.int64), np.array(present, dtype=bool))
+
+
+def build_token_store(individual_path: str, metadata_loc: str, store_dir: str,
+                      num_processes: int = 4, docs_per_shard: int = 500):
+    """
+    Tokenizes every document of the metadata into {store_dir}: tokens.npy (uint32 token ids),
+    offsets.npy (start of every document in tokens, plus the end), line_offsets.npy (start of every
+    non-empty line in tokens, plus the end), doc_ids.npy, years.npy,
+    present.npy (False for documents without a text file), counts.npy and vocab.txt (all words,
+    in GloVe vocab.txt order, so that token id i is line i).
+    :param individual_path: Location of the individual, pre-processed COHA documents
+    :param metadata_loc: Location of the COHA metadata json
+    :param store_dir: output directory
+    :param num_processes:
+    :param docs_per_shard: number of documents handed to a worker at a time
+    :return:
+    """
+    index = coha_utils.load_metadata_index(loc_dir=metadata_loc)
+    documents = index['doc_ids'].tolist()
+    os.makedirs(store_dir, exist_ok=True)
+
+    # First pass: tokens with provisional ids (in order of first occurrence)
+    vocab = {}
+    lengths, line_lengths, present = [], [], []
+    tmp_file = os.path.join(store_dir, f'tokens.{os.getpid()}.tmp')
+    shards = [(documents[i:i + docs_per_shard], individual_path) for i in range(0, len(documents), docs_per_shard)]
+    with open(tmp_file, 'wb') as f, Pool(processes=num_processes) as p:
+        # imap keeps the (year) order of the documents
+        for local_vocab, shard_tokens, shard_lengths, shard_line_lengths, shard_present in tqdm(
+                p.imap(_tokenize_documents, shards), total=len(shards), desc='Tokenizing documents'):
+            local_to_global = np.array([vocab.setdefault(w, len(vocab)) for w in local_vocab], dtype=np.uint32)
+            local_to_global[shard_tokens].tofile(f)
+            lengths.append(shard_lengths)
+            line_lengths.append(shard_line_lengths)
+            present.append(shard_present)
+
+    # Second pass: renumber by GloVe vocab order (most frequent first)
+    provisional = np.fromfile(tmp_file, dtype=np.uint32) if os.path.getsize(tmp_file) > 0 else \
+        np.zeros(0, dtype=np.uint32)
+    counts = np.bincount(provisional, minlength=len(vocab))
+    words = list(vocab)
+    sorted_vocab = cooccur_utils.sort_vocab(counts=dict(zip(words, counts.tolist())), min_count=1)
+    rank = np.empty(len(words), dtype=np.uint32)
+    rank[[vocab[w] for w, _ in sorted_vocab]] = np.arange(len(sorted_vocab), dtype=np.uint32)
+
+    tokens = np.lib.format.open_memmap(
+        os.path.join(store_dir, 'tokens.npy'), mode='w+', dtype=np.uint32, shape=provisional.shape)
+    chunk = 1 << 26
+    for start in range(0, len(provisional), chunk):
+        tokens[start:start + chunk] = rank[provisional[start:start + chunk]]
+    tokens.flush()
+    del tokens, provisional
+    os.remove(tmp_file)
+
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(store_dir, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    line_lengths = np.concatenate(line_lengths) if line_lengths else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(store_dir, 'line_offsets.npy'),
+            np.concatenate([[0], np.cumsum(line_lengths)]).astype(np.int64))
+    np.save(os.path.join(store_dir, 'doc_ids.npy'), index['doc_ids'])
+    np.save(os.path.join(store_dir, 'years.npy'), index['years'])
+    np.save(os.path.join(store_dir, 'present.npy'), np.concatenate(present) if present else np.zeros(0, dtype=bool))
+    np.save(os.path.join(store_dir, 'counts.npy'), np.array([c for _, c in sorted_vocab], dtype=np.int64))
+    cooccur_utils.write_vocab(vocab=sorted_vocab, vocab_file=os.path.join(store_dir, 'vocab.txt'))
+
+
+def load_token_store(store_dir: str) -> Dict:
+    """
+    Loads a token store, with the token array memory-mapped.
+    :param store_dir:
+    :return: (dict) with tokens, offsets, line_offsets, doc_ids, years, present, counts and vocab
+    (list of bytes)
+    """
+    if not os.path.exists(os.path.join(store_dir, 'line_offsets.npy')):
+        raise Exception(f'[ERROR] {store_dir} has no line offsets (built by an older version), rebuild it')
+    store = {name: np.load(os.path.join(store_dir, f'{name}.npy'))
+             for name in ('offsets', 'line_offsets', 'doc_ids', 'years', 'present', 'counts')}
+    store['tokens'] = np.load(os.path.join(store_dir, 'tokens.npy'), mmap_mode='r')
+    store['vocab'] = [w for w, _ in cooccur_utils.load_vocab_counts(vocab_file=os.path.join(store_dir, 'vocab.txt'))]
+    store['store_dir'] = store_dir
+    return store
+
+
+def period_rows(store: Dict, start_year: int, end_year: int) -> np.array:
+    """
+    Rows (documents) of a year range (inclusive), a contiguous range as rows are sorted by year.
+    """
+    lo = np.searchsorted(store['years'], int(start_year), side='left')
+    hi = np.searchsorted(store['years'], int(end_year), side='right')
+    return np.arange(lo, hi)
+
+
+def document_rows(store: Dict, documents: Iterable[str]) -> np.array:
+    """
+    Rows of a list of document ids, in the given order (unknown ids are dropped).
+    """
+    documents = np.array(list(documents), dtype=str)
+    order = np.argsort(store['doc_ids'])
+    positions = np.clip(np.searchsorted(store['doc_ids'], documents, sorter=order), 0, max(len(order) - 1, 0))
+    rows = order[positions] if len(order) > 0 else np.zeros(0, dtype=np.int64)
+    return rows[store['doc_ids'][rows] == documents]
+
+
+def document_tokens(store: Dict, row: int) -> np.array:
+    return store['tokens'][store['offsets'][row]:store['offsets'][row + 1]]
+
+
+def document_lines(store: Dict, row: int) -> List[np.array]:
+    """
+    Tokens of the (non-empty) lines of a document.
+    """
+    start, end = store['offsets'][row], store['offsets'][row + 1]
+    lo, hi = np.searchsorted(store['line_offsets'], [start, end], side='left')
+    return np.split(store['tokens'][start:end], store['line_offsets'][lo + 1:hi] - start)
+
+
+def term_counts(store: Dict, rows: np.array) -> np.array:
+    """
+    Counts of every word of the global vocabulary over some documents.
+    :return: (np.array) of length V
+    """
+    V = len(store['vocab'])
+    rows = np.asarray(rows)
+    if len(rows) > 0 and np.all(np.diff(rows) == 1):
+        # Contiguous rows (e.g. a period): one slice
+        return np.bincount(store['tokens'][store['offsets'][rows[0]]:store['offsets'][rows[-1] + 1]], minlength=V)
+    counts = np.zeros(V, dtype=np.int64)
+    for row in rows:
+        counts += np.bincount(document_tokens(store=store, row=row), minlength=V)
+    return counts
+
+
+def document_term_matrix(store: Dict, rows: np.array) -> sparse.csr_matrix:
+    """
+    (documents, V) matrix of term counts of some documents.
+    """
+    rows = np.asarray(rows)
+    lengths = store['offsets'][rows + 1] - store['offsets'][rows]
+    tokens = np.concatenate([document_tokens(store=store, row=row) for row in rows]) if len(rows) > 0 else \
+        np.zeros(0, dtype=np.uint32)
+    matrix = sparse.coo_matrix(
+        (np.ones(len(tokens), dtype=np.int32), (np.repeat(np.arange(len(rows)), lengths), tokens)),
+        shape=(len(rows), len(store['vocab'])))
+    return matrix.tocsr()
+
+
+def doc_term_index(store: Dict, rows: Optional[np.array] = None) -> Dict:
+    """
+    The document-term index of doc_concentration (see doc_concentration.load_doc_term_index),
+    from the token store, with GloVe's tokenization.
+    :param store: (dict) as returned by load_token_store
+    :param rows: rows (in year order, e.g. from period_rows) of the documents to index, all if None
+    :return:
+    """
+    rows = np.arange(len(store['doc_ids'])) if rows is None else np.asarray(rows)
+    return {
+        'matrix': document_term_matrix(store=store, rows=rows),
+        'doc_ids': store['doc_ids'][rows], 'years': store['years'][rows],
+        'vocab': {w.decode('latin-1'): i for i, w in enumerate(store['vocab'])}}
+
+
+def subset_vocab(store: Dict, rows: np.array,
+                 min_count: int = cooccur_utils.VOCAB_MIN_COUNT) -> Tuple[List[Tuple[bytes, int]], np.array]:
+    """
+    Vocabulary of some documents, as GloVe's vocab_count would build it from their text.
+    :return: ((word, count) list in vocab.txt order, array mapping global ids to subset ids or -1)
+    """
+    counts = term_counts(store=store, rows=rows)
+    nonzero = np.flatnonzero(counts >= min_count)
+    # Global ids of the kept words only
+    word_idx = {store['vocab'][i]: i for i in nonzero}
+    vocab = cooccur_utils.sort_vocab(counts={w: int(counts[i]) for w, i in word_idx.items()}, min_count=min_count)
+    mapping = np.full(len(store['vocab']), -1, dtype=np.int64)
+    mapping[[word_idx[w] for w, _ in vocab]] = np.arange(len(vocab))
+    return vocab, mapping
+
+
+def _cooccur_rows(shard: Tuple[str, np.array, np.array, int]) -> sparse.csr_matrix:
+    store_dir, rows, mapping, window_size = shard
+    store = load_token_store(store_dir=store_dir)
+    V = int(mapping.max()) + 1 if len(mapping) > 0 else 0
+
+    def documents():
+        # Every line is a document for cooccur, so windows stop at line ends
+        for row in rows:
+            for line in document_lines(store=store, row=row):
+                word_ids = mapping[line]
+                yield word_ids[word_ids >= 0]
+
+    return cooccur_utils.accumulate_cooccurrence(documents=documents(), V=V, window_size=window_size)
+
+
+def subset_cooccurrence(store: Dict, rows: np.array, mapping: np.array,
+                        window_size: int = cooccur_utils.WINDOW_SIZE, num_processes: int = 4) -> sparse.csr_matrix:
+    """
+    Co-occurrence matrix of some documents, over the subset vocabulary given by mapping.
+    :param store: (dict) as returned by load_token_store
+    :param rows: rows of the documents
+    :param mapping: (np.array) mapping global ids to subset ids or -1, as returned by subset_vocab
+    :param window_size:
+    :param num_processes:
+    :return: (V, V) co-occurrence matrix over 0-based subset ids
+    """
+    V = int(mapping.max()) + 1 if len(mapping) > 0 else 0
+    shards = [(store['store_dir'], r, mapping, window_size)
+              for r in np.array_split(np.asarray(rows), max(1, min(num_processes, len(rows)))) if len(r) > 0]
+    matrix = sparse.csr_matrix((V, V))
+    with Pool(processes=num_processes) as p:
+        for shard_matrix in p.imap_unordered(_cooccur_rows, shards):
+            matrix = matrix + shard_matrix
+    return matrix
+
+
+def write_consolidated(store: Dict, rows: np.array, out_file: str):
+    """
+    Writes the documents as a GloVe corpus from their tokens, keeping the (non-empty) lines of every
+    document as setup.consolidate_documents does, so that the vocab and co-occurrences GloVe builds
+    from it are those of the consolidated texts.
+    """
+    words = np.array(store['vocab'], dtype=object)
+    with open(out_file, 'wb', buffering=1 << 20) as f:
+        for row in rows:
+            if store['present'][row]:
+                for line in document_lines(store=store, row=row):
+                    f.write(b' '.join(words[line]))
+                    f.write(b'\n')
+
+
+def write_subset(store: Dict, rows: np.array, out_path: str, min_count: int = cooccur_utils.VOCAB_MIN_COUNT,
+                 window_size: int = cooccur_utils.WINDOW_SIZE, num_processes: int = 4) -> Tuple[int, int]:
+    """
+    Writes vocab.txt and cooccurrence.bin of some documents, as cooccur_utils.build_cooccurrence
+    would from their consolidated text.
+    :return: (V, number of co-occurrence records)
+    """
+    os.makedirs(out_path, exist_ok=True)
+    vocab, mapping = subset_vocab(store=store, rows=rows, min_count=min_count)
+    cooccur_utils.write_vocab(vocab=vocab, vocab_file=os.path.join(out_path, 'vocab.txt'))
+    matrix = subset_cooccurrence(
+        store=store, rows=rows, mapping=mapping, window_size=window_size, num_processes=num_processes)
+    cooccur_utils.write_cooccurrence(matrix=matrix, cooccurrence_file=os.path.join(out_path, 'cooccurrence.bin'))
+    return len(vocab), matrix.nnz
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--coha_individual_path', required=True)
+    parser.add_argument('--coha_metadata_loc', required=True)
+    parser.add_argument('--store_dir', required=True)
+    parser.add_argument('--num_processes', required=False, type=int, default=4)
+
+    args = parser.parse_args()
+    build_token_store(
+        individual_path=args.coha_individual_path, metadata_loc=args.coha_metadata_loc, store_dir=args.store_dir,
+        num_processes=args.num_processes)
+    store = load_token_store(store_dir=args.store_dir)
+    print(f'[INFO] Stored {len(store["doc_ids"])} documents, {len(store["tokens"])} tokens '
+          f'and {len(store["vocab"])} words in {args.store_dir}')
@@ -0,0 +1,205 @@
+#
+# Optional per-stage tracing of the pipeline. Code marks stages with
+#
+#   with trace_utils.stage('glove', k=k):
+#       ...
+#
+# which does nothing until tracing is enabled. Once enabled (before worker processes are
+# forked, so that they inherit it), every stage appends one JSON line to the trace file with
+# its wall time, CPU time of the process and of its waited-for subprocesses, peak RSS and
+# bytes read and written (from /proc/self/io, which includes reaped subprocesses). Stages can
+# be nested; nested stages inherit the attributes (e.g. k) of their parents.
+#
+
+import argparse
+import json
+import os
+import resource
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
+import pandas as pd
+
+# Tracing state of this process (inherited by forked workers)
+_state = {'trace_file': None, 'run_id': None, 'handle': None, 'handle_pid': None, 'stack': []}
+
+# Fields of /proc/self/io recorded for every stage
+IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+
+def enable(trace_file: str, run_id: Optional[str] = None) -> str:
+    """
+    Enables tracing to trace_file (appended to).
+    :param trace_file: JSONL file of stage events
+    :param run_id: identifier of the run added to every event, generated if not given
+    :return: the run id
+    """
+    _state['trace_file'] = trace_file
+    _state['run_id'] = run_id or uuid.uuid4().hex[:12]
+    _state['handle'] = None
+    _state['handle_pid'] = None
+    return _state['run_id']
+
+
+def enabled() -> bool:
+    return _state['trace_file'] is not None
+
+
+def _write_event(event: Dict):
+    # One handle per process; O_APPEND keeps the lines of concurrent workers whole
+    if _state['handle_pid'] != os.getpid():
+        _state['handle'] = open(_state['trace_file'], 'a', buffering=1)
+        _state['handle_pid'] = os.getpid()
+    _state['handle'].write(json.dumps(event) + '\n')
+
+
+def _read_io() -> Dict[str, int]:
+    try:
+        with open('/proc/self/io', 'r') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return {field: int(values[field]) for field in IO_FIELDS}
+    except (OSError, KeyError, ValueError):
+        return {field: 0 for field in IO_FIELDS}
+
+
+def _reset_peak_rss() -> bool:
+    # Resets VmHWM (Linux 4.0+), so that the peak RSS of a stage is its own
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+@contextmanager
+def stage(name: str, **attrs) -> Iterator[None]:
+    """
+    Records one stage of the pipeline (no-op unless tracing is enabled).
+    :param name: stage name
+    :param attrs: attributes of the event, e.g. the iteration k
+    :return:
+    """
+    if _state['trace_file'] is None:
+        yield
+        return
+
+    # Stages open in the parent of a forked worker are not stages of the worker
+    if _state['stack'] and _state['stack'][-1]['pid'] != os.getpid():
+        _state['stack'] = []
+    parent = _state['stack'][-1] if _state['stack'] else None
+    if parent is not None:
+        # The peak of the parent so far, before this stage resets it
+        parent['child_peak'] = max(parent['child_peak'], _peak_rss_mb())
+    frame = {'pid': os.getpid(), 'attrs': {**(parent['attrs'] if parent else {}), **attrs}, 'child_peak': 0.0}
+    _state['stack'].append(frame)
+
+    self_start = resource.getrusage(resource.RUSAGE_SELF)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_start = _read_io()
+    peak_reset = _reset_peak_rss()
+    start, start_perf = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_perf
+        self_end = resource.getrusage(resource.RUSAGE_SELF)
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_end = _read_io()
+        # Nested stages reset the peak too, so it is the maximum over this stage and its children
+        peak = max(_peak_rss_mb(), frame['child_peak'])
+        _state['stack'].pop()
+        if parent is not None:
+            parent['child_peak'] = max(parent['child_peak'], peak)
+
+        event = {
+            'name': name, 'run_id': _state['run_id'], 'host': socket.gethostname(), 'pid': os.getpid(),
+            'start': start, 'wall': wall,
+            'cpu_user': self_end.ru_utime - self_start.ru_utime,
+            'cpu_system': self_end.ru_stime - self_start.ru_stime,
+            'children_cpu': (children_end.ru_utime + children_end.ru_stime) -
+                            (children_start.ru_utime + children_start.ru_stime),
+            'peak_rss_mb': peak if peak_reset else None,
+            'max_rss_mb': self_end.ru_maxrss / 1e3,
+            'children_max_rss_mb': children_end.ru_maxrss / 1e3,
+            **{field: io_end[field] - io_start[field] for field in IO_FIELDS},
+            **frame['attrs']}
+        _write_event(event)
+
+
+def load_trace(trace_file: str, run_id: Optional[str] = None) -> List[Dict]:
+    """
+    Reads the events of a trace file, optionally of one run only.
+    """
+    with open(trace_file, 'r') as f:
+        events = [json.loads(line) for line in f if line.strip() != '']
+    if run_id is not None:
+        events = [e for e in events if e['run_id'] == run_id]
+    return events
+
+
+def write_chrome_trace(events: List[Dict], out_file: str):
+    """
+    Writes events in the Chrome trace event format (chrome://tracing, Perfetto), one row per
+    worker process.
+    """
+    trace_events = [{
+        'name': e['name'], 'ph': 'X', 'ts': e['start'] * 1e6, 'dur': e['wall'] * 1e6,
+        'pid': e['host'], 'tid': e['pid'],
+        'args': {k: v for k, v in e.items() if k not in ('name', 'start', 'wall', 'host', 'pid')}}
+        for e in events]
+    with open(out_file, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize_trace(events: List[Dict], by: Sequence[str] = ('name',)) -> pd.DataFrame:
+    """
+    Aggregates events by stage (or any event attributes).
+    :param events: (list) of events as returned by load_trace
+    :param by: event attributes to group by, e.g. ('name', 'pid') for every stage of every worker
+    :return: (pd.DataFrame) with counts, wall and CPU seconds, peak RSS and MB read and written
+    """
+    df = pd.DataFrame(events)
+    if len(df) == 0:
+        return df
+    df['cpu'] = df['cpu_user'] + df['cpu_system']
+    df['read_mb'] = df['rchar'] / 1e6
+    df['write_mb'] = df['wchar'] / 1e6
+    summary = df.groupby(list(by)).agg(
+        count=('wall', 'size'), wall_total=('wall', 'sum'), wall_mean=('wall', 'mean'), wall_max=('wall', 'max'),
+        cpu_total=('cpu', 'sum'), children_cpu_total=('children_cpu', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'), read_mb=('read_mb', 'sum'), write_mb=('write_mb', 'sum'))
+    return summary.sort_values('wall_total', ascending=False)
+
+
+def print_summary(trace_file: str, run_id: Optional[str] = None, by: Sequence[str] = ('name',)):
+    summary = summarize_trace(events=load_trace(trace_file=trace_file, run_id=run_id), by=by)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20, 'display.float_format', '{:.3f}'.format):
+        print(summary.to_string())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trace_file', required=True)
+    parser.add_argument('--run_id', required=False, help='Only events of this run')
+    parser.add_argument('--by', required=False, nargs='+', default=['name'],
+                        help='Event attributes to group the summary by (e.g. name pid)')
+    parser.add_argument('--chrome_trace', required=False, help='Also write the events in Chrome trace format')
+
+    args = parser.parse_args()
+    print_summary(trace_file=args.trace_file, run_id=args.run_id, by=args.by)
+    if args.chrome_trace is not None:
+        write_chrome_trace(events=load_trace(trace_file=args.trace_file, run_id=args.run_id), out_file=args.chrome_trace)
@@ -2,8 +2,15 @@
 # Note: code adapted from https://github.com/mebrunet/understanding-bias/blob/master/src/GloVe.jl
 #
 
+import os
 import numpy as np
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Iterable, Iterator, Optional
+
+# Parameters written to (and read from) a binary vector store, one .npy file each
+STORE_PARAMETERS = ('W', 'U', 'b_w', 'b_u')
+
+# Word vectors that can be derived from the GloVe parameters (see vector_variant)
+VECTOR_VARIANTS = ('center', 'sum', 'normalized')
 
 
 def load_fulltxt_vectors(vectors_file: str) -> Tuple[Dict[str, np.array], Dict[str, np.array], Dict[str, np.array]]:
@@ -60,3 +67,333 @@ def load_fulltxt_vectors(vectors_file: str) -> Tuple[Dict[str, np.array], Dict[s
 
     parameter_dict = {'W': W, 'b_w': b_w, 'U': U, 'b_u': b_u, 'vocab': vocab}
     return parameter_dict, vectors, center_vectors
+
+
+def load_selected_vectors(
+        vectors_file: str, words: Iterable[str]) -> Tuple[Dict[str, np.array], Dict[str, list], Dict[str, list]]:
+    """
+    Reads the rows of a few words from a .txt file in the format of load_fulltxt_vectors. Lines
+    are matched on their raw word prefix, only matching rows are parsed, and the scan stops once
+    all words are found (GloVe writes words by decreasing frequency, so query words are
+    usually found early).
+    :param vectors_file:
+    :param words: (iterable of str) words to read; words missing from the file are left out
+    :return: (parameter_dict, vectors, center_vectors) as load_fulltxt_vectors, restricted to the
+    words found, in file order
+    """
+    wanted = {w.encode('utf-8') for w in words}
+    max_length = max((len(w) for w in wanted), default=0)
+    rows = {}
+    with open(vectors_file, 'rb') as f:
+        for line in f:
+            space = line.find(b' ', 0, max_length + 1)
+            if space > 0 and line[:space] in wanted and line[:space] not in rows:
+                rows[line[:space]] = np.array(line[space + 1:].split(), dtype=np.float64)
+                if len(rows) == len(wanted):
+                    break
+
+    vocab = [w.decode('utf-8') for w in rows]
+    if len(rows) == 0:
+        d = 0
+        full = np.zeros((0, 2))
+    else:
+        full = np.stack(list(rows.values()))
+        d = (full.shape[1] - 2) / 2
+        assert d.is_integer()
+        d = int(d)
+
+    parameter_dict = {
+        'W': full[:, :d], 'b_w': full[:, d:d + 1], 'U': full[:, d + 1:-1], 'b_u': full[:, -1:], 'vocab': vocab}
+    vectors, center_vectors = parameters_to_vector_dicts(parameter_dict=parameter_dict)
+    return parameter_dict, vectors, center_vectors
+
+
+def parameters_to_vector_dicts(
+        parameter_dict: Dict, words: Optional[Iterable[str]] = None) -> Tuple[Dict[str, list], Dict[str, list]]:
+    """
+    Builds the output (W + U) and center (W) vector dicts returned by load_fulltxt_vectors
+    from a parameter dict, optionally restricted to a set of words. Restricting the words
+    avoids materializing Python lists for the full vocabulary.
+    :param parameter_dict: (dict) with W, U and vocab entries
+    :param words: (iterable of str) words to include; all words in the vocabulary if None
+    :return: (vectors, center_vectors)
+    """
+    vocab = parameter_dict['vocab']
+    if words is None:
+        rows = np.arange(len(vocab))
+    else:
+        word_idx = {w: i for i, w in enumerate(vocab)}
+        rows = np.array(sorted({word_idx[w] for w in words if w in word_idx}), dtype=np.int64)
+
+    W = np.asarray(parameter_dict['W'][rows], dtype=np.float64)
+    U = np.asarray(parameter_dict['U'][rows], dtype=np.float64)
+    output = W + U
+
+    vectors = {vocab[i]: output[j, :].tolist() for j, i in enumerate(rows)}
+    center_vectors = {vocab[i]: W[j, :].tolist() for j, i in enumerate(rows)}
+    return vectors, center_vectors
+
+
+def save_binary_vectors(parameter_dict: Dict, store_dir: str, dtype: type = np.float32):
+    """
+    Writes a parameter dict (as returned by load_fulltxt_vectors) to a binary vector store:
+    one .npy matrix per parameter (W, U, b_w, b_u) plus a vocab.txt index with one word
+    per line, in row order. The store is meant to be written once and then opened with
+    load_binary_vectors, which memory-maps the matrices.
+    :param parameter_dict: (dict) with W, U, b_w, b_u and vocab entries
+    :param store_dir: output directory
+    :param dtype: floating point type of the stored matrices
+    :return:
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    V = len(parameter_dict['vocab'])
+    for name in STORE_PARAMETERS:
+        matrix = np.ascontiguousarray(parameter_dict[name], dtype=dtype)
+        assert matrix.shape[0] == V, f'[ERROR] {name} has {matrix.shape[0]} rows, expected {V}'
+        np.save(os.path.join(store_dir, f'{name}.npy'), matrix)
+
+    with open(os.path.join(store_dir, 'vocab.txt'), 'w') as f:
+        for w in parameter_dict['vocab']:
+            f.write(f'{w}\n')
+
+
+def load_binary_vectors(store_dir: str, mmap_mode: Optional[str] = 'r') -> Dict:
+    """
+    Opens a binary vector store written by save_binary_vectors. Matrices are memory-mapped
+    (read-only by default), so loading is close to free and concurrent processes share the
+    same pages.
+    :param store_dir: directory of the binary store
+    :param mmap_mode: np.load memory-map mode; None reads the matrices into memory
+    :return: (dict) with the same keys as the parameter dict of load_fulltxt_vectors
+    """
+    parameter_dict = {
+        name: np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+        for name in STORE_PARAMETERS}
+    parameter_dict['vocab'] = load_vocab_words(vocab_file=os.path.join(store_dir, 'vocab.txt'))
+    return parameter_dict
+
+
+def load_vocab_words(vocab_file: str) -> List[str]:
+    """
+    Reads the words of a GloVe vocab.txt (word count) or a binary store vocab.txt (word),
+    in row order.
+    :param vocab_file:
+    :return:
+    """
+    with open(vocab_file, 'r') as f:
+        return [line.rstrip('\n').split(' ')[0] for line in f if line.strip() != '']
+
+
+def load_glove_binary_vectors(vectors_file: str, vocab_file: str, real: type = np.float64) -> Dict:
+    """
+    Memory-maps the vectors.bin file written by GloVe when trained using the BINARY=1
+    (or BINARY=2) and MODEL=0 parameters. GloVe dumps its full parameter array: 2V rows of
+    d + 1 values, the first V rows holding the word vectors and biases and the last V rows
+    the context vectors and biases, in the order of the vocab file.
+    :param vectors_file: location of vectors.bin
+    :param vocab_file: location of the vocab.txt used for training
+    :param real: floating point type GloVe was compiled with (double by default)
+    :return: (dict) with the same keys as the parameter dict of load_fulltxt_vectors
+    """
+    vocab = load_vocab_words(vocab_file=vocab_file)
+    V = len(vocab)
+
+    params = np.memmap(vectors_file, dtype=real, mode='r')
+    d = params.shape[0] / (2 * V) - 1
+    assert d.is_integer(), f'[ERROR] {vectors_file} does not match a vocabulary of {V} words'
+    d = int(d)
+    params = params.reshape(2 * V, d + 1)
+
+    parameter_dict = {
+        'W': params[:V, :d], 'b_w': params[:V, d:],
+        'U': params[V:, :d], 'b_u': params[V:, d:],
+        'vocab': vocab}
+    return parameter_dict
+
+
+def vector_variant(parameter_dict: Dict, variant: str, rows: Optional[np.array] = None) -> np.array:
+    """
+    Derives word vectors from the GloVe parameters:
+     - center: the word (center) vectors W
+     - sum: W + U, the output vectors of load_fulltxt_vectors
+     - normalized: the sum of the row-normalized W and U, so that both contribute equally
+    :param parameter_dict: (dict) with W and U entries
+    :param variant: (str) one of VECTOR_VARIANTS
+    :param rows: (np.array) of vocabulary rows to derive, all rows if None
+    :return: (np.array) of shape (len(rows), d)
+    """
+    W = parameter_dict['W'] if rows is None else parameter_dict['W'][rows]
+    W = np.asarray(W, dtype=np.float64)
+    if variant == 'center':
+        return W
+
+    U = parameter_dict['U'] if rows is None else parameter_dict['U'][rows]
+    U = np.asarray(U, dtype=np.float64)
+    if variant == 'sum':
+        return W + U
+    elif variant == 'normalized':
+        return W / np.linalg.norm(W, axis=1, keepdims=True) + U / np.linalg.norm(U, axis=1, keepdims=True)
+    raise Exception('[ERROR] Check vector variant')
+
+
+class VectorView:
+    """
+    One vector variant (see vector_variant, or context for the context vectors U) of a Vectors
+    matrix. Behaves like the word-to-vector dicts of load_fulltxt_vectors (e.g. for
+    bias_utils.assemble_vectors), without materializing them, and gathers rows as matrices.
+    """
+    __slots__ = ('vectors', 'variant')
+
+    def __init__(self, vectors: 'Vectors', variant: str):
+        assert variant in VECTOR_VARIANTS or variant == 'context', f'[ERROR] Unknown vector variant {variant}'
+        self.vectors = vectors
+        self.variant = variant
+
+    def rows(self, rows: np.array) -> np.array:
+        """
+        :return: (np.array) of shape (len(rows), d), float64
+        """
+        if self.variant == 'context':
+            return np.asarray(self.vectors.matrix[rows, self.vectors.d:], dtype=np.float64)
+        return vector_variant(parameter_dict=self.vectors.parameters, variant=self.variant, rows=rows)
+
+    def norms(self) -> np.array:
+        return self.vectors.norms(variant=self.variant)
+
+    @property
+    def word_idx(self) -> Dict[str, int]:
+        return self.vectors.word_idx
+
+    def keys(self) -> List[str]:
+        return self.vectors.vocab
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.vectors.word_idx
+
+    def __getitem__(self, word: str) -> np.array:
+        return self.rows(np.array([self.vectors.word_idx[word]]))[0]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.vectors.vocab)
+
+    def __len__(self) -> int:
+        return len(self.vectors.vocab)
+
+
+class Vectors:
+    """
+    Compact in-memory GloVe model: the word and context vectors side by side in one contiguous
+    (V, 2d) float32 (or float16) matrix [W | U], their biases, and a word-to-row index. Row
+    norms are computed on first use. The center (W), context (U), sum (W + U) and normalized
+    variants are available as VectorViews, and the parameters as a parameter dict of views (so
+    Vectors can be used wherever a parameter dict is expected through .parameters).
+    """
+    __slots__ = ('matrix', 'biases', 'vocab', 'word_idx', 'd', '_norms')
+
+    def __init__(self, matrix: np.array, biases: np.array, vocab: List[str]):
+        """
+        :param matrix: (np.array) of shape (V, 2d), the word vectors followed by the context vectors
+        :param biases: (np.array) of shape (V, 2), the word and context biases
+        :param vocab: (list of str) words in row order
+        """
+        assert matrix.shape[0] == len(vocab) and matrix.shape[1] % 2 == 0, \
+            f'[ERROR] Expected a ({len(vocab)}, 2d) matrix, got {matrix.shape}'
+        self.matrix = matrix
+        self.biases = biases
+        self.vocab = list(vocab)
+        self.word_idx = {w: i for i, w in enumerate(self.vocab)}
+        self.d = matrix.shape[1] // 2
+        self._norms = {}
+
+    @classmethod
+    def from_parameters(cls, parameter_dict: Dict, dtype: type = np.float32, block_size: int = 65536) -> 'Vectors':
+        """
+        Copies a parameter dict (e.g. from load_binary_vectors or glove_trainer) into a Vectors
+        matrix, block by block.
+        """
+        V, d = parameter_dict['W'].shape
+        matrix = np.empty((V, 2 * d), dtype=dtype)
+        biases = np.zeros((V, 2), dtype=dtype)
+        for start in range(0, V, block_size):
+            end = min(start + block_size, V)
+            matrix[start:end, :d] = parameter_dict['W'][start:end]
+            matrix[start:end, d:] = parameter_dict['U'][start:end]
+            if 'b_w' in parameter_dict:
+                biases[start:end, 0] = np.ravel(parameter_dict['b_w'][start:end])
+                biases[start:end, 1] = np.ravel(parameter_dict['b_u'][start:end])
+        return cls(matrix=matrix, biases=biases, vocab=parameter_dict['vocab'])
+
+    @classmethod
+    def load_txt(cls, vectors_file: str, words: Optional[Iterable[str]] = None, dtype: type = np.float32) -> 'Vectors':
+        """
+        Reads a .txt file in the format of load_fulltxt_vectors directly into a Vectors matrix,
+        one row at a time, without building the vector dicts.
+        :param vectors_file:
+        :param words: (iterable of str) only read the rows of these words (see load_selected_vectors)
+        :param dtype: floating point type of the matrix
+        :return:
+        """
+        if words is not None:
+            parameter_dict, _, _ = load_selected_vectors(vectors_file=vectors_file, words=words)
+            return cls.from_parameters(parameter_dict=parameter_dict, dtype=dtype)
+
+        with open(vectors_file, 'r') as f:
+            V = sum(1 for line in f if str.strip(line) != '')
+        vocab = []
+        matrix, biases = None, None
+        with open(vectors_file, 'r') as f:
+            for line in f:
+                if str.strip(line) == '':
+                    continue
+                vals = line.rstrip().split(' ')
+                row = np.array(vals[1:], dtype=np.float64)
+                if matrix is None:
+                    d = (len(row) - 2) / 2
+                    assert d.is_integer()
+                    d = int(d)
+                    matrix = np.empty((V, 2 * d), dtype=dtype)
+                    biases = np.empty((V, 2), dtype=dtype)
+                i = len(vocab)
+                matrix[i, :d], biases[i, 0] = row[:d], row[d]
+                matrix[i, d:], biases[i, 1] = row[d + 1:-1], row[-1]
+                vocab.append(vals[0])
+        if matrix is None:
+            matrix, biases = np.zeros((0, 0), dtype=dtype), np.zeros((0, 2), dtype=dtype)
+        return cls(matrix=matrix, biases=biases, vocab=vocab)
+
+    @property
+    def parameters(self) -> Dict:
+        # Views of the matrix, in the layout of the parameter dict of load_fulltxt_vectors
+        return {'W': self.matrix[:, :self.d], 'U': self.matrix[:, self.d:],
+                'b_w': self.biases[:, :1], 'b_u': self.biases[:, 1:], 'vocab': self.vocab}
+
+    def view(self, variant: str) -> VectorView:
+        return VectorView(vectors=self, variant=variant)
+
+    @property
+    def center(self) -> VectorView:
+        return self.view(variant='center')
+
+    @property
+    def context(self) -> VectorView:
+        return self.view(variant='context')
+
+    @property
+    def sum(self) -> VectorView:
+        return self.view(variant='sum')
+
+    def norms(self, variant: str = 'center', block_size: int = 65536) -> np.array:
+        """
+        Row norms of a vector variant, computed (in blocks) on first use.
+        :return: (np.array) of shape (V,), float32
+        """
+        if variant not in self._norms:
+            norms = np.zeros(len(self.vocab), dtype=np.float32)
+            for start in range(0, len(self.vocab), block_size):
+                rows = np.arange(start, min(start + block_size, len(self.vocab)))
+                norms[rows] = np.linalg.norm(self.view(variant=variant).rows(rows=rows), axis=1)
+            self._norms[variant] = norms
+        return self._norms[variant]
+
+    def __len__(self) -> int:
+        return len(self.vocab)
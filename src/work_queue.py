@@ -0,0 +1,286 @@
+#
+# Work queue over a shared directory, for spreading bootstrap iterations over the processes
+# of several machines. Tasks are files that move between directories with atomic renames:
+#
+#   known/{id}                created once by the first worker adding the task, never removed
+#   pending/{id}              waiting to be claimed
+#   leased/{id}.{worker}      claimed by a worker, kept alive by touching the file (heartbeat)
+#   results/{id}.json         finished, written atomically
+#   failures/{id}.json        attempts and last error of a task that failed
+#   failed/{id}               failed max_attempts times, no longer claimed
+#
+# Leases that stop being touched for lease_seconds (e.g. the worker's machine died) are moved
+# back to pending. A task that is finished twice (a worker lost its lease but still finished)
+# overwrites the same result file, so iterations are neither lost nor duplicated. A stop request
+# applies to the tasks queued when it was made: adding new tasks clears it.
+#
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+# Name of the file that tells all workers to stop claiming tasks
+STOP_FILE = 'stop'
+
+
+class WorkQueue:
+    def __init__(self, queue_dir: str, lease_seconds: float = 600, heartbeat_seconds: float = 30,
+                 max_attempts: int = 3):
+        """
+        :param queue_dir: shared directory of the queue (created if missing)
+        :param lease_seconds: time after which a lease that is not renewed is recovered
+        :param heartbeat_seconds: time between renewals of the leases held by this worker
+        :param max_attempts: number of failures after which a task is marked failed
+        """
+        assert heartbeat_seconds < lease_seconds, '[ERROR] Heartbeats must be more frequent than lease expiry'
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+        self.pending_dir = os.path.join(queue_dir, 'pending')
+        self.leased_dir = os.path.join(queue_dir, 'leased')
+        self.results_dir = os.path.join(queue_dir, 'results')
+        self.known_dir = os.path.join(queue_dir, 'known')
+        self.failures_dir = os.path.join(queue_dir, 'failures')
+        self.failed_dir = os.path.join(queue_dir, 'failed')
+        for d in (self.known_dir, self.pending_dir, self.leased_dir, self.results_dir, self.failures_dir,
+                  self.failed_dir):
+            os.makedirs(d, exist_ok=True)
+
+        self._leases = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._heartbeat_stop = threading.Event()
+
+    def _lease_file(self, task_id: int) -> str:
+        return os.path.join(self.leased_dir, f'{task_id}.{self.worker_id}')
+
+    def _result_file(self, task_id: int) -> str:
+        return os.path.join(self.results_dir, f'{task_id}.json')
+
+    def _failure_file(self, task_id: int) -> str:
+        return os.path.join(self.failures_dir, f'{task_id}.json')
+
+    def add_tasks(self, task_ids: Iterable[int]) -> int:
+        """
+        Adds tasks that were never added before. Safe to call from every worker with the same
+        ids: a task is only queued by the worker that creates its known marker, so a task that
+        another worker claims in the meantime is never queued again. Adding new tasks clears a
+        stop request (see clear_stop).
+        :return: number of tasks added
+        """
+        leased = {name.split('.')[0] for name in os.listdir(self.leased_dir)}
+        failed = set(os.listdir(self.failed_dir))
+        added = 0
+        for task_id in task_ids:
+            try:
+                with open(os.path.join(self.known_dir, str(task_id)), 'x'):
+                    pass
+            except FileExistsError:
+                continue
+            # Queues created before the known markers may already hold the task
+            if os.path.exists(self._result_file(task_id)) or str(task_id) in leased or str(task_id) in failed:
+                continue
+            try:
+                with open(os.path.join(self.pending_dir, str(task_id)), 'x'):
+                    added += 1
+            except FileExistsError:
+                continue
+        if added > 0:
+            self.clear_stop()
+        return added
+
+    def recover_expired(self) -> int:
+        """
+        Moves leases that have not been renewed within lease_seconds back to pending.
+        :return: number of tasks recovered
+        """
+        recovered = 0
+        now = time.time()
+        for name in os.listdir(self.leased_dir):
+            lease_file = os.path.join(self.leased_dir, name)
+            try:
+                if now - os.stat(lease_file).st_mtime < self.lease_seconds:
+                    continue
+                os.rename(lease_file, os.path.join(self.pending_dir, name.split('.')[0]))
+                recovered += 1
+            except FileNotFoundError:
+                # Renewed-and-finished or recovered by another worker
+                continue
+        return recovered
+
+    def claim(self) -> Optional[int]:
+        """
+        Claims a pending task, recovering abandoned leases first.
+        :return: task id, or None if there is nothing to claim
+        """
+        if self.stopped():
+            return None
+        self.recover_expired()
+        for name in sorted(os.listdir(self.pending_dir), key=lambda x: int(x)):
+            pending_file = os.path.join(self.pending_dir, name)
+            task_id = int(name)
+            try:
+                # Fresh mtime first, so the new lease cannot look expired
+                os.utime(pending_file)
+                os.rename(pending_file, self._lease_file(task_id))
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+
+            if os.path.exists(self._result_file(task_id)):
+                # Finished by a worker that had lost its lease
+                self._remove_lease(task_id)
+                continue
+
+            with self._lock:
+                self._leases.add(task_id)
+            return task_id
+        return None
+
+    def _remove_lease(self, task_id: int):
+        with self._lock:
+            self._leases.discard(task_id)
+        try:
+            os.remove(self._lease_file(task_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task_id: int, result: Dict):
+        """
+        Writes the result of a task atomically and releases its lease.
+        """
+        result_file = self._result_file(task_id)
+        tmp_file = f'{result_file}.{self.worker_id}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(result, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, result_file)
+        self._remove_lease(task_id)
+
+    def release(self, task_id: int):
+        """
+        Returns a claimed task to pending, e.g. after a failure.
+        """
+        with self._lock:
+            self._leases.discard(task_id)
+        try:
+            os.rename(self._lease_file(task_id), os.path.join(self.pending_dir, str(task_id)))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, task_id: int, error: str) -> int:
+        """
+        Records a failure of a claimed task. The task returns to pending, or is marked failed
+        (and no longer claimed) after max_attempts failures.
+        :return: number of failed attempts of the task
+        """
+        failure_file = self._failure_file(task_id)
+        attempts = 0
+        if os.path.exists(failure_file):
+            with open(failure_file, 'r') as f:
+                attempts = json.load(f)['attempts']
+        attempts += 1
+        tmp_file = f'{failure_file}.{self.worker_id}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'attempts': attempts, 'error': error, 'worker': self.worker_id}, f)
+        os.replace(tmp_file, failure_file)
+
+        if attempts < self.max_attempts:
+            self.release(task_id=task_id)
+            return attempts
+        with self._lock:
+            self._leases.discard(task_id)
+        try:
+            os.rename(self._lease_file(task_id), os.path.join(self.failed_dir, str(task_id)))
+        except FileNotFoundError:
+            pass
+        return attempts
+
+    def failures(self) -> Dict[int, Dict]:
+        """
+        Attempts and last error of the tasks marked failed, by task id.
+        """
+        failures = {}
+        for name in os.listdir(self.failed_dir):
+            with open(self._failure_file(int(name)), 'r') as f:
+                failures[int(name)] = json.load(f)
+        return failures
+
+    def renew(self) -> List[int]:
+        """
+        Renews the leases held by this worker.
+        :return: ids of the tasks whose lease was lost (recovered by another worker)
+        """
+        lost = []
+        with self._lock:
+            leases = list(self._leases)
+        for task_id in leases:
+            try:
+                os.utime(self._lease_file(task_id))
+            except FileNotFoundError:
+                lost.append(task_id)
+        return lost
+
+    def start_heartbeat(self):
+        """
+        Renews the leases of this worker from a background thread until stop_heartbeat.
+        """
+        def beat():
+            while not self._heartbeat_stop.wait(self.heartbeat_seconds):
+                for task_id in self.renew():
+                    print(f'[WARNING] Lost the lease of task {task_id}')
+
+        self._heartbeat_stop.clear()
+        self._heartbeat = threading.Thread(target=beat, daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def request_stop(self):
+        """
+        Tells all workers to stop claiming tasks (tasks already running still finish).
+        """
+        with open(os.path.join(self.queue_dir, STOP_FILE), 'w'):
+            pass
+
+    def clear_stop(self):
+        """
+        Lets workers claim tasks again after request_stop.
+        """
+        try:
+            os.remove(os.path.join(self.queue_dir, STOP_FILE))
+        except FileNotFoundError:
+            pass
+
+    def stopped(self) -> bool:
+        return os.path.exists(os.path.join(self.queue_dir, STOP_FILE))
+
+    def remaining(self) -> int:
+        """
+        Number of tasks pending or leased (failed tasks are not counted).
+        """
+        return len(os.listdir(self.pending_dir)) + len(os.listdir(self.leased_dir))
+
+    def results(self) -> Dict[int, Dict]:
+        """
+        Results of all finished tasks, by task id.
+        """
+        results = {}
+        for name in os.listdir(self.results_dir):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.results_dir, name), 'r') as f:
+                results[int(name[:-len('.json')])] = json.load(f)
+        return results
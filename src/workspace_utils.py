@@ -0,0 +1,137 @@
+#
+# Per-iteration bootstrap workspaces. Every iteration reads the same co-occurrence data, so
+# workspaces share one read-only copy of it; only the shuffled co-occurrences and the trained
+# vectors are private to an iteration.
+#
+
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import trace_utils
+
+# How the shared inputs are made available in a workspace:
+#  - copy: full copy of each file (the original behavior)
+#  - hardlink: hardlinks to the source files, falling back to a copy across file systems
+#  - shared: symbolic links to the source files, which avoids copies even across file systems
+WORKSPACE_MODES = ('copy', 'hardlink', 'shared')
+
+# Files shared (read-only) by all iterations of a bootstrap
+SHARED_FILES = ('cooccurrence.bin', 'vocab.txt')
+
+# Marker identifying the host and process that own a workspace
+MARKER_FILE = '.workspace'
+
+# Names of the workspaces created by bootstrap_workspace ({k}_ and the random mkdtemp suffix)
+WORKSPACE_NAME = re.compile(r'^\d+_[a-z0-9_]+$')
+
+# Age after which a workspace without a marker (its process died before writing it) is removed
+UNMARKED_SECONDS = 60
+
+
+def link_or_copy(f: str, out_file: str, mode: str = 'hardlink'):
+    """
+    Makes f available at out_file as a hardlink, a symbolic link or a copy.
+    :param f: source file
+    :param out_file: destination
+    :param mode: (str) one of WORKSPACE_MODES
+    :return:
+    """
+    if mode == 'shared':
+        os.symlink(os.path.abspath(f), out_file)
+        return
+    if mode == 'hardlink':
+        try:
+            os.link(f, out_file)
+            return
+        except OSError as e:
+            print(f'[WARNING] Could not hardlink {f} ({e}), copying instead')
+    shutil.copyfile(f, out_file)
+
+
+@contextmanager
+def bootstrap_workspace(vector_loc: str, k: int, mode: str = 'hardlink',
+                        shared_files: Tuple[str, ...] = SHARED_FILES, work_dir: Optional[str] = None) -> Iterator[Path]:
+    """
+    Creates a private workspace directory for bootstrap iteration k under work_dir, with the
+    shared inputs (cooccurrence.bin and vocab.txt) of vector_loc linked in according to mode. The directory
+    is removed on exit, including when the iteration fails; workspaces left behind by
+    processes that were killed are removed by clean_stale_workspaces.
+    :param vector_loc: directory with the shared cooccurrence.bin and vocab.txt
+    :param k: iteration number
+    :param mode: (str) one of WORKSPACE_MODES
+    :param shared_files: names of the files of vector_loc to link in
+    :param work_dir: directory holding the workspace, vector_loc if None (e.g. a run directory
+    when vector_loc is a read-only cache entry)
+    :return: path of the workspace
+    """
+    assert mode in WORKSPACE_MODES, f'[ERROR] Unknown workspace mode {mode}'
+
+    # Unique name, so that concurrent runs over the same work_dir never collide
+    output_dir = Path(tempfile.mkdtemp(prefix=f'{k}_', dir=vector_loc if work_dir is None else work_dir))
+    try:
+        with open(output_dir / MARKER_FILE, 'w') as f:
+            f.write(f'{socket.gethostname()} {os.getpid()}\n')
+
+        with trace_utils.stage('workspace_setup', mode=mode):
+            for file_name in shared_files:
+                link_or_copy(f=os.path.join(vector_loc, file_name), out_file=str(output_dir / file_name), mode=mode)
+
+        yield output_dir
+    finally:
+        shutil.rmtree(str(output_dir), ignore_errors=True)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def clean_stale_workspaces(vector_loc: str) -> int:
+    """
+    Removes workspaces under vector_loc whose owning process no longer runs on this host,
+    e.g. after a crash or after pool workers were terminated. Workspaces owned by other hosts
+    are left alone. Workspaces without a marker (a process died between creating the directory
+    and writing the marker) are removed once they are older than UNMARKED_SECONDS.
+    :param vector_loc: directory holding the workspaces
+    :return: number of workspaces removed
+    """
+    hostname = socket.gethostname()
+    removed = 0
+    if not os.path.isdir(vector_loc):
+        return removed
+
+    for output_dir in Path(vector_loc).iterdir():
+        marker = output_dir / MARKER_FILE
+        if not output_dir.is_dir() or not WORKSPACE_NAME.match(output_dir.name):
+            continue
+        if not marker.exists():
+            try:
+                unmarked = time.time() - output_dir.stat().st_mtime > UNMARKED_SECONDS and not marker.exists()
+            except FileNotFoundError:
+                continue
+            if unmarked:
+                shutil.rmtree(str(output_dir), ignore_errors=True)
+                removed += 1
+            continue
+        try:
+            with open(marker, 'r') as f:
+                host, pid = f.read().split()
+        except (OSError, ValueError):
+            continue
+        if host == hostname and not _pid_alive(int(pid)):
+            shutil.rmtree(str(output_dir), ignore_errors=True)
+            removed += 1
+
+    return removed